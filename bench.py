@@ -0,0 +1,365 @@
+from dataclasses import dataclass
+from typing import *
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import struct
+import sys
+import time
+import timeit
+import trio
+import bencode
+import bencode_fields
+import main as dht
+import sql
+from util import chunk_bytes, quiet_logging
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Fraction of a baseline's throughput that can be lost before it's a regression.
+DEFAULT_THRESHOLD = 0.1
+
+
+@dataclass
+class Fixture:
+    name: str
+    bytes: bytes
+    # Path looked up by the bencode_get benchmark.
+    get_path: Tuple[Union[str, int], ...]
+    # Path to a string of fixed size records for the chunk benchmarks, and the
+    # record size.
+    chunk_path: Optional[Tuple[Union[str, int], ...]] = None
+    chunk_size: int = 20
+
+
+def _compact_nodes(rng: random.Random, count: int) -> bytes:
+    return b"".join(
+        struct.pack("!20s4sH", rng.randbytes(20), rng.randbytes(4), rng.randrange(1, 65536))
+        for _ in range(count)
+    )
+
+
+def make_info(rng: random.Random, files: int, pieces: int, piece_length: int) -> dict:
+    info: Dict[str, Any] = {
+        "name": b"fixture",
+        "piece length": piece_length,
+        "pieces": rng.randbytes(20 * pieces),
+    }
+    if files == 1:
+        info["length"] = pieces * piece_length
+    else:
+        info["files"] = [
+            {
+                "length": rng.randrange(1, 1 << 32),
+                "path": [b"dir%d" % (index % 16), b"file%d.bin" % index],
+            }
+            for index in range(files)
+        ]
+    return info
+
+
+# The fixtures checked in to FIXTURES_DIR, as written by --write-fixtures. They
+# come from a fixed seed, so rewriting them only changes them if this does.
+def make_fixture_messages() -> Dict[str, dict]:
+    rng = random.Random(0)
+    return {
+        "ping_query": {
+            "t": rng.randbytes(2),
+            "y": "q",
+            "q": "ping",
+            "a": {"id": rng.randbytes(20)},
+        },
+        "ping_reply": {
+            "t": rng.randbytes(2),
+            "y": "r",
+            "ip": rng.randbytes(6),
+            "r": {"id": rng.randbytes(20)},
+        },
+        # 16 compact nodes, so a 416 byte nodes string.
+        "find_node_reply": {
+            "t": rng.randbytes(2),
+            "y": "r",
+            "r": {"id": rng.randbytes(20), "nodes": _compact_nodes(rng, 16)},
+        },
+        "sample_infohashes_reply": {
+            "t": rng.randbytes(8),
+            "y": "r",
+            "r": {
+                "id": rng.randbytes(20),
+                "interval": 21600,
+                "nodes": _compact_nodes(rng, 8),
+                "num": 3120,
+                "samples": rng.randbytes(20 * 50),
+            },
+        },
+        "info_small": make_info(rng, files=1, pieces=32, piece_length=1 << 18),
+        "info_medium": make_info(rng, files=300, pieces=2000, piece_length=1 << 20),
+    }
+
+
+# Multi-MB info dicts aren't checked in, but built from a fixed seed on load.
+def make_large_fixture_messages() -> Dict[str, dict]:
+    rng = random.Random(1)
+    return {
+        "info_large": make_info(rng, files=5000, pieces=150_000, piece_length=1 << 22)
+    }
+
+
+_fixture_paths: Dict[str, Tuple[tuple, Optional[tuple], int]] = {
+    "ping_query": (("a", "id"), None, 20),
+    "ping_reply": (("r", "id"), None, 20),
+    "find_node_reply": (("r", "nodes"), ("r", "nodes"), 26),
+    "sample_infohashes_reply": (("r", "samples"), ("r", "samples"), 20),
+    "info_small": (("pieces",), ("pieces",), 20),
+    "info_medium": (("pieces",), ("pieces",), 20),
+    "info_large": (("pieces",), ("pieces",), 20),
+}
+
+
+def write_fixtures(directory: str = FIXTURES_DIR):
+    os.makedirs(directory, exist_ok=True)
+    for name, message in make_fixture_messages().items():
+        with open(os.path.join(directory, name + ".bencode"), "wb") as file:
+            file.write(bencode.encode_to_bytes(message))
+
+
+def load_fixtures(directory: str = FIXTURES_DIR, large: bool = True) -> List[Fixture]:
+    encoded = {}
+    for name in make_fixture_messages():
+        with open(os.path.join(directory, name + ".bencode"), "rb") as file:
+            encoded[name] = file.read()
+    if large:
+        for name, message in make_large_fixture_messages().items():
+            encoded[name] = bencode.encode_to_bytes(message)
+    fixtures = []
+    for name, bytes in encoded.items():
+        get_path, chunk_path, chunk_size = _fixture_paths[name]
+        fixtures.append(Fixture(name, bytes, get_path, chunk_path, chunk_size))
+    return fixtures
+
+
+def messages_db():
+    db_conn = sql.connect(":memory:")
+    db_conn.execute(
+        'create table messages(parent_id, "index", depth, type, value, top_id)'
+    )
+    return db_conn
+
+
+# Yields the name, input size and a function to time, of each benchmark of each
+# fixture.
+def benchmark_cases(fixtures: Iterable[Fixture]) -> Iterator[Tuple[str, int, Callable]]:
+    db_conn = messages_db()
+    for fixture in fixtures:
+        data = fixture.bytes
+        value = bencode.parse_one_from_bytes(data)
+        size = len(data)
+        name = fixture.name
+        yield f"encode/{name}", size, lambda value=value: bencode.encode_to_bytes(value)
+        yield f"parse_one_from_bytes/{name}", size, (
+            lambda data=data: bencode.parse_one_from_bytes(data)
+        )
+        yield f"bencode_get/{name}", size, (
+            lambda data=data, path=fixture.get_path: sql.bencode_get(data, *path)
+        )
+
+        def record(data=data):
+            bencode_fields.record_packet(
+                data, db_conn, bencode_fields.new_message_id(db_conn)
+            )
+            db_conn.rollback()
+
+        yield f"message_writer/{name}", size, record
+        if fixture.chunk_path is None:
+            continue
+        records = sql.bencode_get(data, *fixture.chunk_path)
+        yield f"chunk_bytes/{name}", len(records), (
+            lambda records=records, size=fixture.chunk_size: list(
+                chunk_bytes(records, size, strict=True)
+            )
+        )
+        yield f"chunk_table/{name}", len(records), (
+            lambda records=records, size=fixture.chunk_size: db_conn.execute(
+                "select count(*) from chunk(?, ?)", (records, size)
+            ).fetchone()
+        )
+
+
+# Answers every query as soon as it's sent, with a find_node reply of 8 nodes
+# from a fixed pool, so the receive path and the traversal are all that's left
+# to time.
+class LoopbackSocket:
+    def __init__(self, seed: int = 0, pool: int = 1024):
+        rng = random.Random(seed)
+        self._replies = [
+            b"d1:rd2:id20:%s5:nodes208:%se1:t" % (rng.randbytes(20), _compact_nodes(rng, 8))
+            for _ in range(pool)
+        ]
+        self._sent = 0
+        self._send, self._receive = trio.open_memory_channel(math.inf)
+        self.replies = 0
+        self.bytes = 0
+
+    async def sendto(self, bytes, addr):
+        tid = sql.bencode_get(bytes, "t")
+        reply = self._replies[self._sent % len(self._replies)]
+        self._sent += 1
+        self._send.send_nowait((reply + b"%d:%s1:y1:re" % (len(tid), tid), addr))
+
+    async def recvfrom(self, bufsize):
+        reply = await self._receive.receive()
+        self.replies += 1
+        self.bytes += len(reply[0])
+        return reply
+
+
+class _LoopbackBootstrap(dht.Bootstrap):
+    alpha = 64
+
+
+# Runs back to back find_node traversals through a Dispatcher until at least
+# count replies have been received, and returns the socket.
+async def receive_replies(count: int) -> LoopbackSocket:
+    rng = random.Random(0)
+    socket = LoopbackSocket()
+    dispatcher = dht.Dispatcher(socket)
+    seeds = [("10.0.0.%d" % index, 6881) for index in range(1, 65)]
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(dispatcher.run)
+        while socket.replies < count:
+            traversal = _LoopbackBootstrap(
+                socket, rng.randbytes(20), bytes(20), dispatcher=dispatcher
+            )
+            traversal.add_candidates(*seeds)
+            try:
+                await traversal.wait_exhausted()
+            finally:
+                traversal.close()
+        nursery.cancel_scope.cancel()
+    return socket
+
+
+# Best seconds per reply, and the mean reply size, of receive_replies.
+def measure_receive(replies: int = 20000, repeat: int = 3) -> Tuple[float, int]:
+    best = math.inf
+    with quiet_logging():
+        for _ in range(repeat):
+            started = time.perf_counter()
+            socket = trio.run(receive_replies, replies)
+            best = min(best, (time.perf_counter() - started) / socket.replies)
+    return best, socket.bytes // socket.replies
+
+
+# Best seconds per call of func, over repeat runs long enough to time reliably.
+def measure(func: Callable, repeat: int = 3) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run_benchmarks(
+    fixtures: Iterable[Fixture], filter: Optional[str] = None, repeat: int = 3
+) -> Dict[str, Any]:
+    results = {}
+
+    def report(name, size, seconds):
+        results[name] = {
+            "bytes": size,
+            "seconds_per_op": seconds,
+            "ops_per_second": 1 / seconds,
+            "bytes_per_second": size / seconds,
+        }
+        print(f"{name:45} {1 / seconds:14,.1f} ops/s {size / seconds / 1e6:10.1f} MB/s")
+
+    for name, size, func in benchmark_cases(fixtures):
+        if filter is not None and filter not in name:
+            continue
+        report(name, size, measure(func, repeat))
+    # Replies per second through the dispatcher and a traversal, end to end.
+    name = "receive/find_node_reply"
+    if filter is None or filter in name:
+        seconds, size = measure_receive(repeat=repeat)
+        report(name, size, seconds)
+    return {
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+# Returns the benchmarks in both runs whose throughput dropped by more than
+# threshold from the baseline, with their baseline and current ops per second.
+def find_regressions(
+    current: Dict[str, Any], baseline: Dict[str, Any], threshold: float = DEFAULT_THRESHOLD
+) -> List[Tuple[str, float, float]]:
+    regressions = []
+    for name, result in current["results"].items():
+        try:
+            before = baseline["results"][name]["ops_per_second"]
+        except KeyError:
+            continue
+        after = result["ops_per_second"]
+        if after < before * (1 - threshold):
+            regressions.append((name, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark bencode and SQL helpers over representative fixtures"
+    )
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument(
+        "--baseline",
+        default="bench_baseline.json",
+        help="results to compare against, if it exists",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="write the results to the baseline instead of comparing with it",
+    )
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--no-large", action="store_true", help="skip the multi-MB info dicts"
+    )
+    parser.add_argument(
+        "--write-fixtures",
+        action="store_true",
+        help="regenerate the checked in fixtures, and exit",
+    )
+    args = parser.parse_args()
+    if args.write_fixtures:
+        write_fixtures()
+        return
+    results = run_benchmarks(
+        load_fixtures(large=not args.no_large), args.filter, args.repeat
+    )
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print(
+            f"regression: {name} {before:,.1f} -> {after:,.1f} ops/s "
+            f"({after / before - 1:+.0%})",
+            file=sys.stderr,
+        )
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
-from typing import Union, Any, Protocol, Optional, Iterable
+from typing import Union, Any, Protocol, Optional, Iterable, Tuple
 from dataclasses import dataclass
 import itertools
+import operator
 import typing
 import collections, collections.abc
 
@@ -9,48 +10,62 @@ Object = Union[Dict, int, bytes, list]
 
 
 def encode_to_bytes(value: Any) -> bytes:
-    return b"".join(encode(value))
+    return bytes(encode_into(value, bytearray()))
 
 
 def encode(value):
-    return {
-        dict: encode_dict,
-        list: encode_list,
-        int: encode_int,
-        str: encode_str,
-        bytes: encode_bytes,
-    }[type(value)](value)
-
-
-def encode_dict(value):
-    yield b"d"
-    for key, value in value.items():
-        yield from encode(key)
-        yield from encode(value)
-    yield b"e"
-
-
-def encode_list(value):
-    yield b"l"
-    for item in value:
-        yield from encode(item)
-    yield b"e"
-
-
-def encode_int(int):
-    yield b"i"
-    yield str(int)
-    yield b"e"
-
+    yield encode_to_bytes(value)
+
+
+_item_key = operator.itemgetter(0)
+
+
+def _encode_key(key) -> bytes:
+    if isinstance(key, str):
+        return key.encode()
+    return key
+
+
+# Appends the encoding of value to buf, and returns buf. Dict keys are emitted in
+# sorted order as required for canonical bencoding.
+def encode_into(value: Any, buf: bytearray) -> bytearray:
+    if isinstance(value, (bytes, bytearray)):
+        buf += b"%d:" % len(value)
+        buf += value
+    elif isinstance(value, str):
+        value = value.encode()
+        buf += b"%d:" % len(value)
+        buf += value
+    elif isinstance(value, int):
+        buf += b"i%de" % value
+    elif isinstance(value, collections.abc.Mapping):
+        buf += b"d"
+        items = [(_encode_key(key), item) for key, item in value.items()]
+        items.sort(key=_item_key)
+        for key, item in items:
+            buf += b"%d:" % len(key)
+            buf += key
+            encode_into(item, buf)
+        buf += b"e"
+    elif isinstance(value, (list, tuple)):
+        buf += b"l"
+        for item in value:
+            encode_into(item, buf)
+        buf += b"e"
+    else:
+        raise TypeError(f"can't bencode {type(value)}")
+    return buf
 
-def encode_bytes(bytes):
-    yield str(len(bytes)).encode()
-    yield b":"
-    yield bytes
 
+# Encodes into a buffer that is reused between calls, so steady-state encoding
+# only allocates the returned bytes.
+class Encoder:
+    def __init__(self):
+        self.buf = bytearray()
 
-def encode_str(str):
-    yield from encode_bytes(str.encode())
+    def encode(self, value: Any) -> bytes:
+        self.buf.clear()
+        return bytes(encode_into(value, self.buf))
 
 
 class Visitor(typing.Protocol):
@@ -103,25 +118,31 @@ BytesType = bytes
 @dataclass
 class BytesStreamReader:
     bytes: BytesType
+    # Offset of the next unread byte. Advancing this instead of reslicing keeps
+    # tokenizing linear in the input size.
+    pos: int = 0
 
     def peek_one(self) -> Optional[int]:
-        if len(self.bytes) == 0:
+        if self.pos >= len(self.bytes):
             return None
-        return self.bytes[0]
+        return self.bytes[self.pos]
 
     def read_until(self, until: BytesType) -> BytesType:
-        index = self.bytes.index(until)
-        ret = self.bytes[:index]
-        self.bytes = self.bytes[index + len(until) :]
+        index = self.bytes.index(until, self.pos)
+        ret = self.bytes[self.pos : index]
+        self.pos = index + len(until)
         return ret
 
     def read_exactly(self, amount):
-        ret = self.bytes[:amount]
-        self.bytes = self.bytes[amount:]
+        ret = self.bytes[self.pos : self.pos + amount]
+        self.pos += len(ret)
         return ret
 
     def advance_one(self):
-        self.bytes = self.bytes[1:]
+        self.pos += 1
+
+
+_specials = frozenset(map(ord, {"d", "l", "e"}))
 
 
 @dataclass
@@ -130,7 +151,7 @@ class StreamDecoder:
 
     def tokenize(self) -> Iterable[Union[Special, int, bytes]]:
         while (c := self.stream.peek_one()) is not None:
-            if c in map(ord, {"d", "l", "e"}):
+            if c in _specials:
                 self.stream.advance_one()
                 yield Special(c)
             elif c == ord("i"):
@@ -142,20 +163,14 @@ class StreamDecoder:
                 yield self.stream.read_exactly(l)
 
     def visit(self, visitor: Visitor):
-        from functools import partial
-
+        specials = {
+            ord("d"): visitor.start_dict,
+            ord("l"): visitor.start_list,
+            ord("e"): visitor.end,
+        }
         for token in self.tokenize():
             if isinstance(token, Special):
-                dict(
-                    map(
-                        lambda x: (ord(x[0]), *x[1:]),
-                        {
-                            "d": visitor.start_dict,
-                            "l": visitor.start_list,
-                            "e": visitor.end,
-                        }.items(),
-                    )
-                )[token.code]()
+                specials[token.code]()
             elif isinstance(token, int):
                 visitor.int(token)
             elif isinstance(token, bytes):
@@ -164,6 +179,157 @@ class StreamDecoder:
                 raise TypeError(token)
 
 
+_D, _L, _I, _E = b"dlie"
+
+
+def _decode(buf, pos: int) -> Tuple[Object, int]:
+    c = buf[pos]
+    if c == _D:
+        ret = Dict()
+        data = ret.data
+        pos += 1
+        while buf[pos] != _E:
+            key, pos = _decode(buf, pos)
+            data[key], pos = _decode(buf, pos)
+        return ret, pos + 1
+    elif c == _L:
+        ret = []
+        pos += 1
+        while buf[pos] != _E:
+            value, pos = _decode(buf, pos)
+            ret.append(value)
+        return ret, pos + 1
+    elif c == _I:
+        end = buf.index(b"e", pos + 1)
+        return int(buf[pos + 1 : end]), end + 1
+    else:
+        start, end = string_bounds(buf, pos)
+        return buf[start:end], end
+
+
+# Returns the offsets of the contents of the string at pos. Negative lengths are
+# rejected, since scanning would go backwards and could loop forever.
+def string_bounds(buf, pos: int) -> Tuple[int, int]:
+    colon = buf.index(b":", pos)
+    start = colon + 1
+    end = start + int(buf[pos:colon])
+    if end > len(buf) or end < start:
+        raise ValueError(f"string at offset {pos} overruns input")
+    return start, end
+
+
+def _scannable(buf):
+    # memoryview has no index/find, so scan over a single contiguous copy.
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return buf
+
+
+# Decodes the value starting at pos, returning it and the offset just past it.
+# The input is walked with an integer cursor and never resliced; only leaf
+# strings and integer digits are copied out.
+def decode_from(buf, pos: int = 0) -> Tuple[Object, int]:
+    buf = _scannable(buf)
+    try:
+        return _decode(buf, pos)
+    except IndexError:
+        raise ValueError("end not seen")
+
+
+_TOKEN, _INT, _LENGTH, _STRING = range(4)
+# Longest integer or string length prefix we'll buffer while waiting for its
+# terminator.
+_MAX_DIGITS = 32
+
+
+# Resumable parser that's fed arbitrary chunks of input, and emits Visitor events
+# as soon as each token is complete. Only a partially received token is
+# buffered, so memory is bounded by the largest string rather than the input.
+class PushParser:
+    def __init__(self, visitor: Visitor):
+        self.visitor = visitor
+        self._state = _TOKEN
+        self._pending = bytearray()
+        # Bytes still to come for the string being received.
+        self._remaining = 0
+        self._depth = 0
+
+    def feed(self, chunk: BytesType):
+        chunk = _scannable(chunk)
+        pos = 0
+        end = len(chunk)
+        visitor = self.visitor
+        while pos < end:
+            state = self._state
+            if state == _TOKEN:
+                c = chunk[pos]
+                if c == _D:
+                    self._depth += 1
+                    visitor.start_dict()
+                    pos += 1
+                elif c == _L:
+                    self._depth += 1
+                    visitor.start_list()
+                    pos += 1
+                elif c == _E:
+                    if self._depth == 0:
+                        raise ValueError("unexpected end")
+                    self._depth -= 1
+                    visitor.end()
+                    pos += 1
+                elif c == _I:
+                    self._state = _INT
+                    pos += 1
+                else:
+                    self._state = _LENGTH
+            elif state == _STRING:
+                take = min(self._remaining, end - pos)
+                if not self._pending and take == self._remaining:
+                    visitor.str(chunk[pos : pos + take])
+                else:
+                    self._pending += chunk[pos : pos + take]
+                    if take == self._remaining:
+                        visitor.str(bytes(self._pending))
+                        self._pending.clear()
+                self._remaining -= take
+                if not self._remaining:
+                    self._state = _TOKEN
+                pos += take
+            else:
+                terminator = b"e" if state == _INT else b":"
+                index = chunk.find(terminator, pos)
+                self._pending += chunk[pos : end if index == -1 else index]
+                if len(self._pending) > _MAX_DIGITS:
+                    raise ValueError("integer too long")
+                if index == -1:
+                    return
+                value = int(self._pending)
+                self._pending.clear()
+                pos = index + 1
+                if state == _INT:
+                    visitor.int(value)
+                    self._state = _TOKEN
+                elif value < 0:
+                    raise ValueError("negative string length")
+                elif value:
+                    self._remaining = value
+                    self._state = _STRING
+                else:
+                    visitor.str(b"")
+                    self._state = _TOKEN
+
+    def close(self):
+        if self._state != _TOKEN or self._depth:
+            raise ValueError("end not seen")
+
+
+def visit_chunks(chunks: Iterable[BytesType], visitor: Visitor):
+    parser = PushParser(visitor)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+
 def parse_until_end(tokens) -> Iterable[Object]:
     try:
         while (t := next(tokens)) != End:
@@ -191,12 +357,165 @@ def parse(tokens):
             return
 
 
+# Returns the offset just past the value starting at pos, without decoding it.
+def skip(buf, pos: int) -> int:
+    depth = 0
+    while True:
+        c = buf[pos]
+        if c == _D or c == _L:
+            depth += 1
+            pos += 1
+        elif c == _E:
+            if depth == 0:
+                raise ValueError(f"unexpected end at offset {pos}")
+            depth -= 1
+            pos += 1
+        elif c == _I:
+            pos = buf.index(b"e", pos + 1) + 1
+        else:
+            pos = string_bounds(buf, pos)[1]
+        if depth == 0:
+            return pos
+
+
+# Records the offsets of the values in the container at pos, and in every
+# container nested in it, returning the offset just past it. Offsets are keyed by
+# the decoded key for dicts. Only dict keys are copied out.
+def _index(buf, pos: int, table: typing.Dict[int, Union[dict, list]]) -> int:
+    c = buf[pos]
+    if c == _D:
+        offsets = table[pos] = {}
+        pos += 1
+        while buf[pos] != _E:
+            start, pos = string_bounds(buf, pos)
+            offsets[buf[start:pos]] = pos
+            pos = _index(buf, pos, table)
+        return pos + 1
+    elif c == _L:
+        offsets = table[pos] = []
+        pos += 1
+        while buf[pos] != _E:
+            offsets.append(pos)
+            pos = _index(buf, pos, table)
+        return pos + 1
+    elif c == _I:
+        return buf.index(b"e", pos + 1) + 1
+    else:
+        return string_bounds(buf, pos)[1]
+
+
+class _LazyContainer:
+    __slots__ = "_buf", "_pos", "_table", "_values"
+
+    def __init__(self, buf, pos: int, table=None):
+        self._buf = buf
+        self._pos = pos
+        # Shared by all the views into the same top-level value.
+        self._table = table
+        self._values = {}
+
+    def _index(self):
+        if self._table is None:
+            self._table = {}
+            try:
+                _index(self._buf, self._pos, self._table)
+            except IndexError:
+                raise ValueError("end not seen")
+        return self._table[self._pos]
+
+    def _value(self, pos: int):
+        buf = self._buf
+        c = buf[pos]
+        if c == _D:
+            return LazyDict(buf, pos, self._table)
+        if c == _L:
+            return LazyList(buf, pos, self._table)
+        return _decode(buf, pos)[0]
+
+
+# Read-only views over an encoded dict or list. The offsets of a container's
+# items are indexed the first time it's accessed, and only the values that are
+# actually read get decoded. Nested containers are returned as views too.
+class LazyDict(_LazyContainer, collections.abc.Mapping):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._values[key] = self._value(self._index()[key])
+        return value
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        return key in self._index()
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class LazyList(_LazyContainer, collections.abc.Sequence):
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        offsets = self._index()
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(offsets))[index]]
+        if index < 0:
+            index += len(offsets)
+        try:
+            return self._values[index]
+        except KeyError:
+            pass
+        if not 0 <= index < len(offsets):
+            raise IndexError(index)
+        value = self._values[index] = self._value(offsets[index])
+        return value
+
+    def __len__(self):
+        return len(self._index())
+
+    def __eq__(self, other):
+        if isinstance(other, collections.abc.Sequence) and not isinstance(
+            other, (str, bytes, bytearray)
+        ):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def parse_lazy(bytes) -> Object:
+    bytes = _scannable(bytes)
+    try:
+        return _LazyContainer(bytes, 0)._value(0)
+    except IndexError:
+        raise ValueError("end not seen")
+
+
 def parse_bytes(bytes):
-    return list(parse(StreamDecoder(BytesStreamReader(bytes)).tokenize()))
+    bytes = _scannable(bytes)
+    ret = []
+    pos = 0
+    while pos < len(bytes):
+        value, pos = decode_from(bytes, pos)
+        ret.append(value)
+    return ret
 
 
 def parse_one_from_bytes(bytes) -> Object:
-    return parse_bytes(bytes)[0]
+    return decode_from(bytes)[0]
 
 
 class Dict(collections.UserDict, collections.abc.Mapping):
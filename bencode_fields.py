@@ -1,7 +1,50 @@
+from dataclasses import dataclass
+import sqlite3
+import typing
+import bencode
+
+
 def new_message_id(db_conn: sqlite3.Connection) -> int:
     cursor = db_conn.cursor()
     cursor.execute("insert into messages default values")
-    return cursor.lastrowid
+    top_id = cursor.lastrowid
+    cursor.execute("update messages set top_id=rowid where rowid=?", [top_id])
+    return top_id
+
+
+# Adds the top_id column to an existing messages table, fills it in for rows
+# written before it existed, and indexes the columns used to look up fields.
+def upgrade_messages_table(db_conn: sqlite3.Connection):
+    existing = {row[1] for row in db_conn.execute("pragma table_info(messages)")}
+    if not existing:
+        return
+    with db_conn:
+        if "top_id" not in existing:
+            db_conn.execute("alter table messages add column top_id integer")
+        db_conn.execute(
+            'create index if not exists messages_parent_id on messages(parent_id, "index", type)'
+        )
+        db_conn.execute(
+            "create index if not exists messages_top_id on messages(top_id)"
+        )
+        db_conn.execute(
+            "update messages set top_id=rowid where parent_id is null and top_id is null"
+        )
+        # Propagate top ids down a level at a time. Messages are only a few
+        # levels deep, so this takes a handful of passes.
+        while (
+            db_conn.execute(
+                """
+                update messages set top_id=parent.top_id
+                from messages as parent
+                where messages.parent_id=parent.rowid
+                and messages.top_id is null
+                and parent.top_id is not null
+                """
+            ).rowcount
+            > 0
+        ):
+            pass
 
 
 @dataclass
@@ -16,6 +59,7 @@ class MessageWriter:
 
     def __init__(self, cursor, top_id):
         self.cursor = cursor
+        self.top_id = top_id
         self.field_contexts = [FieldContext(top_id)]
 
     def _cur_parent_id(self) -> typing.Union[int, None]:
@@ -24,29 +68,32 @@ class MessageWriter:
     def _cur_field_context(self) -> FieldContext:
         return self.field_contexts[-1]
 
-    def _insert_code(self, code):
-        self._insert(code, None)
+    def _insert_code(self, code) -> int:
+        return self._insert(code, None)
 
-    def _insert(self, code, value):
-        parent_id = self._cur_parent_id()
-        self.cursor.execute(
-            """insert into messages (parent_id, "index", depth, type, value) values (?, ?, ?, ?, ?)""",
-            [
-                parent_id,
-                self._cur_field_context().index,
-                self._cur_depth(),
-                code,
-                value,
-            ],
+    def _insert(self, code, value) -> int:
+        rowid = self._write_row(
+            self._cur_parent_id(),
+            self._cur_field_context().index,
+            self._cur_depth(),
+            code,
+            value,
         )
         self._cur_field_context().index += 1
+        return rowid
+
+    def _write_row(self, parent_id, index, depth, code, value) -> int:
+        self.cursor.execute(
+            """insert into messages (parent_id, "index", depth, type, value, top_id) values (?, ?, ?, ?, ?, ?)""",
+            [parent_id, index, depth, code, value, self.top_id],
+        )
+        return self.cursor.lastrowid
 
     def _cur_depth(self):
         return len(self.field_contexts) - 1
 
     def _start(self, code):
-        self._insert_code(code)
-        self.field_contexts.append(FieldContext(self.cursor.lastrowid))
+        self.field_contexts.append(FieldContext(self._insert_code(code)))
 
     def start_dict(self):
         self._start("d")
@@ -69,3 +116,48 @@ def record_packet(bytes, db_conn, top_id):
     bencode.StreamDecoder(bencode.BytesStreamReader(bytes)).visit(
         MessageWriter(db_conn.cursor(), top_id)
     )
+
+
+# Flattens messages into rows for the messages table, assigning rowids itself
+# rather than asking SQLite for each parent's, so that any number of messages can
+# be inserted with a single executemany.
+class BatchMessageWriter(MessageWriter):
+    def __init__(self, first_rowid: int):
+        self.next_rowid = first_rowid
+        self.rows: typing.List[tuple] = []
+        self.top_id = None
+        self.field_contexts = []
+
+    def start_message(self) -> int:
+        self.top_id = self.next_rowid
+        self._write_row(None, None, None, None, None)
+        self.field_contexts = [FieldContext(self.top_id)]
+        return self.top_id
+
+    def _write_row(self, parent_id, index, depth, code, value) -> int:
+        rowid = self.next_rowid
+        self.next_rowid += 1
+        self.rows.append((rowid, parent_id, index, depth, code, value, self.top_id))
+        return rowid
+
+
+# Records each packet as a new message, returning their top ids. Rowids are
+# assigned from the current maximum, so this takes the write lock up front unless
+# the caller already holds it in an open transaction.
+def record_packets(db_conn, packets: typing.Iterable[bytes]) -> typing.List[int]:
+    with db_conn:
+        if not db_conn.in_transaction:
+            db_conn.execute("begin immediate")
+        (first_rowid,) = db_conn.execute(
+            "select coalesce(max(rowid), 0) + 1 from messages"
+        ).fetchone()
+        writer = BatchMessageWriter(first_rowid)
+        top_ids = []
+        for bytes in packets:
+            top_ids.append(writer.start_message())
+            bencode.StreamDecoder(bencode.BytesStreamReader(bytes)).visit(writer)
+        db_conn.executemany(
+            """insert into messages (rowid, parent_id, "index", depth, type, value, top_id) values (?, ?, ?, ?, ?, ?, ?)""",
+            writer.rows,
+        )
+    return top_ids
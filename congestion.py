@@ -0,0 +1,123 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import *
+import logging
+from my_types import Addr
+from util import percentiles
+
+
+# Smoothed round-trip time, and the timeout derived from it, as in RFC 6298.
+@dataclass
+class RttEstimator:
+    srtt: Optional[float] = None
+    rttvar: float = 0.0
+
+    def update(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self) -> Optional[float]:
+        if self.srtt is None:
+            return None
+        return self.srtt + 4 * self.rttvar
+
+
+# Picks how many queries a traversal keeps in flight, and how long to wait for
+# each reply. Share one between traversals so what's learned carries over.
+#
+# The window grows by one each time a window's worth of replies arrive, and
+# shrinks multiplicatively on timeouts while the recent timeout rate is above
+# max_timeout_rate. Some timeouts are expected in the DHT, since many nodes we
+# hear about are gone, so timeouts below that rate don't shrink the window.
+class QueryScheduler:
+    def __init__(
+        self,
+        initial_window: float = 3,
+        min_window: float = 1,
+        max_window: float = 64,
+        max_timeout_rate: float = 0.5,
+        initial_timeout: float = 5,
+        min_timeout: float = 0.25,
+        max_timeout: float = 5,
+        max_nodes: int = 100_000,
+        rtt_samples: int = 10_000,
+    ):
+        self.window = float(initial_window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_timeout_rate = max_timeout_rate
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_nodes = max_nodes
+        # Exponentially weighted fraction of recent queries that timed out.
+        self.timeout_rate = 0.0
+        self.session = RttEstimator()
+        self.nodes: "OrderedDict[Addr, RttEstimator]" = OrderedDict()
+        self.recent_rtts: Deque[float] = deque(maxlen=rtt_samples)
+        self.recent_windows: Deque[float] = deque(maxlen=rtt_samples)
+        self.responses = 0
+        self.timeouts = 0
+
+    @property
+    def alpha(self) -> int:
+        return int(self.window)
+
+    def timeout_for(self, addr: Addr) -> float:
+        node = self.nodes.get(addr)
+        timeout = None if node is None else node.timeout()
+        if timeout is None:
+            timeout = self.session.timeout()
+        if timeout is None:
+            return self.initial_timeout
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def _node(self, addr: Addr) -> RttEstimator:
+        try:
+            self.nodes.move_to_end(addr)
+            return self.nodes[addr]
+        except KeyError:
+            node = self.nodes[addr] = RttEstimator()
+            if len(self.nodes) > self.max_nodes:
+                self.nodes.popitem(last=False)
+            return node
+
+    def on_response(self, addr: Addr, rtt: float):
+        self.responses += 1
+        self._node(addr).update(rtt)
+        self.session.update(rtt)
+        self.recent_rtts.append(rtt)
+        self.timeout_rate *= 0.95
+        self.window = min(self.max_window, self.window + 1 / self.window)
+        self.recent_windows.append(self.window)
+
+    def on_timeout(self, addr: Addr):
+        self.timeouts += 1
+        self.timeout_rate = 0.95 * self.timeout_rate + 0.05
+        if self.timeout_rate > self.max_timeout_rate:
+            self.window = max(self.min_window, self.window * 0.75)
+        self.recent_windows.append(self.window)
+
+    def log_stats(self):
+        node_srtts = [node.srtt for node in self.nodes.values() if node.srtt is not None]
+        logging.info(
+            "query scheduler: window %.1f (recent p10/p50/p90 %s), "
+            "%d responses, %d timeouts (recent rate %.2f), "
+            "session srtt %s, rtt p50/p90/p99 %s, node srtt p50/p90/p99 %s",
+            self.window,
+            _format(percentiles(self.recent_windows, [10, 50, 90]), "%.1f"),
+            self.responses,
+            self.timeouts,
+            self.timeout_rate,
+            _format([self.session.srtt], "%.3f"),
+            _format(percentiles(self.recent_rtts, [50, 90, 99]), "%.3f"),
+            _format(percentiles(node_srtts, [50, 90, 99]), "%.3f"),
+        )
+
+
+def _format(values, format) -> str:
+    return "/".join("-" if value is None else format % value for value in values)
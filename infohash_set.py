@@ -0,0 +1,134 @@
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from typing import *
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_SORT_SLICE = 1 << 15
+
+
+# Membership of 20-byte infohashes in bounded memory. Infohashes are reduced to
+# their first 64 bits, kept in a sorted packed array plus a small set of recent
+# additions that's merged in once it grows. That's 8 bytes per infohash instead
+# of ~90 for a set of bytes, and 64-bit prefixes of hashes practically never
+# collide even at billions of entries.
+#
+# Merging is linear in the packed size, which at 100M entries takes seconds, so
+# it's done on a background thread. Meanwhile the keys being merged are still
+# looked up in their own set, and new ones go to a fresh delta.
+class InfohashSet:
+    def __init__(self, min_merge: int = 1 << 16):
+        self.packed = array("Q")
+        self.delta: Set[int] = set()
+        self.merging: Set[int] = set()
+        self.min_merge = min_merge
+        self._merge_thread: Optional[threading.Thread] = None
+        self._merged: Optional[array] = None
+
+    @staticmethod
+    def key(infohash: bytes) -> int:
+        return int.from_bytes(infohash[:8], "big")
+
+    def __len__(self):
+        return len(self.packed) + len(self.merging) + len(self.delta)
+
+    def __contains__(self, infohash: bytes) -> bool:
+        key = self.key(infohash)
+        if key in self.delta or key in self.merging:
+            return True
+        i = bisect_left(self.packed, key)
+        return i < len(self.packed) and self.packed[i] == key
+
+    def add(self, infohash: bytes):
+        if infohash in self:
+            return
+        self.delta.add(self.key(infohash))
+        thread = self._merge_thread
+        if thread is not None and not thread.is_alive():
+            self._finish_merge()
+        # Merge cost is linear in the packed size, so let the delta grow with it.
+        if self._merge_thread is None and len(self.delta) >= max(
+            self.min_merge, len(self.packed) // 16
+        ):
+            self._start_merge()
+
+    def _start_merge(self):
+        self.merging, self.delta = self.delta, set()
+        self._merge_thread = threading.Thread(
+            target=self._merge_into, args=(self.packed, self.merging), daemon=True
+        )
+        self._merge_thread.start()
+
+    def _merge_into(self, packed: array, keys: Set[int]):
+        # A sort holds the GIL throughout, so sort in slices short enough not to
+        # stall the event loop, and merge those.
+        keys = list(keys)
+        runs = [
+            sorted(keys[start : start + _SORT_SLICE])
+            for start in range(0, len(keys), _SORT_SLICE)
+        ]
+        self._merged = array("Q", heapq.merge(packed, *runs))
+
+    def _finish_merge(self):
+        assert self._merge_thread is not None
+        self._merge_thread.join()
+        assert self._merged is not None
+        self.packed = self._merged
+        self._merged = None
+        self._merge_thread = None
+        self.merging = set()
+
+    # Packs everything, waiting for any merge in progress.
+    def merge(self):
+        if self._merge_thread is not None:
+            self._finish_merge()
+        self._start_merge()
+        self._finish_merge()
+
+    # The infohashes whose keys are in [low, high).
+    def between(self, low: int, high: int) -> "InfohashSet":
+        subset = InfohashSet(self.min_merge)
+        subset.packed = self.packed[
+            bisect_left(self.packed, low) : bisect_left(self.packed, high)
+        ]
+        subset.delta = {
+            key for key in chain(self.merging, self.delta) if low <= key < high
+        }
+        return subset
+
+    # Appends keys that must be ascending and distinct from each other and
+    # everything already packed.
+    def _extend_sorted(self, keys: Iterable[int]):
+        last = self.packed[-1] if self.packed else -1
+        for key in keys:
+            if key != last:
+                self.packed.append(key)
+                last = key
+
+    @classmethod
+    def load(cls, db_conn, **kwargs) -> "InfohashSet":
+        self = cls(**kwargs)
+        with db_conn:
+            db_conn.execute(
+                "create index if not exists sample_infohashes_response_infohash_infohash on sample_infohashes_response_infohash(infohash)"
+            )
+        # Blobs sort bytewise, which is the order of their big-endian prefixes.
+        self._extend_sorted(
+            cls.key(infohash)
+            for (infohash,) in db_conn.execute(
+                "select distinct infohash from sample_infohashes_response_infohash order by infohash"
+            )
+        )
+        return self
+
+    def log_stats(self):
+        logger.info(
+            "%d known infohashes in %d bytes",
+            len(self),
+            self.packed.itemsize * len(self.packed)
+            + 40 * (len(self.merging) + len(self.delta)),
+        )
@@ -0,0 +1,120 @@
+from typing import *
+import logging
+import random
+import time
+
+ID_BITS = 160
+
+
+# Tracks which regions of the keyspace have been sampled, by the IDs of nodes
+# that answered sample_infohashes, and when. Regions are the IDs sharing a
+# prefix of prefix_bits bits. Traversal targets are picked in the regions that
+# were sampled least recently, never sampled regions first.
+class CoveragePlanner:
+    def __init__(self, prefix_bits: int = 12):
+        self.prefix_bits = prefix_bits
+        regions = 1 << prefix_bits
+        self.samples = [0] * regions
+        self.last_sampled = [0.0] * regions
+        # When a target was last picked in each region, so concurrent
+        # traversals spread out before any of them report back.
+        self.last_planned = [0.0] * regions
+        # The regions targets are picked from.
+        self.regions: Sequence[int] = range(regions)
+
+    def region(self, id: bytes) -> int:
+        return int.from_bytes(id, "big") >> (len(id) * 8 - self.prefix_bits)
+
+    def record(self, node_id: bytes, now: Optional[float] = None):
+        if len(node_id) * 8 < self.prefix_bits:
+            return
+        region = self.region(node_id)
+        self.samples[region] += 1
+        self.last_sampled[region] = time.time() if now is None else now
+
+    # Limits targets to the index-th of count equal slices of the keyspace.
+    def restrict(self, index: int, count: int):
+        regions = len(self.samples)
+        self.regions = range(index * regions // count, (index + 1) * regions // count)
+
+    # A random ID in the region.
+    def random_id(self, region: int) -> bytes:
+        suffix_bits = ID_BITS - self.prefix_bits
+        id = (region << suffix_bits) | random.getrandbits(suffix_bits)
+        return id.to_bytes(ID_BITS // 8, "big")
+
+    def pick_target(self, now: Optional[float] = None) -> bytes:
+        region = min(
+            self.regions,
+            key=lambda region: (
+                max(self.last_sampled[region], self.last_planned[region]),
+                self.samples[region],
+                random.random(),
+            ),
+        )
+        self.last_planned[region] = time.time() if now is None else now
+        return self.random_id(region)
+
+    # Fraction of regions sampled at all, and since each of the given times.
+    def coverage(self, since: Sequence[float] = ()) -> Tuple[float, List[float]]:
+        regions = len(self.samples)
+        covered = sum(1 for count in self.samples if count) / regions
+        return (
+            covered,
+            [
+                sum(1 for last in self.last_sampled if last and last >= time)
+                / regions
+                for time in since
+            ],
+        )
+
+    def log_stats(self):
+        now = time.time()
+        covered, (last_hour, last_day) = self.coverage([now - 3600, now - 86400])
+        logging.info(
+            "keyspace coverage at %d bits: %.1f%% ever, %.1f%% in the last hour, %.1f%% in the last day",
+            self.prefix_bits,
+            covered * 100,
+            last_hour * 100,
+            last_day * 100,
+        )
+
+    @staticmethod
+    def _create_tables(db_conn):
+        db_conn.execute(
+            "create table if not exists keyspace_coverage(prefix_bits integer, prefix integer, samples integer, last_sampled real, primary key (prefix_bits, prefix))"
+        )
+        db_conn.execute(
+            "create table if not exists keyspace_coverage_history(time real, prefix_bits integer, covered real, last_hour real, last_day real)"
+        )
+
+    def save(self, db_conn):
+        now = time.time()
+        covered, (last_hour, last_day) = self.coverage([now - 3600, now - 86400])
+        with db_conn:
+            self._create_tables(db_conn)
+            db_conn.executemany(
+                "insert or replace into keyspace_coverage(prefix_bits, prefix, samples, last_sampled) values (?, ?, ?, ?)",
+                (
+                    (self.prefix_bits, region, count, self.last_sampled[region])
+                    for region, count in enumerate(self.samples)
+                    if count
+                ),
+            )
+            db_conn.execute(
+                "insert into keyspace_coverage_history(time, prefix_bits, covered, last_hour, last_day) values (?, ?, ?, ?, ?)",
+                (now, self.prefix_bits, covered, last_hour, last_day),
+            )
+
+    @classmethod
+    def load(cls, db_conn, prefix_bits: int = 12) -> "CoveragePlanner":
+        self = cls(prefix_bits)
+        with db_conn:
+            self._create_tables(db_conn)
+        for region, count, last_sampled in db_conn.execute(
+            "select prefix, samples, last_sampled from keyspace_coverage where prefix_bits=?",
+            (prefix_bits,),
+        ):
+            self.samples[region] = count
+            self.last_sampled[region] = last_sampled
+        return self
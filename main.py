@@ -6,7 +6,13 @@ import sqlite3
 import logging
 import typing
 import functools
-from sortedcontainers import SortedSet
+import heapq
+import copy
+import multiprocessing
+import queue
+import random
+import time
+from collections import OrderedDict
 import secrets
 import struct
 from trio import socket
@@ -17,10 +23,25 @@ import argparse
 import os
 from abc import abstractmethod
 import sql
+import bencode_fields
+import metrics
 from my_types import Addr
 from util import chunk_bytes
+from congestion import QueryScheduler
+from node_health import NodeHealthCache, Verdict
+from revisit import RevisitScheduler
+from keyspace_coverage import CoveragePlanner
+from infohash_set import InfohashSet
+from pacing import Pacer, PacedSocket
+from profiling import Profiler
+from util import percentiles, quiet_logging
 from itertools import repeat
 import hashlib
+import calendar
+import json
+
+if TYPE_CHECKING:
+    from simulation import SimNetwork
 
 global_bootstrap_nodes: List[Addr] = [
     ("router.utorrent.com", 6881),
@@ -65,113 +86,424 @@ def distance_hex(a, b) -> str:
 TransactionId = NewType("TransactionId", bytes)
 
 
+# Nodes to query, closest to the target first, followed by nodes with unknown IDs
+# in the order they were added, and then deferred nodes. Each node's distance to
+# the target is computed once, when it's added.
+class Candidates:
+    def __init__(self, target: bytes):
+        self.target = int.from_bytes(target, "big")
+        self._heap: List[Tuple[int, int, int, Optional[int], NodeInfo]] = []
+        self._added: Set[NodeInfo] = set()
+        self._count = 0
+
+    def distance(self, node_info: NodeInfo) -> Optional[int]:
+        if node_info.id is None:
+            return None
+        return self.target ^ int.from_bytes(node_info.id.bytes, "big")
+
+    # Adds the node unless it's been added before, or its distance is beyond
+    # bound. Returns whether it was added.
+    def add(self, node_info: NodeInfo, bound: Optional[int] = None) -> bool:
+        if node_info in self._added:
+            return False
+        distance = self.distance(node_info)
+        if distance is not None and bound is not None and distance > bound:
+            return False
+        self._added.add(node_info)
+        self._push(0 if distance is not None else 1, distance, node_info)
+        return True
+
+    def _push(self, tier: int, distance: Optional[int], node_info: NodeInfo):
+        self._count += 1
+        heapq.heappush(
+            self._heap, (tier, distance or 0, self._count, distance, node_info)
+        )
+
+    # Puts a popped node back, to be popped after all the others.
+    def defer(self, distance: Optional[int], node_info: NodeInfo):
+        self._push(2, distance, node_info)
+
+    def pop(self) -> Tuple[Optional[int], NodeInfo]:
+        _, _, _, distance, node_info = heapq.heappop(self._heap)
+        return distance, node_info
+
+    def __len__(self):
+        return len(self._heap)
+
+
+# The k closest nodes seen to the target, by precomputed distance.
+class ClosestNodes:
+    def __init__(self, k: int = 8):
+        self.k = k
+        # A max-heap on distance, so the furthest of the k closest is first.
+        self._heap: List[Tuple[int, int, NodeInfo]] = []
+        self._count = 0
+
+    # The distance a node must not exceed to be among the k closest, once there
+    # are k nodes.
+    @property
+    def bound(self) -> Optional[int]:
+        if len(self._heap) < self.k:
+            return None
+        return -self._heap[0][0]
+
+    def add(self, node_info: NodeInfo, distance: int):
+        self._count += 1
+        entry = (-distance, self._count, node_info)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif distance < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def __iter__(self) -> Iterator[NodeInfo]:
+        # Furthest first.
+        return (entry[2] for entry in sorted(self._heap))
+
+    def __len__(self):
+        return len(self._heap)
+
+
+# Routes replies to whatever started the transaction, from one receive loop. It
+# also sends queries from a pool of tasks, so that a send held back by pacing to
+# one subnet doesn't hold up the others, and expires transactions from a single
+# deadline heap. Handlers of transactions with deadlines implement on_message,
+# on_sent, on_send_error and on_timeout.
+class Dispatcher:
+    senders = 64
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.transactions: Dict[TransactionId, Any] = {}
+        # Entries of transactions that have since completed are skipped when
+        # they come due.
+        self.deadlines: List[Tuple[float, TransactionId]] = []
+        self._timer_scope: Optional[trio.CancelScope] = None
+        self._outgoing, self._outgoing_receiver = trio.open_memory_channel[
+            Tuple[Any, TransactionId, bytes, Addr]
+        ](float("inf"))
+
+    def new_transaction_id(self) -> TransactionId:
+        while True:
+            tid = TransactionId(secrets.token_bytes(8))
+            if tid not in self.transactions:
+                return tid
+
+    def dispatch(self, bytes, src):
+        # Only the transaction ID is read until we know the message is wanted.
+        try:
+            key = sql.bencode_get(bytes, "t")
+        except (ValueError, IndexError):
+            key = None
+        if not isinstance(key, typing.ByteString):
+            logging.warning("got undecodable message from %r: %r", src, bytes)
+            return
+        handler = self.transactions.get(key)
+        if handler is None:
+            logging.warning("got unexpected reply: %r", key)
+            return
+        try:
+            msg = typing.cast(bencode.Dict, bencode.parse_lazy(bytes))
+            # The view only indexes the input when it's first read, so do that
+            # here, where a truncated message can be dropped.
+            len(msg)
+        except ValueError:
+            logging.warning("got undecodable message from %r: %r", src, bytes)
+            return
+        handler.on_message(msg, src)
+
+    # Queues a query to be sent. The handler's on_sent or on_send_error is called
+    # once it has been. Queries whose transactions have completed by the time
+    # they're dequeued aren't sent.
+    def send(self, handler, tid: TransactionId, bytes: bytes, addr: Addr):
+        self._outgoing.send_nowait((handler, tid, bytes, addr))
+
+    def set_deadline(self, tid: TransactionId, deadline: float):
+        heapq.heappush(self.deadlines, (deadline, tid))
+        if self._timer_scope is not None and deadline < self._timer_scope.deadline:
+            self._timer_scope.deadline = deadline
+
+    def expire(self, now: float):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, tid = heapq.heappop(self.deadlines)
+            handler = self.transactions.get(tid)
+            if handler is not None:
+                handler.on_timeout(tid)
+
+    async def _send_loop(self):
+        async for handler, tid, bytes, addr in self._outgoing_receiver:
+            if self.transactions.get(tid) is not handler:
+                continue
+            try:
+                await self.socket.sendto(bytes, addr)
+            except socket.gaierror:
+                logging.warning("error sending to %r: %s", addr, sys.exc_info()[1])
+                handler.on_send_error(tid)
+            else:
+                handler.on_sent(tid)
+
+    async def _expire_loop(self):
+        while True:
+            deadline = self.deadlines[0][0] if self.deadlines else float("inf")
+            with trio.CancelScope(deadline=deadline) as self._timer_scope:
+                await trio.sleep_forever()
+            self._timer_scope = None
+            self.expire(trio.current_time())
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            for _ in range(self.senders):
+                nursery.start_soon(self._send_loop)
+            nursery.start_soon(self._expire_loop)
+            while True:
+                bytes, addr = await self.socket.recvfrom(0x1000)
+                self.dispatch(bytes, addr)
+
+    # Sends a single query outside of any traversal, and returns the reply, or
+    # None if there isn't one within timeout.
+    async def request(
+        self, addr: Addr, q: str, a: Dict[str, Any], timeout: float
+    ) -> Optional[bencode.Dict]:
+        tid = self.new_transaction_id()
+        pending = PendingRequest()
+        self.transactions[tid] = pending
+        try:
+            await self.socket.sendto(
+                bencode.encode_to_bytes({"t": tid, "y": "q", "q": q, "a": a}), addr
+            )
+            with trio.move_on_after(timeout):
+                await pending.replied.wait()
+            return pending.reply
+        finally:
+            del self.transactions[tid]
+
+
+class PendingRequest:
+    def __init__(self):
+        self.replied = trio.Event()
+        self.reply: Optional[bencode.Dict] = None
+
+    def on_message(self, msg: bencode.Dict, src):
+        self.reply = msg
+        self.replied.set()
+
+
+_queries = metrics.registry.counter("dht_queries_total", "traversal queries sent")
+_replies = metrics.registry.counter("dht_replies_total", "replies to traversal queries")
+_error_replies = metrics.registry.counter(
+    "dht_error_replies_total", "error replies to traversal queries"
+)
+_timeouts = metrics.registry.counter(
+    "dht_query_timeouts_total", "traversal queries that timed out"
+)
+_rtt = metrics.registry.histogram(
+    "dht_query_rtt_seconds", "round trip time of traversal queries", metrics.RTT_BUCKETS
+)
+_active = metrics.registry.gauge("dht_active_queries", "traversal queries in flight")
+_backlog = metrics.registry.gauge(
+    "dht_backlog_candidates", "candidates waiting in traversal backlogs"
+)
+_sample_responses = metrics.registry.counter(
+    "dht_sample_infohashes_responses_total", "sample_infohashes responses handled"
+)
+_samples = metrics.registry.counter(
+    "dht_infohash_samples_total", "infohashes in sample_infohashes responses"
+)
+_new_infohashes = metrics.registry.counter(
+    "dht_new_infohashes_total", "sampled infohashes not seen before"
+)
+
+
+@dataclass
+class PendingQuery:
+    addr: Addr
+    bytes: bytes
+    timeout: float
+    sent: Optional[float] = None
+    # Sent only for the nodes in the reply, instead of the traversal's query.
+    routing_only: bool = False
+
+
 class Traversal:
     alpha: int = 3
+    # Whether the query is sample_infohashes, which not every node supports.
+    samples_infohashes = False
 
-    def __init__(self, socket, target: typing.ByteString, nursery, local_id: bytes):
-        self.active: Dict[TransactionId, trio.MemorySendChannel] = {}
+    def __init__(
+        self,
+        socket,
+        target: typing.ByteString,
+        local_id: bytes,
+        dispatcher: Optional[Dispatcher] = None,
+        scheduler: Optional[QueryScheduler] = None,
+        routing_table: Optional["RoutingTable"] = None,
+        node_health: Optional[NodeHealthCache] = None,
+    ):
+        if dispatcher is None:
+            dispatcher = Dispatcher(socket)
+        self.dispatcher = dispatcher
+        self.scheduler = scheduler
+        self.routing_table = routing_table
+        self.node_health = node_health
+        self.deferred: Set[Addr] = set()
+        self.active: Dict[TransactionId, PendingQuery] = {}
         self.queried: Set[Addr] = set()
         self.local_id = local_id
         self.socket = socket
         self.target = target
-        # this is sorted so that the best candidates are at the end, since pop defaults to popping from the back
-        self.backlog: SortedSet[NodeInfo] = SortedSet(key=self._distance_key)
-        self.exhausted = trio.Condition()
-        self.nursery = nursery
-        self.responded: SortedSet[NodeInfo] = SortedSet(key=self._distance_key)
-
-    def _distance_key(
-        self, elem: NodeInfo
-    ) -> Union[Tuple[Literal[False], int], Tuple[Literal[True], int, int]]:
-        addr = hash(elem.addr)
-        if elem.id is None:
-            return False, addr
-        else:
-            return (
-                True,
-                -(distance(self.target, elem.id.bytes)),
-                addr,
-            )
-
-    def new_transaction_id(self) -> TransactionId:
-        return TransactionId(secrets.token_bytes(8))
+        self.backlog = Candidates(target)
+        self.exhausted = trio.Event()
+        self._reported_backlog = 0
+        self.responded = ClosestNodes()
+        self.encoder = bencode.Encoder()
 
     def add_candidates(self, *addrs: Addr):
-        self.backlog.update([NodeInfo(None, addr) for addr in addrs])
+        for addr in addrs:
+            if addr not in self.queried:
+                self.backlog.add(NodeInfo(None, addr))
+        self.try_do_sends()
+
+    def add_nodes(self, *node_infos: NodeInfo):
+        for node_info in node_infos:
+            if node_info.addr not in self.queried:
+                self.backlog.add(node_info)
         self.try_do_sends()
 
-    def on_reply(self, reply, src):
-        msg = typing.cast(bencode.Dict, bencode.parse_one_from_bytes(reply))
+    def on_message(self, msg: bencode.Dict, src):
         # logging.debug("got reply:\n%s", pformat(msg))
         key = msg[b"t"]
-        if key not in self.active:
+        pending = self.finish_query(key)
+        if pending is None:
             logging.warning("got unexpected reply: %r", key)
             return
-        self.nursery.start_soon(self.active[key].send, msg)
-        try:
-            replier_id = msg[b"r"][b"id"]
-        except KeyError:
-            logging.warning(
-                "got reply from %r with no replier id:\n%s", src, pformat(msg)
+        addr = pending.addr
+        _replies.inc()
+        if pending.sent is not None:
+            rtt = trio.current_time() - pending.sent
+            _rtt.observe(rtt)
+            if self.scheduler is not None:
+                self.scheduler.on_response(addr, rtt)
+        if self.node_health is not None:
+            self.node_health.on_reply(
+                addr, msg, self.samples_infohashes and not pending.routing_only
+            )
+        if not pending.routing_only:
+            self.on_response(msg, addr)
+        if b"r" in msg:
+            try:
+                reply_id: bytes = msg[b"r"][b"id"]
+            except KeyError:
+                logging.warning(
+                    "got reply from %r with no replier id:\n%s", src, pformat(msg)
+                )
+            else:
+                node_info = NodeInfo(PeerId(reply_id), addr)
+                self.responded.add(node_info, self.backlog.distance(node_info))
+                if self.routing_table is not None:
+                    self.routing_table.add(node_info)
+            try:
+                nodes = msg[b"r"][b"nodes"]
+            except KeyError:
+                pass
+            else:
+                self.process_reply_nodes(nodes)
+        if b"e" in msg:
+            _error_replies.inc()
+            logging.error(
+                "got error from %s: %s\nwe sent: %r", addr, msg, pending.bytes
             )
+        self.after_query()
 
-    def start_query(self, addr, q, a=None):
+    def on_sent(self, key: TransactionId):
+        pending = self.active.get(key)
+        if pending is None:
+            return
+        pending.sent = trio.current_time()
+        self.dispatcher.set_deadline(key, pending.sent + pending.timeout)
+        _queries.inc()
+
+    def on_send_error(self, key: TransactionId):
+        if self.finish_query(key) is not None:
+            self.after_query()
+
+    def on_timeout(self, key: TransactionId):
+        pending = self.finish_query(key)
+        if pending is not None:
+            _timeouts.inc()
+            self.on_query_timeout(pending.addr)
+            self.after_query()
+
+    def start_query(self, addr, q, a=None, routing_only=False):
         if a is None:
             a = {}
         a["id"] = self.local_id
-        tid = self.new_transaction_id()
+        tid = self.dispatcher.new_transaction_id()
         msg = {"t": tid, "y": "q", "q": q, "a": a}
-        key = tid
+        bytes = self.encoder.encode(msg)
+        self.track_query(tid, addr, bytes, routing_only)
+        self.dispatcher.send(self, tid, bytes, addr)
+
+    # Registers a query as in flight, so its reply or timeout comes back here.
+    def track_query(
+        self, key: TransactionId, addr: Addr, bytes: bytes, routing_only=False
+    ) -> PendingQuery:
         if key in self.active:
             raise KeyError("already in use")
-        send_channel, receive_channel = trio.open_memory_channel[bencode.Dict](0)
-        self.active[key] = send_channel
-        self.queried.add(addr)
-        self.nursery.start_soon(
-            self.do_query, b"".join(bencode.encode(msg)), addr, receive_channel, key
+        pending = self.active[key] = PendingQuery(
+            addr, bytes, self.timeout_for(addr), routing_only=routing_only
         )
+        _active.inc()
+        self.dispatcher.transactions[key] = self
+        self.queried.add(addr)
+        return pending
 
-    def process_reply_nodes(self, nodes):
-        for id, packed_ip, port in struct.iter_unpack("!20s4sH", nodes):
-            self.backlog.add(NodeInfo(PeerId(id), (socket.inet_ntoa(packed_ip), port),))
+    def finish_query(self, key: TransactionId) -> Optional["PendingQuery"]:
+        pending = self.active.pop(key, None)
+        if pending is not None:
+            del self.dispatcher.transactions[key]
+            _active.inc(-1)
+        return pending
+
+    def after_query(self):
         self.try_do_sends()
+        self._notify_if_exhausted()
 
-    async def do_query(
-        self,
-        bytes,
-        addr: Addr,
-        response_receiver: trio.MemoryReceiveChannel,
-        key: TransactionId,
-    ):
-        try:
-            async with response_receiver:
-                try:
-                    await self.socket.sendto(bytes, addr)
-                except socket.gaierror:
-                    logging.warning("error sending to %r: %s", addr, sys.exc_info()[1])
-                else:
-                    with trio.move_on_after(5):
-                        reply: bencode.Dict = await response_receiver.receive()
-                        self.on_response(reply)
-                        if b"r" in reply:
-                            reply_id: bytes = reply[b"r"][b"id"]
-                            self.responded.add(NodeInfo(PeerId(reply_id), addr))
-                            try:
-                                nodes = reply[b"r"][b"nodes"]
-                            except KeyError:
-                                pass
-                            else:
-                                self.process_reply_nodes(nodes)
-                        if b"e" in reply:
-                            logging.error(
-                                "got error from %s: %s\nwe sent: %r", addr, reply, bytes
-                            )
-        finally:
-            del self.active[key]
-            await self._try_notify_exhausted()
+    # Abandons the queries in flight, so that nothing more is sent.
+    def close(self):
+        for key in list(self.active):
+            self.finish_query(key)
+        self.backlog = Candidates(self.target)
+        self._report_backlog(0)
+
+    def process_reply_nodes(self, nodes):
+        bound = self.responded.bound
+        for id, packed_ip, port in struct.iter_unpack("!20s4sH", nodes):
+            addr = (socket.inet_ntoa(packed_ip), port)
+            if addr in self.queried:
+                continue
+            # Candidates further than the closest nodes that have responded
+            # can't improve the result.
+            self.backlog.add(NodeInfo(PeerId(id), addr), bound)
         self.try_do_sends()
 
-    def on_response(self, response: bencode.Dict):
+    def on_query_timeout(self, addr: Addr):
+        if self.scheduler is not None:
+            self.scheduler.on_timeout(addr)
+        if self.routing_table is not None:
+            self.routing_table.on_timeout(addr)
+        if self.node_health is not None:
+            self.node_health.on_timeout(addr)
+
+    def timeout_for(self, addr: Addr) -> float:
+        if self.scheduler is None:
+            return 5
+        return self.scheduler.timeout_for(addr)
+
+    def window(self) -> int:
+        if self.scheduler is None:
+            return self.alpha
+        return self.scheduler.alpha
+
+    def on_response(self, response: bencode.Dict, addr: Addr):
         pass
 
     @abstractmethod
@@ -183,45 +515,58 @@ class Traversal:
 
     def start_next(self):
         try:
-            node_info = self.backlog.pop()
+            distance, node_info = self.backlog.pop()
             # We don't drop nodes without an ID, since we don't know what it
-            # is, it could actually be closer.
-            if len(self.responded) >= 8 and node_info.id is not None:
-                # Note that we use >, since we could have multiple candidates
-                # with the same distance for silly reasons.
-                if distance(node_info.id.bytes, self.target) > distance(
-                    self.responded[-8].id.bytes, self.target
-                ):
-                    logging.debug("discarding divergent candidate %r", node_info)
-                    return
+            # is, it could actually be closer. The bound may have tightened
+            # since the node was added. Note that we use >, since we could have
+            # multiple candidates with the same distance for silly reasons.
+            bound = self.responded.bound
+            if distance is not None and bound is not None and distance > bound:
+                logging.debug("discarding divergent candidate %r", node_info)
+                return
             addr = node_info.addr
             if addr in self.queried:
                 logging.warning("skipping already queried addr %r", addr)
                 return
-            logger.debug(
-                "picked %r for next query (distance=%s)",
-                node_info,
-                None
-                if node_info.id is None
-                else distance_hex(self.target, node_info.id.bytes),
-            )
+            if self.node_health is not None and addr not in self.deferred:
+                verdict = self.node_health.check(addr, self.samples_infohashes)
+                if verdict == Verdict.SKIP:
+                    logging.debug("skipping unhealthy node %r", node_info)
+                    return
+                if verdict == Verdict.DEFER:
+                    self.deferred.add(addr)
+                    self.backlog.defer(distance, node_info)
+                    return
+                if verdict == Verdict.ROUTE_ONLY:
+                    return self.start_query(addr, *self.find_node(), routing_only=True)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "picked %r for next query (distance=%s)",
+                    node_info,
+                    None if distance is None else f"{distance:040x}",
+                )
             return self.start_query(addr, *self.query())
         finally:
-            self.nursery.start_soon(self._try_notify_exhausted)
+            self._notify_if_exhausted()
 
     def try_do_sends(self):
-        while len(self.active) < self.alpha and self.backlog:
+        while len(self.active) < self.window() and self.backlog:
             self.start_next()
+        self._report_backlog(len(self.backlog))
+
+    # The backlog gauge is the sum over traversals, so report changes to it.
+    def _report_backlog(self, size: int):
+        _backlog.inc(size - self._reported_backlog)
+        self._reported_backlog = size
 
     async def wait_exhausted(self):
-        async with self.exhausted:
-            while not self._exhausted_predicate():
-                await self.exhausted.wait()
+        while not self._exhausted_predicate():
+            self.exhausted = trio.Event()
+            await self.exhausted.wait()
 
-    async def _try_notify_exhausted(self):
-        async with self.exhausted:
-            if self._exhausted_predicate():
-                self.exhausted.notify_all()
+    def _notify_if_exhausted(self):
+        if self._exhausted_predicate():
+            self.exhausted.set()
 
     def _exhausted_predicate(self):
         return not self.active and not self.backlog
@@ -232,102 +577,663 @@ class Bootstrap(Traversal):
     query = Traversal.find_node
 
 
+# Inserts a sample_infohashes response received at the given time, without
+# committing, and returns its infohashes.
+def insert_sample_infohashes_response(db_conn, response, time: str) -> List[bytes]:
+    cursor = db_conn.cursor()
+    cursor.execute(
+        "insert into sample_infohashes_response(time, query_t, num, interval) values (?, ?, ?, ?)",
+        (
+            time,
+            response["t"],
+            response["r"].get("num"),
+            response["r"].get("interval"),
+        ),
+    )
+    response_id = cursor.lastrowid
+    try:
+        samples = response["r"]["samples"]
+    except KeyError:
+        return []
+    infohashes = list(chunk_bytes(samples, 20, strict=True))
+    cursor.executemany(
+        "insert into sample_infohashes_response_infohash(response_id, infohash) values (?, ?)",
+        zip(repeat(response_id), infohashes),
+    )
+    return infohashes
+
+
+# Records a sample_infohashes response, and returns the number of samples and how
+# many of them weren't in sampled_infohashes, which they're added to.
+def record_sample_infohashes_response(
+    db_conn, response, sampled_infohashes: InfohashSet
+) -> Tuple[int, int]:
+    started = time.perf_counter()
+    try:
+        with db_conn:
+            infohashes = insert_sample_infohashes_response(
+                db_conn, response, sql.db_datetime()
+            )
+        return len(infohashes), count_new_infohashes(infohashes, sampled_infohashes)
+    except Exception:
+        logging.error("exception handling\n%s", pformat(response))
+        raise
+    finally:
+        sql.commit_seconds.observe(time.perf_counter() - started)
+        sql.commits.inc()
+
+
+# Returns how many of the infohashes weren't in sampled_infohashes, and adds them.
+# New ones are logged if log_new, which crawl workers leave to the writer, since
+# it's the writer that has every infohash.
+def count_new_infohashes(
+    infohashes, sampled_infohashes: InfohashSet, log_new: bool = True
+) -> int:
+    new = 0
+    for ih in infohashes:
+        if ih not in sampled_infohashes:
+            if log_new:
+                logging.info("got new infohash %s", ih.hex())
+            sampled_infohashes.add(ih)
+            new += 1
+    return new
+
+
+# Stores a sample_infohashes response, and returns the number of samples and how
+# many were new.
+RecordResponse = Callable[[bencode.Dict], Tuple[int, int]]
+
+
 class SampleInfohashes(Traversal):
-    def __init__(self, *args, **kwargs):
-        self.__sampled_infohashes: Set[bytes] = set()
-        self.__db_conn = args[0]
-        super().__init__(*args[1:], **kwargs)
+    samples_infohashes = True
+
+    def __init__(
+        self,
+        record_response: RecordResponse,
+        *args,
+        revisit: Optional[RevisitScheduler] = None,
+        coverage: Optional[CoveragePlanner] = None,
+        **kwargs,
+    ):
+        self.record_response = record_response
+        self.revisit = revisit
+        self.coverage = coverage
+        super().__init__(*args, **kwargs)
 
     def query(self):
         return "sample_infohashes", {"target": self.target}
 
-    def on_response(self, response):
+    def on_response(self, response, addr):
         if "r" not in response:
             return
-        try:
-            with self.__db_conn:
-                cursor = self.__db_conn.cursor()
-                cursor.execute(
-                    "insert into sample_infohashes_response(time, query_t, num, interval) values (datetime('now'), ?, ?, ?)",
+        samples, new = self.record_response(response)
+        _sample_responses.inc()
+        _samples.inc(samples)
+        _new_infohashes.inc(new)
+        if self.revisit is not None:
+            self.revisit.observe(addr, response, samples, new)
+        if self.coverage is not None:
+            node_id = response["r"].get("id")
+            if isinstance(node_id, bytes):
+                self.coverage.record(node_id)
+
+
+@dataclass
+class RoutingEntry:
+    node_info: NodeInfo
+    last_seen: float
+    failures: int = 0
+
+
+# A Kademlia routing table of nodes that have responded to us. Buckets are
+# indexed by the bit length of a node's distance from root, and hold up to k
+# nodes, least recently seen first. A full bucket only takes a new node in place
+# of one that's stale or has been failing.
+class RoutingTable:
+    stale_after = 15 * 60
+    max_failures = 2
+
+    def __init__(self, root: bytes, k: int = 8):
+        self.root = int.from_bytes(root, "big")
+        self.k = k
+        self.buckets: List["OrderedDict[Addr, RoutingEntry]"] = [
+            OrderedDict() for _ in range(len(root) * 8 + 1)
+        ]
+        self._bucket_index_by_addr: Dict[Addr, int] = {}
+
+    def _remove(self, addr: Addr):
+        del self.buckets[self._bucket_index_by_addr.pop(addr)][addr]
+
+    def add(self, node_info: NodeInfo, last_seen: Optional[float] = None) -> bool:
+        if node_info.id is None:
+            return False
+        if last_seen is None:
+            last_seen = time.time()
+        addr = node_info.addr
+        index = (self.root ^ int.from_bytes(node_info.id.bytes, "big")).bit_length()
+        if index == 0 or index >= len(self.buckets):
+            return False
+        if self._bucket_index_by_addr.get(addr, index) != index:
+            # The node at this address has a new ID.
+            self._remove(addr)
+        bucket = self.buckets[index]
+        entry = bucket.get(addr)
+        if entry is not None:
+            entry.node_info = node_info
+            entry.last_seen = max(entry.last_seen, last_seen)
+            entry.failures = 0
+            bucket.move_to_end(addr)
+            return True
+        if len(bucket) >= self.k:
+            oldest_addr, oldest = next(iter(bucket.items()))
+            if (
+                oldest.failures == 0
+                and last_seen - oldest.last_seen < self.stale_after
+            ):
+                return False
+            self._remove(oldest_addr)
+        bucket[addr] = RoutingEntry(node_info, last_seen)
+        self._bucket_index_by_addr[addr] = index
+        return True
+
+    def on_timeout(self, addr: Addr):
+        index = self._bucket_index_by_addr.get(addr)
+        if index is None:
+            return
+        entry = self.buckets[index][addr]
+        entry.failures += 1
+        if entry.failures > self.max_failures:
+            self._remove(addr)
+
+    def entries(self) -> Iterator[RoutingEntry]:
+        for bucket in self.buckets:
+            yield from bucket.values()
+
+    def closest(self, target: bytes, count: int) -> List[NodeInfo]:
+        target_int = int.from_bytes(target, "big")
+        return [
+            entry.node_info
+            for entry in heapq.nsmallest(
+                count,
+                (entry for entry in self.entries() if not entry.failures),
+                key=lambda entry: target_int
+                ^ int.from_bytes(entry.node_info.id.bytes, "big"),
+            )
+        ]
+
+    def __len__(self):
+        return len(self._bucket_index_by_addr)
+
+    @staticmethod
+    def _create_table(db_conn):
+        db_conn.execute(
+            "create table if not exists routing_table(id blob, addr text, last_seen real, failures integer)"
+        )
+        db_conn.execute("create table if not exists routing_table_root(id blob)")
+
+    def save(self, db_conn):
+        with db_conn:
+            self._create_table(db_conn)
+            db_conn.execute("delete from routing_table_root")
+            db_conn.execute(
+                "insert into routing_table_root(id) values (?)",
+                (self.root.to_bytes((len(self.buckets) - 1) // 8, "big"),),
+            )
+            db_conn.execute("delete from routing_table")
+            db_conn.executemany(
+                "insert into routing_table(id, addr, last_seen, failures) values (?, ?, ?, ?)",
+                (
                     (
-                        response["t"],
-                        response["r"].get("num"),
-                        response["r"].get("interval"),
-                    ),
-                )
-                response_id = cursor.lastrowid
-                try:
-                    samples = response["r"]["samples"]
-                except KeyError:
-                    pass
-                else:
-                    infohashes = list(chunk_bytes(samples, 20, strict=True))
-                    cursor.executemany(
-                        "insert into sample_infohashes_response_infohash(response_id, infohash) values (?, ?)",
-                        zip(repeat(response_id), infohashes),
+                        entry.node_info.id.bytes,
+                        sql.addr_for_db(entry.node_info.addr),
+                        entry.last_seen,
+                        entry.failures,
                     )
-                    for ih in infohashes:
-                        if ih not in self.__sampled_infohashes:
-                            logging.info("got new infohash %s", ih.hex())
-                            self.__sampled_infohashes.add(ih)
-        except Exception:
-            logging.error("exception handling\n%s", pformat(response))
-            raise
-
+                    for entry in self.entries()
+                ),
+            )
 
-class RoutingTable:
-    def __init__(self, root):
-        self.buckets = []
+    @classmethod
+    def load(cls, db_conn, root: bytes, k: int = 8) -> "RoutingTable":
+        self = cls(root, k)
+        with db_conn:
+            self._create_table(db_conn)
+        for id, addr, last_seen, failures in db_conn.execute(
+            "select id, addr, last_seen, failures from routing_table order by last_seen"
+        ):
+            node_info = NodeInfo(PeerId(id), string_to_address_tuple(addr))
+            if self.add(node_info, last_seen):
+                self.buckets[self._bucket_index_by_addr[node_info.addr]][
+                    node_info.addr
+                ].failures = failures
+        return self
+
+    # The root the table was last saved with, so the buckets mean the same thing
+    # when it's loaded again, or a new random one.
+    @classmethod
+    def saved_root(cls, db_conn) -> bytes:
+        with db_conn:
+            cls._create_table(db_conn)
+        row = db_conn.execute("select id from routing_table_root").fetchone()
+        if row is None:
+            return secrets.token_bytes(20)
+        return bytes(row[0])
 
 
 async def ping_bootstrap_nodes(sender, db_conn):
     for addr in global_bootstrap_nodes:
-        bytes = "".join(
-            bencode.encode(
-                {"t": "aa", "y": "q", "q": "ping", "a": {"id": "abcdefghij0123456789"},}
-            )
-        ).encode()
-        sender.sendto(bytes, addr)
+        bytes = bencode.encode_to_bytes(
+            {"t": "aa", "y": "q", "q": "ping", "a": {"id": "abcdefghij0123456789"},}
+        )
+        await sender.sendto(bytes, addr)
 
 
 def string_to_address_tuple(s):
-    host, port = s.rsplit(":")
+    host, port = s.rsplit(":", 1)
     return host, int(port)
 
 
+# State shared by all the traversals in a sample_infohashes run.
+@dataclass
+class SamplingContext:
+    local_id: bytes
+    dispatcher: Dispatcher
+    scheduler: QueryScheduler
+    routing_table: RoutingTable
+    node_health: NodeHealthCache
+    coverage: CoveragePlanner
+    infohashes: InfohashSet
+    record_response: RecordResponse
+    revisit: Optional[RevisitScheduler] = None
+
+
 async def sample_infohashes(args, db_conn, socket):
-    local_id = secrets.token_bytes(20)
-    while True:
-        target = secrets.token_bytes(20)
-        logger.info("sampling toward %s", target.hex())
+    local_id = RoutingTable.saved_root(db_conn)
+    infohashes = InfohashSet.load(db_conn)
+    context = SamplingContext(
+        local_id=local_id,
+        dispatcher=Dispatcher(socket),
+        scheduler=QueryScheduler(max_window=args.max_window),
+        routing_table=RoutingTable.load(db_conn, local_id),
+        node_health=NodeHealthCache.load(db_conn),
+        coverage=CoveragePlanner.load(db_conn, args.coverage_prefix_bits),
+        infohashes=infohashes,
+        record_response=functools.partial(
+            record_sample_infohashes_response,
+            db_conn,
+            sampled_infohashes=infohashes,
+        ),
+        revisit=RevisitScheduler() if args.revisit else None,
+    )
+    logger.info("loaded %d nodes into routing table", len(context.routing_table))
+    logger.info("loaded health of %d nodes", len(context.node_health.entries))
+    logger.info("loaded %d known infohashes", len(context.infohashes))
+    stats_sources = [
+        context.scheduler,
+        context.node_health,
+        context.coverage,
+        context.infohashes,
+    ]
+    stores = [context.routing_table, context.node_health, context.coverage]
+    try:
         async with trio.open_nursery() as nursery:
-            traversal = SampleInfohashes(db_conn, socket, target, nursery, local_id)
-            nursery.start_soon(receive_for_traversal, socket, traversal)
-            traversal.add_candidates(
-                *map(
-                    lambda x: string_to_address_tuple(x[0]),
-                    db_conn.execute(
-                        "select remote_addr from operation where type='recv'"
-                    ),
+            nursery.start_soon(context.dispatcher.run)
+            if context.revisit is not None:
+                stats_sources.append(context.revisit)
+                nursery.start_soon(
+                    context.revisit.run,
+                    context.dispatcher,
+                    local_id,
+                    context.record_response,
                 )
-            )
-            await traversal.wait_exhausted()
+            nursery.start_soon(log_stats, stats_sources)
+            nursery.start_soon(save_state, stores, db_conn)
+            async with trio.open_nursery() as samplers:
+                for _ in range(args.parallel):
+                    samplers.start_soon(sample_infohashes_forever, socket, context)
             nursery.cancel_scope.cancel()
+    finally:
+        for store in stores:
+            store.save(db_conn)
 
 
-async def receive_for_traversal(socket, traversal):
+async def save_state(stores, db_conn, interval=60):
     while True:
-        bytes, addr = await socket.recvfrom(0x1000)
-        traversal.on_reply(bytes, addr)
+        await trio.sleep(interval)
+        for store in stores:
+            store.save(db_conn)
 
 
-async def bootstrap(args, db_conn, socket):
+async def log_stats(sources, interval=60):
+    while True:
+        await trio.sleep(interval)
+        for source in sources:
+            source.log_stats()
 
+
+async def sample_infohashes_forever(socket, context: SamplingContext):
+    while True:
+        target = context.coverage.pick_target()
+        logger.info("sampling toward %s", target.hex())
+        traversal = SampleInfohashes(
+            context.record_response,
+            socket,
+            target,
+            context.local_id,
+            dispatcher=context.dispatcher,
+            scheduler=context.scheduler,
+            routing_table=context.routing_table,
+            node_health=context.node_health,
+            revisit=context.revisit,
+            coverage=context.coverage,
+        )
+        seeds = context.routing_table.closest(target, 4 * context.routing_table.k)
+        try:
+            if seeds:
+                traversal.add_nodes(*seeds)
+            else:
+                traversal.add_candidates(*global_bootstrap_nodes)
+            await traversal.wait_exhausted()
+        finally:
+            traversal.close()
+
+
+# Buffers compact result records in a crawl worker, and sends them to the writer
+# in batches.
+class CrawlSink:
+    def __init__(self, results, batch_size: int = 256):
+        self.results = results
+        self.batch_size = batch_size
+        self.records: List[tuple] = []
+
+    def put(self, record: tuple):
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            self.results.put(self.records)
+            self.records = []
+
+    async def run(self, interval=0.5):
+        try:
+            while True:
+                await trio.sleep(interval)
+                self.flush()
+        finally:
+            self.flush()
+
+
+@dataclass
+class CrawlRecordedSocket(sql.RecordedSocket):
+    sink: CrawlSink
+
+    async def record(self, type: str, addr: Addr, bytes: bytes, error: Optional[str]):
+        self.sink.put(
+            ("operation", sql.operation_row(type, sql.addr_for_db(addr), bytes, error))
+        )
+
+
+# Reports node sightings to the writer, which keeps the routing table that's saved.
+class CrawlRoutingTable(RoutingTable):
+    sink: Optional[CrawlSink] = None
+
+    def add(self, node_info: NodeInfo, last_seen: Optional[float] = None) -> bool:
+        if last_seen is None:
+            last_seen = time.time()
+        if self.sink is not None and node_info.id is not None:
+            self.sink.put(("node", node_info.id.bytes, node_info.addr, last_seen))
+        return super().add(node_info, last_seen)
+
+
+# Sends a sample_infohashes response to the writer, and returns the number of
+# samples and how many of them weren't in sampled_infohashes, which they're added
+# to.
+def send_sample_infohashes_response(
+    sink: CrawlSink, response, sampled_infohashes: InfohashSet
+) -> Tuple[int, int]:
+    r = response["r"]
+    samples = r.get("samples")
+    node_id = r.get("id")
+    sink.put(
+        (
+            "sample",
+            time.time(),
+            response["t"],
+            r.get("num"),
+            r.get("interval"),
+            samples,
+            node_id if isinstance(node_id, bytes) else None,
+        )
+    )
+    if samples is None:
+        return 0, 0
+    infohashes = list(chunk_bytes(samples, 20, strict=True))
+    return len(infohashes), count_new_infohashes(
+        infohashes, sampled_infohashes, log_new=False
+    )
+
+
+# Everything a crawl worker needs, loaded by the parent so workers never touch the
+# database.
+@dataclass
+class CrawlShard:
+    index: int
+    port: int
+    local_id: bytes
+    routing_table: CrawlRoutingTable
+    node_health: NodeHealthCache
+    coverage: CoveragePlanner
+    infohashes: InfohashSet
+    parallel: int
+    max_window: int
+    revisit: bool
+    pacer: Optional[Pacer] = None
+    metrics_port: Optional[int] = None
+    profile: bool = False
+    profile_stacks: Optional[str] = None
+
+
+def run_crawl_worker(shard: CrawlShard, results):
+    configure_logging()
+    try:
+        if shard.profile:
+            stacks_path = shard.profile_stacks
+            if stacks_path is not None:
+                stacks_path += f".{shard.index}"
+            trio.run(run_profiled, stacks_path, crawl_worker, shard, results)
+        else:
+            trio.run(crawl_worker, shard, results)
+    except KeyboardInterrupt:
+        pass
+
+
+async def crawl_worker(shard: CrawlShard, results):
+    sink = CrawlSink(results)
+    shard.routing_table.sink = sink
+    udp_socket = trio.socket.socket(type=trio.socket.SOCK_DGRAM)
+    await udp_socket.bind(("", shard.port))
+    socket = CrawlRecordedSocket(udp_socket, None, sink)
+    if shard.pacer is not None:
+        socket = PacedSocket(socket, shard.pacer)
+    context = SamplingContext(
+        local_id=shard.local_id,
+        dispatcher=Dispatcher(socket),
+        scheduler=QueryScheduler(max_window=shard.max_window),
+        routing_table=shard.routing_table,
+        node_health=shard.node_health,
+        coverage=shard.coverage,
+        infohashes=shard.infohashes,
+        record_response=functools.partial(
+            send_sample_infohashes_response,
+            sink,
+            sampled_infohashes=shard.infohashes,
+        ),
+        revisit=RevisitScheduler() if shard.revisit else None,
+    )
+    logger.info(
+        "crawl worker %d on port %d sampling regions %s",
+        shard.index,
+        shard.port,
+        shard.coverage.regions,
+    )
+    stats_sources = [context.scheduler, context.node_health, context.coverage]
+    if shard.pacer is not None:
+        stats_sources.append(shard.pacer)
     async with trio.open_nursery() as nursery:
-        target_id = secrets.token_bytes(20)
-        logging.info("bootstrap target id: %s", target_id.hex())
-        bootstrap = Bootstrap(socket, target_id, nursery, secrets.token_bytes(20))
-        nursery.start_soon(receive_for_traversal, socket, bootstrap)
+        nursery.start_soon(sink.run)
+        if shard.metrics_port is not None:
+            nursery.start_soon(metrics.serve, shard.metrics_port)
+        nursery.start_soon(context.dispatcher.run)
+        if context.revisit is not None:
+            stats_sources.append(context.revisit)
+            nursery.start_soon(
+                context.revisit.run,
+                context.dispatcher,
+                context.local_id,
+                context.record_response,
+            )
+        nursery.start_soon(log_stats, stats_sources)
+        for _ in range(shard.parallel):
+            nursery.start_soon(sample_infohashes_forever, socket, context)
+
+
+# Owns the database for a crawl: writes the records from all the workers, and
+# keeps the routing table and coverage that are saved.
+class CrawlWriter:
+    def __init__(
+        self,
+        results,
+        routing_table: RoutingTable,
+        coverage: CoveragePlanner,
+        infohashes: InfohashSet,
+        save_interval: float = 60,
+    ):
+        self.results = results
+        self.routing_table = routing_table
+        self.coverage = coverage
+        self.infohashes = infohashes
+        self.save_interval = save_interval
+        self.records = 0
+
+    # Writes a batch of records in a single transaction.
+    def write(self, db_conn, records: List[tuple]):
+        started = time.perf_counter()
+        with db_conn:
+            operations = [record[1] for record in records if record[0] == "operation"]
+            if operations:
+                sql.insert_operation_rows(db_conn, operations)
+            for record in records:
+                kind = record[0]
+                if kind == "sample":
+                    _, received, t, num, interval, samples, node_id = record
+                    r = {"num": num, "interval": interval}
+                    if samples is not None:
+                        r["samples"] = samples
+                    infohashes = insert_sample_infohashes_response(
+                        db_conn, {"t": t, "r": r}, sql.db_datetime(received)
+                    )
+                    count_new_infohashes(infohashes, self.infohashes)
+                    if node_id is not None:
+                        self.coverage.record(node_id, received)
+                elif kind == "node":
+                    _, id, addr, last_seen = record
+                    self.routing_table.add(NodeInfo(PeerId(id), addr), last_seen)
+        sql.commit_seconds.observe(time.perf_counter() - started)
+        sql.commits.inc()
+        self.records += len(records)
+
+    def save(self, db_conn):
+        self.routing_table.save(db_conn)
+        self.coverage.save(db_conn)
+        logger.info(
+            "crawl writer has written %d records, %d nodes in routing table",
+            self.records,
+            len(self.routing_table),
+        )
+
+    # Writes until all the workers have exited and their records are drained.
+    def run(self, db_conn, workers):
+        saved = time.monotonic()
+        try:
+            while True:
+                try:
+                    records = self.results.get(timeout=1)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        return
+                else:
+                    self.write(db_conn, records)
+                if time.monotonic() - saved >= self.save_interval:
+                    self.save(db_conn)
+                    saved = time.monotonic()
+        finally:
+            self.save(db_conn)
+
+
+async def crawl(args, db_conn, socket):
+    workers = args.workers or os.cpu_count()
+    coverage = CoveragePlanner.load(db_conn, args.coverage_prefix_bits)
+    infohashes = InfohashSet.load(db_conn)
+    node_health = NodeHealthCache.load(db_conn)
+    mp = multiprocessing.get_context("spawn")
+    results = mp.Queue()
+    processes = []
+    for index in range(workers):
+        shard_coverage = copy.deepcopy(coverage)
+        shard_coverage.restrict(index, workers)
+        local_id = shard_coverage.random_id(random.choice(shard_coverage.regions))
+        # Nodes mostly hold infohashes near their own IDs, so those are the ones a
+        # worker needs to tell which samples are new. The writer has them all.
+        shift = 64 - shard_coverage.prefix_bits
+        regions = shard_coverage.regions
+        shard = CrawlShard(
+            index=index,
+            port=args.base_port + index,
+            local_id=local_id,
+            routing_table=CrawlRoutingTable.load(db_conn, local_id),
+            node_health=node_health,
+            coverage=shard_coverage,
+            infohashes=infohashes.between(regions.start << shift, regions.stop << shift),
+            parallel=args.parallel,
+            max_window=args.max_window,
+            revisit=args.revisit,
+            pacer=make_pacer(args),
+            metrics_port=None
+            if args.metrics_port is None
+            else args.metrics_port + 1 + index,
+            profile=args.profile,
+            profile_stacks=args.profile_stacks,
+        )
+        process = mp.Process(target=run_crawl_worker, args=(shard, results), daemon=True)
+        process.start()
+        processes.append(process)
+    logger.info("started %d crawl workers", workers)
+    writer = CrawlWriter(
+        results,
+        RoutingTable.load(db_conn, RoutingTable.saved_root(db_conn)),
+        coverage,
+        infohashes,
+    )
+
+    # The writer has its own connection, as it runs in a thread.
+    def write():
+        writer_conn = sql.connect()
+        try:
+            writer.run(writer_conn, processes)
+        finally:
+            writer_conn.close()
+
+    await trio.to_thread.run_sync(write)
+
+
+async def bootstrap(args, db_conn, socket):
+    target_id = secrets.token_bytes(20)
+    logging.info("bootstrap target id: %s", target_id.hex())
+    bootstrap = Bootstrap(socket, target_id, secrets.token_bytes(20))
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(bootstrap.dispatcher.run)
         bootstrap.add_candidates(*global_bootstrap_nodes)
         await bootstrap.wait_exhausted()
         logging.debug("bootstrap exhausted")
@@ -401,13 +1307,406 @@ async def list_files(args, db_conn, socket):
     for infohash, bytes in db_conn.execute(
         "select infohash, bytes from info where bytes is not null"
     ):
-        info = bencode.parse_one_from_bytes(bytes)
+        info = bencode.parse_lazy(bytes)
         print(infohash)
         print('', info['name'].decode())
         for file in info.get('files', []):
             print('', '', *(p.decode() for p in file['path']))
 
-async def main():
+async def coverage_report(args, db_conn, socket):
+    planner = CoveragePlanner.load(db_conn, args.coverage_prefix_bits)
+    for when, covered, last_hour, last_day in db_conn.execute(
+        "select datetime(time, 'unixepoch'), covered, last_hour, last_day from keyspace_coverage_history where prefix_bits=? order by time",
+        (args.coverage_prefix_bits,),
+    ):
+        print(
+            f"{when} {covered:7.2%} ever {last_hour:7.2%} last hour {last_day:7.2%} last day"
+        )
+    now = time.time()
+    covered, (last_hour, last_day) = planner.coverage([now - 3600, now - 86400])
+    print(
+        f"now {covered:7.2%} ever {last_hour:7.2%} last hour {last_day:7.2%} last day, "
+        f"of {len(planner.samples)} regions with {sum(planner.samples)} samples"
+    )
+
+
+# Counts samples without storing them, so simulations measure the traversal
+# engine rather than SQLite.
+def count_samples(infohashes: InfohashSet, response) -> Tuple[int, int]:
+    samples = response["r"].get("samples")
+    if samples is None:
+        return 0, 0
+    new = 0
+    for ih in chunk_bytes(samples, 20):
+        if ih not in infohashes:
+            infohashes.add(ih)
+            new += 1
+    return len(samples) // 20, new
+
+
+async def simulate_traversals(network: "SimNetwork", args) -> Dict[str, Any]:
+    from simulation import SimSocket
+
+    rng = random.Random(args.seed)
+    socket = SimSocket(network)
+    local_id = rng.randbytes(20)
+    scheduler = QueryScheduler(max_window=args.max_window)
+    routing_table = RoutingTable(local_id)
+    node_health = NodeHealthCache()
+    infohashes = InfohashSet()
+    dispatcher = Dispatcher(socket)
+    convergence: List[float] = []
+    queries: List[int] = []
+    remaining = args.traversals
+
+    async def traverse():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            target = rng.randbytes(20)
+            kwargs = dict(
+                dispatcher=dispatcher,
+                scheduler=scheduler,
+                routing_table=routing_table,
+                node_health=node_health,
+            )
+            if args.query == "sample_infohashes":
+                traversal: Traversal = SampleInfohashes(
+                    functools.partial(count_samples, infohashes),
+                    socket,
+                    target,
+                    local_id,
+                    **kwargs,
+                )
+            else:
+                traversal = Bootstrap(socket, target, local_id, **kwargs)
+            started = trio.current_time()
+            seeds = routing_table.closest(target, 4 * routing_table.k)
+            try:
+                if seeds:
+                    traversal.add_nodes(*seeds)
+                else:
+                    traversal.add_candidates(*network.bootstrap_nodes())
+                await traversal.wait_exhausted()
+            finally:
+                traversal.close()
+            convergence.append(trio.current_time() - started)
+            queries.append(len(traversal.queried))
+
+    started = trio.current_time()
+    cpu_started = time.process_time()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(network.run)
+        nursery.start_soon(dispatcher.run)
+        async with trio.open_nursery() as traversals:
+            for _ in range(args.parallel):
+                traversals.start_soon(traverse)
+        nursery.cancel_scope.cancel()
+    elapsed = trio.current_time() - started
+    cpu_seconds = time.process_time() - cpu_started
+    p50, p90 = percentiles(convergence, [50, 90])
+    return {
+        "traversals": len(convergence),
+        "simulated_seconds": elapsed,
+        "convergence_p50_seconds": p50,
+        "convergence_p90_seconds": p90,
+        "queries_per_traversal": sum(queries) / len(queries),
+        "responses": scheduler.responses,
+        "timeouts": scheduler.timeouts,
+        "new_infohashes": len(infohashes),
+        "new_infohashes_per_second": len(infohashes) / elapsed if elapsed else None,
+        "cpu_seconds": cpu_seconds,
+        "queries_per_cpu_second": network.queries / cpu_seconds if cpu_seconds else None,
+    }
+
+
+# The simulator and trio.testing are only imported here, so the other commands
+# don't load them.
+def run_simulation(args) -> Dict[str, Any]:
+    from simulation import SimNetwork
+    import trio.testing
+
+    network = SimNetwork(
+        nodes=args.nodes,
+        seed=args.seed,
+        latency=args.latency,
+        loss=args.loss,
+        churn=args.churn,
+        infohashes=args.infohashes,
+        infohashes_per_node=args.infohashes_per_node,
+    )
+    # Simulated time jumps ahead whenever every task is waiting, so results don't
+    # depend on how fast the machine is, apart from the CPU time.
+    clock = trio.testing.MockClock(autojump_threshold=0)
+    with quiet_logging():
+        return trio.run(simulate_traversals, network, args, clock=clock)
+
+
+# Benchmarks traversals against a simulated DHT, for comparing changes to the
+# traversal engine without the noise of the real network.
+async def simulate(args, db_conn, socket):
+    results = await trio.to_thread.run_sync(run_simulation, args)
+    print(json.dumps(results, indent=2))
+
+
+# Never delivers anything, and nothing is sent through it during a replay.
+class StubSocket:
+    async def sendto(self, bytes, addr):
+        pass
+
+    async def recvfrom(self, amount):
+        await trio.sleep_forever()
+
+
+# Traversals fed by a replay don't send queries of their own, since the log has
+# no replies to them. The recorded queries stand in for them instead.
+class ReplayBootstrap(Bootstrap):
+    def window(self) -> int:
+        return 0
+
+
+class ReplaySampleInfohashes(SampleInfohashes):
+    def window(self) -> int:
+        return 0
+
+
+_replay_query_paths = [("t",), ("y",), ("q",), ("a", "target")]
+
+_replay_tables = [
+    "create table if not exists operation(remote_addr, type, error, payload, datetime, "
+    "t blob, y text, q text, node_id blob, error_code integer)",
+    "create table if not exists sample_infohashes_response(time, query_t, num, interval)",
+    "create table if not exists sample_infohashes_response_infohash(response_id, infohash)",
+]
+
+
+# Feeds recorded operations through the receive path and the ingest pipeline, as
+# if they were happening now. Recorded queries are tracked by a traversal for
+# their target, so the replies to them are dispatched, processed and stored as
+# they were live. Queries that go unanswered time out by the recorded clock.
+# Everything stored goes to db_conn, which shouldn't be the database replayed.
+class Replayer:
+    def __init__(self, db_conn, max_traversals: int = 64, batch_size: int = 500):
+        for create in _replay_tables:
+            db_conn.execute(create)
+        self.db_conn = db_conn
+        self.max_traversals = max_traversals
+        self.batch_size = batch_size
+        self.socket = StubSocket()
+        self.local_id = bytes(20)
+        self.dispatcher = Dispatcher(self.socket)
+        self.routing_table = RoutingTable(self.local_id)
+        self.node_health = NodeHealthCache()
+        self.coverage = CoveragePlanner()
+        self.infohashes = InfohashSet()
+        self.traversals: "OrderedDict[Tuple[bytes, bytes], Traversal]" = OrderedDict()
+        self.rows: List[tuple] = []
+        self.packets = 0
+        self.sent = 0
+        self.received = 0
+
+    def replay(
+        self, type: str, remote_addr: str, payload: bytes, error: Optional[str], now: float
+    ):
+        self.packets += 1
+        self.dispatcher.expire(now)
+        self.rows.append(sql.operation_row(type, remote_addr, payload, error))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        if error is not None:
+            return
+        addr = string_to_address_tuple(remote_addr)
+        if type == "recv":
+            self.received += 1
+            self.dispatcher.dispatch(payload, addr)
+        elif type == "send":
+            self.sent += 1
+            self.track_query(payload, addr, now)
+
+    def track_query(self, payload: bytes, addr: Addr, now: float):
+        try:
+            t, y, q, target = sql.bencode_get_paths(payload, _replay_query_paths)
+        except (ValueError, IndexError):
+            return
+        if y != b"q" or not isinstance(t, bytes):
+            return
+        if not isinstance(target, bytes) or len(target) != 20:
+            return
+        if q not in (b"find_node", b"sample_infohashes"):
+            return
+        traversal = self.traversal(q, target)
+        tid = TransactionId(t)
+        previous = self.dispatcher.transactions.get(tid)
+        if previous is not None:
+            previous.finish_query(tid)
+        pending = traversal.track_query(tid, addr, payload)
+        self.dispatcher.set_deadline(tid, now + pending.timeout)
+
+    def traversal(self, q: bytes, target: bytes) -> Traversal:
+        key = q, target
+        try:
+            self.traversals.move_to_end(key)
+            return self.traversals[key]
+        except KeyError:
+            pass
+        kwargs = dict(
+            dispatcher=self.dispatcher,
+            routing_table=self.routing_table,
+            node_health=self.node_health,
+        )
+        if q == b"sample_infohashes":
+            traversal: Traversal = ReplaySampleInfohashes(
+                functools.partial(
+                    record_sample_infohashes_response,
+                    self.db_conn,
+                    sampled_infohashes=self.infohashes,
+                ),
+                self.socket,
+                target,
+                self.local_id,
+                coverage=self.coverage,
+                **kwargs,
+            )
+        else:
+            traversal = ReplayBootstrap(self.socket, target, self.local_id, **kwargs)
+        self.traversals[key] = traversal
+        if len(self.traversals) > self.max_traversals:
+            self.traversals.popitem(last=False)[1].close()
+        return traversal
+
+    def flush(self):
+        if self.rows:
+            sql.record_operation_rows(self.db_conn, self.rows)
+            self.rows = []
+
+    def close(self):
+        for traversal in self.traversals.values():
+            traversal.close()
+        self.traversals.clear()
+        self.flush()
+
+
+def _recorded_time(datetime: Optional[str]) -> Optional[float]:
+    if datetime is None:
+        return None
+    return calendar.timegm(time.strptime(datetime, "%Y-%m-%d %H:%M:%S"))
+
+
+# Replays the operation table from db_conn through replayer, at speed times the
+# recorded rate, or as fast as possible if speed is 0. The log only has whole
+# seconds, so at recorded speed the operations of each second arrive together.
+async def replay_operations(
+    db_conn, replayer: Replayer, speed: float = 0, limit: Optional[int] = None
+) -> Dict[str, Any]:
+    counters = [_replies, _error_replies, _timeouts, _samples, _new_infohashes]
+    before = [counter.value for counter in counters]
+    started = trio.current_time()
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    first: Optional[float] = None
+    last_datetime = None
+    now = 0.0
+    cursor = db_conn.execute(
+        "select type, remote_addr, payload, error, datetime from operation order by rowid"
+        + ("" if limit is None else f" limit {int(limit)}")
+    )
+    for type, remote_addr, payload, error, datetime in cursor:
+        if datetime != last_datetime:
+            last_datetime = datetime
+            recorded = _recorded_time(datetime)
+            if recorded is not None:
+                now = recorded
+                if first is None:
+                    first = now
+                if speed:
+                    await trio.sleep_until(started + (now - first) / speed)
+        if not isinstance(payload, bytes):
+            payload = bytes(payload or b"")
+        replayer.replay(type, remote_addr, payload, error, now)
+    replayer.close()
+    seconds = time.perf_counter() - wall_started
+    cpu_seconds = time.process_time() - cpu_started
+    replies, error_replies, timeouts, samples, new_infohashes = (
+        counter.value - value for counter, value in zip(counters, before)
+    )
+    return {
+        "packets": replayer.packets,
+        "sent": replayer.sent,
+        "received": replayer.received,
+        "replies": replies,
+        "error_replies": error_replies,
+        "timeouts": timeouts,
+        "samples": samples,
+        "new_infohashes": new_infohashes,
+        "routing_table_nodes": len(replayer.routing_table),
+        "recorded_seconds": None if first is None else now - first,
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "packets_per_second": replayer.packets / seconds if seconds else None,
+    }
+
+
+# Streams the recorded operation log back through the receive path without the
+# network, for benchmarking and checking parser and storage changes against
+# real traffic.
+async def replay(args, db_conn, socket):
+    replayer = Replayer(
+        sql.connect(args.output), max_traversals=args.max_traversals
+    )
+    with quiet_logging():
+        results = await replay_operations(db_conn, replayer, args.speed, args.limit)
+    print(json.dumps(results, indent=2))
+
+
+async def backfill_operation(args, db_conn, socket):
+    total = sql.backfill_operation_columns(db_conn)
+    print(f"backfilled {total} operations", file=sys.stderr)
+
+
+# Functions timed in --profile mode.
+PROFILED_PATHS = [
+    (Dispatcher, "dispatch"),
+    (Traversal, "on_message"),
+    (Traversal, "process_reply_nodes"),
+    (sql, "record_operation_rows"),
+    (bencode, "encode_to_bytes"),
+    (bencode.Encoder, "encode"),
+]
+
+
+async def run_profiled(stacks_path: Optional[str], func, *args):
+    profiler = Profiler(PROFILED_PATHS, stacks_path)
+    profiler.start()
+    try:
+        await func(*args)
+    finally:
+        profiler.stop()
+        logger.info("%s", profiler.summary())
+
+
+# Argument type for the send rate limits, which are divided by.
+def positive_float(value: str) -> float:
+    rate = float(value)
+    if not rate > 0:
+        raise argparse.ArgumentTypeError(f"must be positive: {value}")
+    return rate
+
+
+def make_pacer(args) -> Optional[Pacer]:
+    if (
+        args.max_send_rate is None
+        and args.max_send_bytes_rate is None
+        and args.max_subnet_send_rate is None
+    ):
+        return None
+    return Pacer(
+        packets_per_second=args.max_send_rate,
+        bytes_per_second=args.max_send_bytes_rate,
+        subnet_packets_per_second=args.max_subnet_send_rate,
+    )
+
+
+def configure_logging():
     logging.Formatter.default_msec_format = "%s.%03d"
     logging.basicConfig(
         level=getattr(logging, os.environ.get("LOGLEVEL", "INFO").upper()),
@@ -415,8 +1714,59 @@ async def main():
         format="{module}:{lineno} {message}",
     )
 
+
+async def main():
+    configure_logging()
+
     parser = argparse.ArgumentParser()
     # parser.add_argument("--clobber-db", action="store_true")
+    parser.add_argument(
+        "--batch-recording",
+        action="store_true",
+        help="record operations from a writer thread in batched transactions",
+    )
+    parser.add_argument("--record-queue-size", type=int, default=10000)
+    parser.add_argument(
+        "--drop-records-when-full",
+        action="store_true",
+        help="drop operations instead of waiting when the record queue is full",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="count trio task activity and time hot paths, and log a summary at exit",
+    )
+    parser.add_argument(
+        "--profile-stacks",
+        metavar="PATH",
+        help="with --profile, also sample stacks to PATH in collapsed format for flamegraphs",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on this local port; crawl workers use the following ports",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=60,
+        help="seconds between writing metrics to the stats table, 0 to not",
+    )
+    parser.add_argument(
+        "--max-send-rate",
+        type=positive_float,
+        help="most packets sent per second, per process",
+    )
+    parser.add_argument(
+        "--max-send-bytes-rate",
+        type=positive_float,
+        help="most bytes sent per second, per process",
+    )
+    parser.add_argument(
+        "--max-subnet-send-rate",
+        type=positive_float,
+        help="most packets sent per second to each /24",
+    )
     subparsers = parser.add_subparsers(required=True, dest="cmd")
 
     def add_command(command, func=None):
@@ -424,24 +1774,145 @@ async def main():
         cmd_parser.set_defaults(func=func or globals()[command])
         return cmd_parser
 
-    add_command("sample_infohashes")
+    sample_infohashes_parser = add_command("sample_infohashes")
+    sample_infohashes_parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="number of traversals to run concurrently on the socket",
+    )
+    sample_infohashes_parser.add_argument(
+        "--max-window",
+        type=int,
+        default=64,
+        help="most queries each traversal may have in flight",
+    )
+    sample_infohashes_parser.add_argument(
+        "--revisit",
+        action="store_true",
+        help="also resample productive nodes as their intervals allow",
+    )
+    sample_infohashes_parser.add_argument(
+        "--coverage-prefix-bits",
+        type=int,
+        default=12,
+        help="ID prefix length the keyspace is divided into for coverage",
+    )
+    crawl_parser = add_command("crawl")
+    crawl_parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of worker processes, one per CPU by default",
+    )
+    crawl_parser.add_argument(
+        "--base-port",
+        type=int,
+        default=42070,
+        help="UDP port of the first worker, the others follow it",
+    )
+    crawl_parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="number of traversals each worker runs concurrently",
+    )
+    crawl_parser.add_argument("--max-window", type=int, default=64)
+    crawl_parser.add_argument("--revisit", action="store_true")
+    crawl_parser.add_argument("--coverage-prefix-bits", type=int, default=12)
+    coverage_report_parser = add_command("coverage_report")
+    coverage_report_parser.add_argument("--coverage-prefix-bits", type=int, default=12)
     add_command("bootstrap")
     add_command("check_infos")
     add_command("list_files")
+    add_command("backfill_operation")
+    simulate_parser = add_command("simulate")
+    simulate_parser.add_argument("--nodes", type=int, default=5000)
+    simulate_parser.add_argument("--seed", type=int, default=0)
+    simulate_parser.add_argument(
+        "--latency", type=float, default=0.05, help="mean one way latency in seconds"
+    )
+    simulate_parser.add_argument(
+        "--loss", type=float, default=0.01, help="chance each packet is lost"
+    )
+    simulate_parser.add_argument(
+        "--churn",
+        type=float,
+        default=0.0,
+        help="fraction of nodes that leave or return each second",
+    )
+    simulate_parser.add_argument("--infohashes", type=int, default=100_000)
+    simulate_parser.add_argument("--infohashes-per-node", type=int, default=50)
+    simulate_parser.add_argument(
+        "--query", choices=["find_node", "sample_infohashes"], default="sample_infohashes"
+    )
+    simulate_parser.add_argument("--traversals", type=int, default=20)
+    simulate_parser.add_argument("--parallel", type=int, default=1)
+    simulate_parser.add_argument("--max-window", type=int, default=64)
+    replay_parser = add_command("replay")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="multiple of the recorded rate to replay at, 0 for as fast as possible",
+    )
+    replay_parser.add_argument("--limit", type=int, help="most operations to replay")
+    replay_parser.add_argument(
+        "--output",
+        default=":memory:",
+        help="database to store what's replayed in, instead of the one replayed",
+    )
+    replay_parser.add_argument(
+        "--max-traversals",
+        type=int,
+        default=64,
+        help="most targets to track replayed queries for at once",
+    )
     single_query_parser = add_command("single_query")
     single_query_parser.add_argument("--addrs", default=global_bootstrap_nodes)
     single_query_parser.add_argument("query")
     single_query_parser.add_argument("--id", default=secrets.token_bytes(20))
     single_query_parser.add_argument("--target", action=TargetAction)
     args = parser.parse_args()
+    if args.profile:
+        await run_profiled(args.profile_stacks, run_command, args)
+    else:
+        await run_command(args)
+
 
+async def run_command(args):
     db_conn = sql.connect()
+    sql.upgrade_operation_table(db_conn)
+    bencode_fields.upgrade_messages_table(db_conn)
     # if args.clobber_db:
     #     drop_tables(tables)
     # create_tables(tables, safe=not args.clobber_db)
     socket = trio.socket.socket(type=trio.socket.SOCK_DGRAM)
     await socket.bind(("", 42069))
-    await args.func(args, db_conn, sql.RecordedSocket(socket, db_conn))
+    pacer = make_pacer(args)
+
+    async def run(socket):
+        async with trio.open_nursery() as nursery:
+            if pacer is not None:
+                nursery.start_soon(log_stats, [pacer])
+                socket = PacedSocket(socket, pacer)
+            if args.metrics_port is not None:
+                nursery.start_soon(metrics.serve, args.metrics_port)
+            if args.stats_interval:
+                nursery.start_soon(
+                    metrics.save_periodically, db_conn, args.stats_interval
+                )
+            await args.func(args, db_conn, socket)
+            nursery.cancel_scope.cancel()
+
+    if args.batch_recording:
+        async with sql.open_batch_recorder(
+            max_queue=args.record_queue_size,
+            drop_when_full=args.drop_records_when_full,
+        ) as recorder:
+            await run(sql.BatchRecordedSocket(socket, db_conn, recorder))
+    else:
+        await run(sql.RecordedSocket(socket, db_conn))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+from bisect import bisect_left
+from typing import *
+import logging
+import time
+import trio
+
+logger = logging.getLogger(__name__)
+
+
+# Metrics are plain attribute updates, so recording one costs about as much as
+# a method call, and they can stay enabled.
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self) -> Iterator[Tuple[str, float]]:
+        yield self.name, self.value
+
+
+# A gauge either is set, or calls func to get its value when read.
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, func: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self) -> Iterator[Tuple[str, float]]:
+        yield self.name, self.value if self.func is None else self.func()
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # The last count is for values above every bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> Iterator[Tuple[str, float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"{name} is already a {metric.type}")
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str, func=None) -> Gauge:
+        gauge = self._get(Gauge, name, help)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float]) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    # All the metrics in the Prometheus text exposition format.
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _create_table(db_conn):
+        db_conn.execute("create table if not exists stats(time real, name text, value real)")
+
+    def save(self, db_conn):
+        now = time.time()
+        with db_conn:
+            self._create_table(db_conn)
+            db_conn.executemany(
+                "insert into stats(time, name, value) values (?, ?, ?)",
+                (
+                    (now, name, value)
+                    for metric in self.metrics.values()
+                    for name, value in metric.samples()
+                ),
+            )
+
+
+# The registry everything records to.
+registry = Registry()
+
+# Buckets for durations that are mostly network round trips.
+RTT_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+# Buckets for durations of local work, like SQLite commits.
+LOCAL_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5]
+
+
+async def _handle_http(stream, registry: Registry):
+    # A client going away mustn't take the server down with it.
+    try:
+        async with stream:
+            await _respond(stream, registry)
+    except (trio.BrokenResourceError, trio.ClosedResourceError):
+        pass
+
+
+async def _respond(stream, registry: Registry):
+    request = b""
+    with trio.move_on_after(5):
+        while b"\r\n\r\n" not in request and len(request) < 0x2000:
+            data = await stream.receive_some(0x1000)
+            if not data:
+                break
+            request += data
+    request_line = request.split(b"\r\n", 1)[0].split()
+    if request_line[:2] in ([b"GET", b"/metrics"], [b"GET", b"/"]):
+        status = "200 OK"
+        body = registry.render().encode()
+    else:
+        status = "404 Not Found"
+        body = b"not found\n"
+    header = (
+        f"HTTP/1.0 {status}\r\n"
+        "Content-Type: text/plain; version=0.0.4\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    )
+    await stream.send_all(header.encode() + body)
+
+
+# Serves the registry at /metrics on a local HTTP port, for Prometheus to scrape.
+async def serve(
+    port: int,
+    registry: Registry = registry,
+    host="127.0.0.1",
+    task_status=trio.TASK_STATUS_IGNORED,
+):
+    logger.info("serving metrics on http://%s:%d/metrics", host, port)
+    await trio.serve_tcp(
+        lambda stream: _handle_http(stream, registry),
+        port,
+        host=host,
+        task_status=task_status,
+    )
+
+
+async def save_periodically(db_conn, interval: float, registry: Registry = registry):
+    while True:
+        await trio.sleep(interval)
+        registry.save(db_conn)
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from dataclasses import dataclass, astuple, fields
+from typing import *
+import logging
+import time
+from my_types import Addr
+import sql
+
+# BEP 5 error code for a query the node doesn't implement.
+METHOD_UNKNOWN = 204
+
+
+@dataclass
+class NodeHealth:
+    updated: float
+    last_response: Optional[float] = None
+    last_timeout: Optional[float] = None
+    consecutive_timeouts: int = 0
+    errors: int = 0
+    last_error_code: Optional[int] = None
+    supports_sample_infohashes: Optional[bool] = None
+
+
+class Verdict:
+    QUERY = "query"
+    # Query only after the nodes that aren't suspect.
+    DEFER = "defer"
+    SKIP = "skip"
+    # Query for routing only, as the node won't answer the query the traversal
+    # wants, but its nodes still lead toward the target.
+    ROUTE_ONLY = "route_only"
+
+
+# What we've learned about nodes, shared by all traversals in the process. Holds
+# at most max_entries nodes, evicting the least recently updated, and forgets
+# nodes that haven't been updated in ttl seconds.
+#
+# Nodes that have timed out skip_after_timeouts times in a row are skipped until
+# retry_after seconds have passed, and nodes with fewer recent timeouts are
+# deferred. Nodes known not to support sample_infohashes are only used for
+# routing by traversals that need it.
+class NodeHealthCache:
+    def __init__(
+        self,
+        max_entries: int = 100_000,
+        ttl: float = 6 * 60 * 60,
+        skip_after_timeouts: int = 2,
+        retry_after: float = 10 * 60,
+    ):
+        self.entries: "OrderedDict[Addr, NodeHealth]" = OrderedDict()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.skip_after_timeouts = skip_after_timeouts
+        self.retry_after = retry_after
+        self.lookups = 0
+        self.hits = 0
+        self.skips = 0
+        self.deferrals = 0
+        self.routed_only = 0
+
+    def get(self, addr: Addr, now: Optional[float] = None) -> Optional[NodeHealth]:
+        health = self.entries.get(addr)
+        if health is None:
+            return None
+        if (time.time() if now is None else now) - health.updated > self.ttl:
+            del self.entries[addr]
+            return None
+        return health
+
+    def _update(self, addr: Addr, now: float) -> NodeHealth:
+        health = self.get(addr, now)
+        if health is None:
+            health = self.entries[addr] = NodeHealth(now)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            health.updated = now
+            self.entries.move_to_end(addr)
+        return health
+
+    def check(self, addr: Addr, needs_sample_infohashes=False, now=None) -> str:
+        if now is None:
+            now = time.time()
+        self.lookups += 1
+        health = self.get(addr, now)
+        if health is None:
+            return Verdict.QUERY
+        self.hits += 1
+        verdict = Verdict.QUERY
+        if health.consecutive_timeouts and now - health.last_timeout < self.retry_after:
+            if health.consecutive_timeouts >= self.skip_after_timeouts:
+                verdict = Verdict.SKIP
+            else:
+                verdict = Verdict.DEFER
+        if (
+            needs_sample_infohashes
+            and health.supports_sample_infohashes is False
+            and now - health.updated < self.retry_after
+            and verdict == Verdict.QUERY
+        ):
+            verdict = Verdict.ROUTE_ONLY
+        if verdict == Verdict.SKIP:
+            self.skips += 1
+        elif verdict == Verdict.DEFER:
+            self.deferrals += 1
+        elif verdict == Verdict.ROUTE_ONLY:
+            self.routed_only += 1
+        return verdict
+
+    def on_reply(self, addr: Addr, reply, sampled=False, now=None):
+        health = self._update(addr, time.time() if now is None else now)
+        health.last_response = health.updated
+        health.consecutive_timeouts = 0
+        if b"e" in reply:
+            health.errors += 1
+            try:
+                code = reply[b"e"][0]
+            except (IndexError, KeyError, TypeError):
+                code = None
+            health.last_error_code = code
+            if sampled and code == METHOD_UNKNOWN:
+                health.supports_sample_infohashes = False
+        elif sampled and b"r" in reply:
+            r = reply[b"r"]
+            health.supports_sample_infohashes = isinstance(r, Mapping) and any(
+                key in r for key in (b"samples", b"num", b"interval")
+            )
+
+    def on_timeout(self, addr: Addr, now=None):
+        health = self._update(addr, time.time() if now is None else now)
+        health.last_timeout = health.updated
+        health.consecutive_timeouts += 1
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        if not self.lookups:
+            return None
+        return self.hits / self.lookups
+
+    def log_stats(self):
+        logging.info(
+            "node health: %d nodes, %d lookups, hit rate %s, %d skipped, %d deferred, "
+            "%d only routed through",
+            len(self.entries),
+            self.lookups,
+            "-" if self.hit_rate is None else f"{self.hit_rate:.2f}",
+            self.skips,
+            self.deferrals,
+            self.routed_only,
+        )
+
+    _columns = [field.name for field in fields(NodeHealth)]
+
+    @classmethod
+    def _create_table(cls, db_conn):
+        db_conn.execute(
+            f"create table if not exists node_health(addr text primary key, {', '.join(cls._columns)})"
+        )
+
+    def save(self, db_conn):
+        with db_conn:
+            self._create_table(db_conn)
+            db_conn.execute("delete from node_health")
+            db_conn.executemany(
+                f"insert into node_health(addr, {', '.join(self._columns)}) values ({', '.join('?' * (len(self._columns) + 1))})",
+                (
+                    (sql.addr_for_db(addr), *astuple(health))
+                    for addr, health in self.entries.items()
+                ),
+            )
+
+    @classmethod
+    def load(cls, db_conn, *args, **kwargs) -> "NodeHealthCache":
+        self = cls(*args, **kwargs)
+        with db_conn:
+            self._create_table(db_conn)
+        for addr, *values in db_conn.execute(
+            f"select addr, {', '.join(self._columns)} from node_health where updated > ? order by updated desc limit ?",
+            (time.time() - self.ttl, self.max_entries),
+        ):
+            host, port = addr.rsplit(":", 1)
+            self.entries[(host, int(port))] = NodeHealth(*values)
+        # Least recently updated first, for eviction.
+        self.entries = OrderedDict(reversed(self.entries.items()))
+        return self
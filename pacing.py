@@ -0,0 +1,133 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import *
+import logging
+import socket
+import trio
+from my_types import Addr
+
+
+# Tokens accrue at rate per second up to burst. Takers can go into debt, and wait
+# for it to be paid off, so concurrent senders queue up in the order they took.
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated: Optional[float] = None
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Takes amount tokens, and returns how long to wait before using them.
+    def take(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+# The subnet an address is in, for per-subnet limits. Hostnames are their own
+# subnet.
+def subnet(host: str, prefix_bits: int = 24) -> Union[int, str]:
+    try:
+        packed = socket.inet_aton(host)
+    except OSError:
+        return host
+    return int.from_bytes(packed, "big") >> (32 - prefix_bits)
+
+
+# Limits outgoing packets and bytes per second overall, and optionally packets
+# per second to each subnet. Any limit can be None.
+class Pacer:
+    def __init__(
+        self,
+        packets_per_second: Optional[float] = None,
+        bytes_per_second: Optional[float] = None,
+        subnet_packets_per_second: Optional[float] = None,
+        burst_seconds: float = 0.05,
+        subnet_prefix_bits: int = 24,
+        max_subnets: int = 100_000,
+    ):
+        self.packets = None
+        if packets_per_second is not None:
+            self.packets = TokenBucket(
+                packets_per_second, max(1, packets_per_second * burst_seconds)
+            )
+        self.bytes = None
+        if bytes_per_second is not None:
+            self.bytes = TokenBucket(
+                bytes_per_second, max(1500, bytes_per_second * burst_seconds)
+            )
+        self.subnet_packets_per_second = subnet_packets_per_second
+        self.subnet_prefix_bits = subnet_prefix_bits
+        self.max_subnets = max_subnets
+        self.subnets: "OrderedDict[Union[int, str], TokenBucket]" = OrderedDict()
+        self.sends = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    def _subnet_bucket(self, host: str, now: float) -> TokenBucket:
+        key = subnet(host, self.subnet_prefix_bits)
+        try:
+            self.subnets.move_to_end(key)
+            return self.subnets[key]
+        except KeyError:
+            rate = self.subnet_packets_per_second
+            bucket = self.subnets[key] = TokenBucket(rate, max(1, rate))
+            if len(self.subnets) > self.max_subnets:
+                # Forgetting a bucket that's full loses nothing.
+                oldest_key, oldest = next(iter(self.subnets.items()))
+                if oldest.full(now):
+                    del self.subnets[oldest_key]
+            return bucket
+
+    # Takes what a packet needs from every bucket, and returns how long to wait
+    # before sending it.
+    def delay(self, size: int, addr: Addr, now: float) -> float:
+        delay = 0.0
+        if self.packets is not None:
+            delay = max(delay, self.packets.take(1, now))
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.take(size, now))
+        if self.subnet_packets_per_second is not None:
+            delay = max(delay, self._subnet_bucket(addr[0], now).take(1, now))
+        self.sends += 1
+        if delay > 0:
+            self.throttled += 1
+            self.throttled_seconds += delay
+        return delay
+
+    async def pace(self, size: int, addr: Addr):
+        delay = self.delay(size, addr, trio.current_time())
+        if delay > 0:
+            await trio.sleep(delay)
+
+    def log_stats(self):
+        logging.info(
+            "pacer: %d sends, %d throttled for %.1fs in total, %d subnets tracked",
+            self.sends,
+            self.throttled,
+            self.throttled_seconds,
+            len(self.subnets),
+        )
+
+
+# Paces sends through the wrapped socket. Wrap the recorded socket, so sends are
+# recorded when they actually happen.
+@dataclass
+class PacedSocket:
+    socket: Any
+    pacer: Pacer
+
+    async def sendto(self, bytes, addr):
+        await self.pacer.pace(len(bytes), addr)
+        return await self.socket.sendto(bytes, addr)
+
+    async def recvfrom(self, amount):
+        return await self.socket.recvfrom(amount)
@@ -0,0 +1,190 @@
+from collections import defaultdict, deque
+import collections
+from dataclasses import dataclass
+from typing import *
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import trio
+from util import percentiles
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TaskStats:
+    spawns: int = 0
+    steps: int = 0
+    cpu_seconds: float = 0
+
+
+# Counts task spawns, and measures how long tasks wait to run once scheduled, and
+# the CPU time of their steps, per task name.
+class TaskInstrument(trio.abc.Instrument):
+    def __init__(self, latency_samples: int = 100_000):
+        self.tasks: DefaultDict[str, TaskStats] = defaultdict(TaskStats)
+        self.latencies: Deque[float] = deque(maxlen=latency_samples)
+        self._scheduled: Dict[trio.lowlevel.Task, float] = {}
+        # None until a step is seen starting, as the instrument can be added
+        # partway through one.
+        self._step_started: Optional[float] = None
+
+    def task_spawned(self, task):
+        self.tasks[task.name].spawns += 1
+
+    def task_scheduled(self, task):
+        self._scheduled[task] = time.perf_counter()
+
+    def before_task_step(self, task):
+        scheduled = self._scheduled.pop(task, None)
+        if scheduled is not None:
+            self.latencies.append(time.perf_counter() - scheduled)
+        self._step_started = time.thread_time()
+
+    def after_task_step(self, task):
+        if self._step_started is None:
+            return
+        stats = self.tasks[task.name]
+        stats.steps += 1
+        stats.cpu_seconds += time.thread_time() - self._step_started
+        self._step_started = None
+
+    def task_exited(self, task):
+        self._scheduled.pop(task, None)
+
+
+@dataclass
+class PathStats:
+    calls: int = 0
+    sampled: int = 0
+    sampled_seconds: float = 0
+
+    @property
+    def estimated_seconds(self) -> float:
+        if not self.sampled:
+            return 0
+        return self.sampled_seconds / self.sampled * self.calls
+
+
+# Times every-th call of functions, to estimate where time goes without timing
+# each call.
+class HotPaths:
+    def __init__(self, every: int = 16):
+        self.every = every
+        self.paths: Dict[str, PathStats] = {}
+        self._originals: List[Tuple[Any, str, Any]] = []
+
+    def wrap(self, owner, attr: str):
+        name = f"{getattr(owner, '__name__', owner)}.{attr}"
+        func = getattr(owner, attr)
+        stats = self.paths[name] = PathStats()
+        every = self.every
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            stats.calls += 1
+            if stats.calls % every:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.sampled += 1
+                stats.sampled_seconds += time.perf_counter() - started
+
+        self._originals.append((owner, attr, owner.__dict__[attr]))
+        setattr(owner, attr, timed)
+
+    def restore(self):
+        for owner, attr, original in reversed(self._originals):
+            setattr(owner, attr, original)
+        self._originals.clear()
+
+
+# Samples the stack of a thread from another thread, and counts the stacks in
+# the collapsed format flamegraph tools read.
+class StackSampler:
+    def __init__(self, thread_id: Optional[int] = None, interval: float = 0.002):
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.stacks: "collections.Counter[str]" = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if names:
+            self.stacks[";".join(reversed(names))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                print(stack, count, file=file)
+
+
+class Profiler:
+    def __init__(self, hot_paths: Iterable[Tuple[Any, str]], stacks_path: Optional[str] = None):
+        self.instrument = TaskInstrument()
+        self.hot_paths = HotPaths()
+        for owner, attr in hot_paths:
+            self.hot_paths.wrap(owner, attr)
+        self.stacks_path = stacks_path
+        self.sampler = StackSampler() if stacks_path is not None else None
+        self.started = time.perf_counter()
+
+    # Call from within trio.run, on the thread to sample.
+    def start(self):
+        trio.lowlevel.add_instrument(self.instrument)
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def stop(self):
+        trio.lowlevel.remove_instrument(self.instrument)
+        self.hot_paths.restore()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(self.stacks_path)
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        lines = [f"profile over {elapsed:.1f}s"]
+        p50, p90, p99 = percentiles(self.instrument.latencies, [50, 90, 99])
+        if p50 is not None:
+            lines.append(
+                f"scheduler latency p50 {p50 * 1e6:.0f}us p90 {p90 * 1e6:.0f}us p99 {p99 * 1e6:.0f}us"
+            )
+        lines.append("tasks by CPU time: name, spawns, steps, cpu seconds")
+        for name, stats in sorted(
+            self.instrument.tasks.items(), key=lambda item: -item[1].cpu_seconds
+        ):
+            lines.append(
+                f"  {name} {stats.spawns} {stats.steps} {stats.cpu_seconds:.3f}"
+            )
+        lines.append("hot paths: name, calls, estimated seconds, mean us")
+        for name, stats in sorted(
+            self.hot_paths.paths.items(), key=lambda item: -item[1].estimated_seconds
+        ):
+            mean = stats.sampled_seconds / stats.sampled * 1e6 if stats.sampled else 0
+            lines.append(
+                f"  {name} {stats.calls} {stats.estimated_seconds:.3f} {mean:.1f}"
+            )
+        return "\n".join(lines)
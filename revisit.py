@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+from typing import *
+import heapq
+import logging
+import secrets
+import time
+import trio
+from my_types import Addr
+
+# BEP 51 caps the interval a node may ask for at 6 hours.
+MAX_INTERVAL = 6 * 60 * 60
+
+
+@dataclass
+class SampledNode:
+    addr: Addr
+    next_sample: float
+    queries: int = 0
+    samples: int = 0
+    new_infohashes: int = 0
+    last_num: Optional[int] = None
+    last_interval: int = 0
+    consecutive_failures: int = 0
+
+    # Expected new infohashes per query, with a prior of one per query so that
+    # nodes we've barely sampled still get revisited.
+    def yield_rate(self) -> float:
+        return (self.new_infohashes + 1) / (self.queries + 1)
+
+
+# Decides when to sample each node that supports sample_infohashes again. Nodes
+# are kept in a priority queue on the earliest time they may be sampled, which is
+# never before the interval they asked for, and is later the fewer new
+# infohashes they've yielded per query.
+class RevisitScheduler:
+    def __init__(
+        self,
+        revisit_base: float = 5 * 60,
+        max_revisit: float = MAX_INTERVAL,
+        retry_after: float = 10 * 60,
+        max_failures: int = 3,
+    ):
+        self.revisit_base = revisit_base
+        self.max_revisit = max_revisit
+        self.retry_after = retry_after
+        self.max_failures = max_failures
+        self.nodes: Dict[Addr, SampledNode] = {}
+        self._heap: List[Tuple[float, int, Addr]] = []
+        self._count = 0
+        self.queries = 0
+        self.new_infohashes = 0
+
+    def _schedule(self, node: SampledNode, next_sample: float):
+        node.next_sample = next_sample
+        self._count += 1
+        heapq.heappush(self._heap, (next_sample, self._count, node.addr))
+
+    # Records a sample_infohashes response from addr, from a traversal or a
+    # revisit, and schedules the node's next sample.
+    def observe(self, addr: Addr, response, samples: int, new: int, now=None):
+        if now is None:
+            now = time.monotonic()
+        node = self.nodes.get(addr)
+        if node is None:
+            node = self.nodes[addr] = SampledNode(addr, now)
+        node.queries += 1
+        node.samples += samples
+        node.new_infohashes += new
+        node.consecutive_failures = 0
+        reply = response["r"]
+        if not isinstance(reply, Mapping):
+            reply = {}
+        num = reply.get("num")
+        node.last_num = num if isinstance(num, int) else None
+        interval = reply.get("interval")
+        if not isinstance(interval, int) or interval < 0:
+            interval = 0
+        node.last_interval = min(interval, MAX_INTERVAL)
+        # A node that returned all it has won't have anything new until its
+        # interval is up.
+        delay = self.revisit_base / node.yield_rate()
+        if node.last_num is not None and samples >= node.last_num:
+            delay = max(delay, node.last_interval)
+        self._schedule(
+            node, now + max(node.last_interval, min(self.max_revisit, delay))
+        )
+
+    def on_failure(self, addr: Addr, now=None):
+        if now is None:
+            now = time.monotonic()
+        node = self.nodes[addr]
+        node.consecutive_failures += 1
+        if node.consecutive_failures >= self.max_failures:
+            del self.nodes[addr]
+            return
+        self._schedule(node, now + self.retry_after)
+
+    # Pops the node that's due soonest, if it's due by now.
+    def pop_due(self, now=None) -> Optional[SampledNode]:
+        if now is None:
+            now = time.monotonic()
+        while self._heap:
+            next_sample, _, addr = self._heap[0]
+            node = self.nodes.get(addr)
+            if node is None or node.next_sample != next_sample:
+                # Superseded by a later schedule.
+                heapq.heappop(self._heap)
+                continue
+            if next_sample > now:
+                return None
+            heapq.heappop(self._heap)
+            return node
+        return None
+
+    def next_due(self) -> Optional[float]:
+        while self._heap:
+            next_sample, _, addr = self._heap[0]
+            node = self.nodes.get(addr)
+            if node is not None and node.next_sample == next_sample:
+                return next_sample
+            heapq.heappop(self._heap)
+        return None
+
+    # Samples nodes as they come due, with at most max_in_flight queries
+    # outstanding. on_response is called with each reply, and returns the number
+    # of samples and how many were new.
+    async def run(
+        self,
+        dispatcher,
+        local_id: bytes,
+        on_response: Callable[[Any], Tuple[int, int]],
+        timeout: float = 5,
+        max_in_flight: int = 8,
+    ):
+        in_flight = trio.Semaphore(max_in_flight)
+
+        async def revisit(node: SampledNode):
+            try:
+                reply = await dispatcher.request(
+                    node.addr,
+                    "sample_infohashes",
+                    {"id": local_id, "target": secrets.token_bytes(20)},
+                    timeout,
+                )
+                self.queries += 1
+                if reply is None or "r" not in reply:
+                    self.on_failure(node.addr)
+                    return
+                samples, new = on_response(reply)
+                self.new_infohashes += new
+                self.observe(node.addr, reply, samples, new)
+            finally:
+                in_flight.release()
+
+        async with trio.open_nursery() as nursery:
+            while True:
+                next_due = self.next_due()
+                now = time.monotonic()
+                if next_due is None or next_due > now:
+                    # Traversals can add nodes that are due sooner, so don't
+                    # sleep too long.
+                    await trio.sleep(1 if next_due is None else min(1, next_due - now))
+                    continue
+                await in_flight.acquire()
+                node = self.pop_due()
+                if node is None:
+                    in_flight.release()
+                    continue
+                nursery.start_soon(revisit, node)
+
+    def log_stats(self):
+        logging.info(
+            "revisit scheduler: %d nodes, %d revisits, %d new infohashes (%.2f per query)",
+            len(self.nodes),
+            self.queries,
+            self.new_infohashes,
+            self.new_infohashes / self.queries if self.queries else 0,
+        )
@@ -0,0 +1,187 @@
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import *
+import heapq
+import logging
+import math
+import random
+import struct
+import trio
+import bencode
+from my_types import Addr
+from node_health import METHOD_UNKNOWN
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SimNode:
+    id: int
+    addr: Addr
+    # One way latency in seconds.
+    latency: float
+    supports_sample_infohashes: bool
+    infohashes: List[bytes]
+    alive: bool = True
+    # Filled in when the node is first queried.
+    table: Optional[List[int]] = None
+
+
+# A DHT of fake nodes reached through SimSockets, using trio's clock, so with a
+# MockClock a traversal over thousands of nodes runs as fast as the CPU allows.
+# Everything random is drawn from seed, so runs are repeatable.
+class SimNetwork:
+    k = 8
+
+    def __init__(
+        self,
+        nodes: int = 5000,
+        seed: int = 0,
+        latency: float = 0.05,
+        jitter: float = 0.5,
+        loss: float = 0.01,
+        churn: float = 0.0,
+        infohashes: int = 100_000,
+        infohashes_per_node: int = 50,
+        sample_support: float = 0.8,
+        interval: int = 600,
+    ):
+        self.random = random.Random(seed)
+        self.loss = loss
+        self.churn = churn
+        self.interval = interval
+        population = [self.random.randbytes(20) for _ in range(infohashes)]
+        self.nodes: Dict[int, SimNode] = {}
+        self.by_addr: Dict[Addr, SimNode] = {}
+        for index in range(nodes):
+            addr = (f"10.{index >> 16 & 0xFF}.{index >> 8 & 0xFF}.{index & 0xFF}", 6881)
+            node = SimNode(
+                id=self.random.getrandbits(160),
+                addr=addr,
+                latency=latency * self.random.uniform(1 - jitter, 1 + jitter),
+                supports_sample_infohashes=self.random.random() < sample_support,
+                infohashes=self.random.sample(
+                    population, min(infohashes_per_node, infohashes)
+                ),
+            )
+            self.nodes[node.id] = node
+            self.by_addr[addr] = node
+        self.ids = sorted(self.nodes)
+        self._deliveries: List[Tuple[float, int, "SimSocket", bytes, Addr]] = []
+        self._count = 0
+        self._delivery_scope: Optional[trio.CancelScope] = None
+        self.queries = 0
+        self.dropped = 0
+
+    def bootstrap_nodes(self, count: int = 8) -> List[Addr]:
+        alive = [node.addr for node in self.nodes.values() if node.alive]
+        return self.random.sample(alive, min(count, len(alive)))
+
+    # Up to k nodes from each of the buckets of node's routing table. Each bucket
+    # is a contiguous range of the sorted IDs.
+    def _table(self, node: SimNode) -> List[int]:
+        if node.table is None:
+            table = []
+            for bit in range(160):
+                start = ((node.id >> bit) ^ 1) << bit
+                low = bisect_left(self.ids, start)
+                high = bisect_right(self.ids, start + (1 << bit) - 1)
+                bucket = self.ids[low:high]
+                table.extend(self.random.sample(bucket, min(self.k, len(bucket))))
+            node.table = table
+        return node.table
+
+    def _closest(self, node: SimNode, target: int) -> bytes:
+        closest = heapq.nsmallest(self.k, self._table(node), key=lambda id: id ^ target)
+        return b"".join(
+            struct.pack(
+                "!20s4sH",
+                id.to_bytes(20, "big"),
+                bytes(map(int, self.nodes[id].addr[0].split("."))),
+                self.nodes[id].addr[1],
+            )
+            for id in closest
+        )
+
+    def _reply(self, node: SimNode, query) -> dict:
+        t = query[b"t"]
+        q = query[b"q"]
+        a = query.get(b"a", {})
+        if q == b"ping":
+            r = {"id": node.id.to_bytes(20, "big")}
+        elif q in (b"find_node", b"sample_infohashes"):
+            if q == b"sample_infohashes" and not node.supports_sample_infohashes:
+                return {"t": t, "y": "e", "e": [METHOD_UNKNOWN, "Method Unknown"]}
+            target = int.from_bytes(a[b"target"], "big")
+            r = {"id": node.id.to_bytes(20, "big"), "nodes": self._closest(node, target)}
+            if q == b"sample_infohashes":
+                samples = self.random.sample(node.infohashes, min(20, len(node.infohashes)))
+                r.update(
+                    interval=self.interval,
+                    num=len(node.infohashes),
+                    samples=b"".join(samples),
+                )
+        else:
+            return {"t": t, "y": "e", "e": [METHOD_UNKNOWN, "Method Unknown"]}
+        return {"t": t, "y": "r", "r": r}
+
+    def send(self, socket: "SimSocket", bytes: bytes, addr: Addr):
+        node = self.by_addr.get(addr)
+        if node is None or not node.alive or self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.queries += 1
+        reply = self._reply(node, bencode.parse_one_from_bytes(bytes))
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        arrival = trio.current_time() + 2 * node.latency
+        self._count += 1
+        heapq.heappush(
+            self._deliveries,
+            (arrival, self._count, socket, bencode.encode_to_bytes(reply), addr),
+        )
+        if self._delivery_scope is not None and arrival < self._delivery_scope.deadline:
+            self._delivery_scope.deadline = arrival
+
+    async def _deliver(self):
+        while True:
+            deadline = self._deliveries[0][0] if self._deliveries else math.inf
+            with trio.CancelScope(deadline=deadline) as self._delivery_scope:
+                await trio.sleep_forever()
+            self._delivery_scope = None
+            now = trio.current_time()
+            while self._deliveries and self._deliveries[0][0] <= now:
+                _, _, socket, bytes, addr = heapq.heappop(self._deliveries)
+                socket.received.send_nowait((bytes, addr))
+
+    # Each second, churn of the nodes leave or come back.
+    async def _churn(self):
+        nodes = list(self.nodes.values())
+        while True:
+            await trio.sleep(1)
+            for node in self.random.sample(nodes, int(len(nodes) * self.churn)):
+                node.alive = not node.alive
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self._deliver)
+            if self.churn:
+                nursery.start_soon(self._churn)
+
+
+# Stands in for a UDP socket on the simulated network.
+class SimSocket:
+    def __init__(self, network: SimNetwork):
+        self.network = network
+        self._send, self._receive = trio.open_memory_channel[Tuple[bytes, Addr]](
+            math.inf
+        )
+        self.received = self._send
+
+    async def sendto(self, bytes, addr):
+        await trio.lowlevel.checkpoint()
+        self.network.send(self, bytes, addr)
+
+    async def recvfrom(self, amount) -> Tuple[bytes, Addr]:
+        return await self._receive.receive()
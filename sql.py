@@ -9,111 +9,215 @@ import sqlite3
 import os
 from pprint import pprint
 from util import chunk_bytes
+from contextlib import asynccontextmanager
+import logging
+import queue
+import time
+import trio
+import metrics
 
 DB_PATH = "herp.db"
 USE_APSW = os.environ.get("USE_APSW", False)
 
 if USE_APSW:
 
-    def connect():
-        db = apsw.Connection("herp.db")
+    def connect(database=DB_PATH):
+        db = apsw.Connection(database)
         db.createscalarfunction("bencode_get", bencode_get, deterministic=True)
         db.createmodule("chunk", Chunk)
+        db.createmodule("bencode_get_many", BencodeGetMany)
         return db
 
 
 else:
     sqlite3.enable_callback_tracebacks(True)
 
-    def connect(database="herp.db"):
+    def connect(database=DB_PATH):
         db = sqlite3.connect(database)
         Chunk.register(db)
+        BencodeGetMany.register(db)
         db.create_function("bencode_get", -1, bencode_get, deterministic=True)
         return db
 
 
-def dropwhile(f, bytes):
-    print("dropwhile", f, bytes)
-    while f(bencode.parse_one_from_bytes(bytes)):
-        bytes = discard(bytes)
-    return bytes
+class SequenceEnded(Exception):
+    pass
 
 
-def drop_until_end(bytes):
-    while not bytes.startswith(b"e"):
-        bytes = discard(bytes)
-    return bytes[1:]
+_D, _L, _E = b"dle"
 
 
-class SequenceEnded(Exception):
-    pass
+# Returns the offset of the value for key in the dict body starting at pos, or
+# None if the body ends without it. Keys are compared in place without decoding.
+def _find_key(buf, pos: int, key: bytes) -> Optional[int]:
+    while pos < len(buf) and buf[pos] != _E:
+        c = buf[pos]
+        if c != _D and c != _L and c != ord("i"):
+            start, end = bencode.string_bounds(buf, pos)
+            if end - start == len(key) and buf.startswith(key, start):
+                return end
+            pos = end
+        else:
+            pos = bencode.skip(buf, pos)
+        if pos >= len(buf) or buf[pos] == _E:
+            return None
+        pos = bencode.skip(buf, pos)
+    return None
+
+
+def _skip_items(buf, pos: int, n: int) -> Optional[int]:
+    for _ in range(n):
+        if buf[pos] == _E:
+            return None
+        pos = bencode.skip(buf, pos)
+    if buf[pos] == _E:
+        return None
+    return pos
 
 
-def discard(bytes, n=1):
-    def discard_one(bytes):
-        c = bytes[0]
-        if c in map(ord, ["l", "d"]):
-            return drop_until_end(bytes[1:])
-        elif c == ord("i"):
-            return bytes.partition(b"e")[2]
-        elif c == ord("e"):
-            raise SequenceEnded(bytes)
+def _path_key(key):
+    if isinstance(key, str):
+        return key.encode()
+    return key
+
+
+# Returns the offset of the value at path, or None if it doesn't exist. Integer
+# path elements index into the items of a list (or the flattened keys and values
+# of a dict), other elements are dict keys.
+def locate(buf, *path) -> Optional[int]:
+    pos = 0
+    for key in path:
+        c = buf[pos]
+        if c != _D and c != _L:
+            return None
+        if isinstance(key, int):
+            pos = _skip_items(buf, pos + 1, key)
         else:
-            len, _, bytes = bytes.partition(b":")
-            return bytes[int(len) :]
-
-    while n > 0:
-        bytes = discard_one(bytes)
-        n -= 1
-    return bytes
+            pos = _find_key(buf, pos + 1, _path_key(key))
+        if pos is None:
+            return None
+    return pos
 
 
 def lookup(key, bytes):
-    if isinstance(key, str):
-        key = key.encode()
-    while bytes[:1] != b"e":
-        if key == bencode.parse_one_from_bytes(bytes):
-            return discard(bytes)
-        bytes = discard(bytes, 2)
-    raise SequenceEnded
+    pos = _find_key(bytes, 0, _path_key(key))
+    if pos is None:
+        raise SequenceEnded
+    return bytes[pos:]
 
 
 def bencode_get_bytes(bytes, *path):
-    if len(path) == 0:
-        return bytes
-    key, *rest = path
-    try:
-        if isinstance(key, int):
-            return bencode_get_bytes(discard(bytes[1:], key), *rest)
-        return bencode_get_bytes(lookup(key, bytes[1:]), *rest)
-    except SequenceEnded:
+    pos = locate(bytes, *path)
+    if pos is None:
         return
+    return bytes[pos:]
+
+
+def _leaf_at(buf, pos: Optional[int]):
+    if pos is None or buf[pos] in (_D, _L):
+        return None
+    return bencode.decode_from(buf, pos)[0]
 
 
 def bencode_get(bytes, *path):
     if bytes is None:
         return
-    bytes = bencode_get_bytes(bytes, *path)
-    if bytes is None:
-        return
-    object = bencode.parse_one_from_bytes(bytes)
-    if isinstance(object, (dict, list)):
-        return None
-    else:
-        return object
-
+    return _leaf_at(bytes, locate(bytes, *path))
+
+
+def _paths_trie(paths):
+    # Each node is a mapping of path elements to child nodes, and the indexes of
+    # the paths that end there.
+    root = ({}, [])
+    for index, path in enumerate(paths):
+        node = root
+        for key in path:
+            node = node[0].setdefault(_path_key(key), ({}, []))
+        node[1].append(index)
+    return root
+
+
+# Records the offsets of the paths in nodes, for the value at pos. An item can be
+# reached through more than one node, by its index and by its key. Returns the
+# offset just past the value if need_end, which callers that go on scanning the
+# enclosing container use instead of skipping the value a second time.
+def _scan_paths(
+    buf, pos: int, nodes: list, found: List[Optional[int]], need_end: bool
+) -> Optional[int]:
+    wanted = 0
+    for children, ends in nodes:
+        for index in ends:
+            found[index] = pos
+        wanted += len(children)
+    c = buf[pos]
+    if not wanted or (c != _D and c != _L):
+        return bencode.skip(buf, pos) if need_end else None
+    is_dict = c == _D
+    pos += 1
+    item_index = 0
+    # Nodes for the value after the current key, and the keys seen, since only
+    # the first of duplicate keys is looked up.
+    key_nodes: list = []
+    seen_keys = set()
+    while buf[pos] != _E:
+        if not wanted and not need_end:
+            return None
+        item_nodes = [
+            children[item_index] for children, _ in nodes if item_index in children
+        ] + key_nodes
+        key_nodes = []
+        if is_dict and not item_index % 2 and buf[pos] not in (_D, _L, ord("i")):
+            start, end = bencode.string_bounds(buf, pos)
+            key = buf[start:end]
+            if key not in seen_keys:
+                seen_keys.add(key)
+                key_nodes = [children[key] for children, _ in nodes if key in children]
+            if not item_nodes:
+                pos = end
+                item_index += 1
+                continue
+        if item_nodes:
+            wanted -= len(item_nodes)
+            pos = _scan_paths(buf, pos, item_nodes, found, True)
+        else:
+            pos = bencode.skip(buf, pos)
+        item_index += 1
+    return pos + 1
 
-class BencodeGet(TableFunction):
-    columns = "key", "value"
-    params = "bytes", "lookup"
 
-    def initialize(self, bytes, lookup):
-        self.bytes = bytes
-        self.lookup = lookup
-        self.parsed = bencode.parse_from_bytes(bytes)
+# Locates the values at several paths in a single scan of buf. Returns the leaf
+# values in the same order as paths, with None for missing paths or containers.
+def bencode_get_paths(bytes, paths: Sequence[Sequence[Union[str, bytes, int]]]):
+    if bytes is None:
+        return [None] * len(paths)
+    found: List[Optional[int]] = [None] * len(paths)
+    _scan_paths(bytes, 0, [_paths_trie(paths)], found, False)
+    return [_leaf_at(bytes, pos) for pos in found]
+
+
+def parse_paths(paths: str) -> List[tuple]:
+    return [
+        tuple(int(key) if key.isdigit() else key for key in path.split("."))
+        for path in paths.split(",")
+    ]
+
+
+# Table function giving a row for each of a comma separated list of dotted paths,
+# from a single scan of the input. For example bencode_get_many(payload,
+# 't,r.id,r.nodes').
+class BencodeGetMany(TableFunction):
+    params = ["input", "paths"]
+    columns = ["path", "value"]
+    name = "bencode_get_many"
+
+    def initialize(self, input, paths):
+        names = paths.split(",")
+        self.__rows = iter(
+            zip(names, bencode_get_paths(input, parse_paths(paths)))
+        )
 
     def iterate(self, idx):
-        eval(self.lookup)
+        return next(self.__rows)
 
 
 class Chunk(TableFunction):
@@ -128,11 +232,42 @@ class Chunk(TableFunction):
         return (next(self.__iter),)
 
 
+# Reads a blob using incremental blob I/O, so it needn't be held in memory at
+# once. Suitable for feeding to bencode.visit_chunks.
+def read_blob_chunks(db_conn, table, column, rowid, chunk_size=0x10000):
+    with db_conn.blobopen(table, column, rowid, readonly=True) as blob:
+        while chunk := blob.read(chunk_size):
+            yield chunk
+
+
 @dataclass
 class BaseRecordedSocket:
     socket: typing.Any
     db_conn: typing.Any
 
+    async def record(self, type: str, addr: Addr, bytes: bytes, error: Optional[str]):
+        record_operation(self.db_conn, type, addr_for_db(addr), bytes, error)
+
+
+_packets_sent = metrics.registry.counter("dht_packets_sent_total", "UDP packets sent")
+_bytes_sent = metrics.registry.counter("dht_bytes_sent_total", "UDP payload bytes sent")
+_send_errors = metrics.registry.counter(
+    "dht_send_errors_total", "UDP sends that raised"
+)
+_packets_received = metrics.registry.counter(
+    "dht_packets_received_total", "UDP packets received"
+)
+_bytes_received = metrics.registry.counter(
+    "dht_bytes_received_total", "UDP payload bytes received"
+)
+commits = metrics.registry.counter("sqlite_commits_total", "SQLite write transactions")
+commit_seconds = metrics.registry.histogram(
+    "sqlite_commit_seconds", "time to write and commit a transaction", metrics.LOCAL_BUCKETS
+)
+_operations_written = metrics.registry.counter(
+    "sqlite_operations_written_total", "rows written to the operation table"
+)
+
 
 class Sender(BaseRecordedSocket):
     async def sendto(self, bytes, addr):
@@ -143,20 +278,20 @@ class Sender(BaseRecordedSocket):
         finally:
             exc_value = sys.exc_info()[1]
             if exc_value is not None:
+                _send_errors.inc()
                 exc_value = str(exc_value)
-            with self.db_conn:
-                try:
-                    record_operation(
-                        self.db_conn, "send", addr_for_db(addr), bytes, exc_value
-                    )
-                except ValueError:
-                    raise
+            else:
+                _packets_sent.inc()
+                _bytes_sent.inc(len(bytes))
+            await self.record("send", addr, bytes, exc_value)
 
 
 class Receiver(BaseRecordedSocket):
     async def recvfrom(self, amount) -> Tuple[bytes, Addr]:
         bytes, addr = await self.socket.recvfrom(amount)
-        record_operation(self.db_conn, "recv", addr_for_db(addr), bytes, None)
+        _packets_received.inc()
+        _bytes_received.inc(len(bytes))
+        await self.record("recv", addr, bytes, None)
         return bytes, addr
 
 
@@ -164,14 +299,253 @@ class RecordedSocket(Sender, Receiver):
     pass
 
 
+_insert_operation = """insert into operation
+    (payload, remote_addr, type, error, datetime, t, y, q, node_id, error_code)
+    values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Columns decoded from the payload when an operation is recorded, and their
+# types.
+operation_columns = {
+    "t": "blob",
+    "y": "text",
+    "q": "text",
+    "node_id": "blob",
+    "error_code": "integer",
+}
+
+_operation_column_paths = [("t",), ("y",), ("q",), ("r", "id"), ("a", "id"), ("e", 0)]
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("ascii", "replace")
+    return value
+
+
+def operation_columns_values(type: str, bytes: bytes) -> tuple:
+    try:
+        t, y, q, reply_id, query_id, error_code = bencode_get_paths(
+            bytes, _operation_column_paths
+        )
+    except (ValueError, IndexError):
+        # Not something we can decode, so there's nothing to index.
+        return None, None, None, None, None
+    # The id in a query is the sender's, which is only the remote node when we
+    # received it.
+    node_id = reply_id if reply_id is not None or type == "send" else query_id
+    if not isinstance(error_code, int):
+        error_code = None
+    return t, _text(y), _text(q), node_id, error_code
+
+
+# An operation as it's queued for writing. The columns decoded from the payload
+# are added by record_operation_rows, so that decoding happens on the writer.
+def operation_row(
+    type: str, remote_addr: str, bytes: bytes, error: Union[str, None]
+) -> tuple:
+    # Taken when the operation occurred rather than when it's written.
+    return (bytes, remote_addr, type, error, db_datetime())
+
+
+# Same format as SQLite's datetime('now'), for the given time or now.
+def db_datetime(t: Optional[float] = None) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+# Adds the columns decoded at ingest to an existing operation table, and indexes
+# them. Rows recorded before the columns existed are filled in by
+# backfill_operation_columns.
+def upgrade_operation_table(db_conn):
+    existing = {row[1] for row in db_conn.execute("pragma table_info(operation)")}
+    if not existing:
+        return
+    with db_conn:
+        for name, type in operation_columns.items():
+            if name not in existing:
+                db_conn.execute(f"alter table operation add column {name} {type}")
+        db_conn.execute("create index if not exists operation_t on operation(t)")
+        db_conn.execute(
+            "create index if not exists operation_node_id on operation(node_id)"
+        )
+        db_conn.execute(
+            "create index if not exists operation_type_y on operation(type, y, q)"
+        )
+        # Nothing looks operations up by type and address now that the routing
+        # table is saved in its own table, and the index slowed every insert.
+        db_conn.execute("drop index if exists operation_type_remote_addr")
+
+
+def backfill_operation_columns(db_conn, batch_size=10000) -> int:
+    last_rowid = 0
+    total = 0
+    while True:
+        rows = db_conn.execute(
+            "select rowid, type, payload from operation where rowid > ? order by rowid limit ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return total
+        with db_conn:
+            db_conn.executemany(
+                "update operation set t=?, y=?, q=?, node_id=?, error_code=? where rowid=?",
+                (
+                    (*operation_columns_values(type, payload), rowid)
+                    for rowid, type, payload in rows
+                ),
+            )
+        last_rowid = rows[-1][0]
+        total += len(rows)
+        logging.info("backfilled operation columns up to rowid %d", last_rowid)
+
+
 def record_operation(
     db_conn, type: str, remote_addr: str, bytes: bytes, error: Union[str, None]
 ):
+    record_operation_rows(db_conn, [operation_row(type, remote_addr, bytes, error)])
+
+
+# Decodes the columns of rows made by operation_row, and inserts them in one
+# transaction.
+def record_operation_rows(db_conn, rows: Sequence[tuple]):
+    started = time.perf_counter()
     with db_conn:
-        db_conn.execute(
-            "insert into operation (payload, remote_addr, type, error, datetime) values (?, ?, ?, ?, datetime('now'))",
-            [bytes, remote_addr, type, error],
-        )
+        insert_operation_rows(db_conn, rows)
+    commit_seconds.observe(time.perf_counter() - started)
+    commits.inc()
+
+
+# Like record_operation_rows, but in the caller's transaction.
+def insert_operation_rows(db_conn, rows: Sequence[tuple]):
+    decoded = [(*row, *operation_columns_values(row[2], row[0])) for row in rows]
+    db_conn.executemany(_insert_operation, decoded)
+    _operations_written.inc(len(rows))
+
+
+@dataclass
+class RecorderStats:
+    queued: int = 0
+    dropped: int = 0
+    # Time spent waiting for space in a full queue.
+    blocked_seconds: float = 0
+    written: int = 0
+    flushes: int = 0
+    last_flush_seconds: float = 0
+    max_flush_seconds: float = 0
+    total_flush_seconds: float = 0
+
+
+_stop_recording = object()
+
+
+# Records operations from a bounded queue that's drained by a dedicated writer
+# thread, which inserts them in transactions of up to batch_size rows, or after
+# max_delay seconds. When the queue is full, record either waits for space or
+# drops the operation, depending on drop_when_full.
+class BatchRecorder:
+    def __init__(
+        self,
+        database=DB_PATH,
+        max_queue=10000,
+        batch_size=500,
+        max_delay=1.0,
+        drop_when_full=False,
+    ):
+        self.database = database
+        self.queue: queue.Queue = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.drop_when_full = drop_when_full
+        self.stats = RecorderStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    async def record(
+        self, type: str, remote_addr: str, bytes: bytes, error: Union[str, None]
+    ):
+        row = operation_row(type, remote_addr, bytes, error)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            if self.drop_when_full:
+                self.stats.dropped += 1
+                return
+            started = time.monotonic()
+            while True:
+                await trio.sleep(self.max_delay / 100)
+                try:
+                    self.queue.put_nowait(row)
+                except queue.Full:
+                    continue
+                break
+            self.stats.blocked_seconds += time.monotonic() - started
+        self.stats.queued += 1
+
+    def _flush(self, db_conn, batch):
+        started = time.perf_counter()
+        record_operation_rows(db_conn, batch)
+        elapsed = time.perf_counter() - started
+        stats = self.stats
+        stats.written += len(batch)
+        stats.flushes += 1
+        stats.last_flush_seconds = elapsed
+        stats.max_flush_seconds = max(stats.max_flush_seconds, elapsed)
+        stats.total_flush_seconds += elapsed
+
+    def _write_loop(self):
+        db_conn = sqlite3.connect(self.database)
+        try:
+            batch = []
+            deadline = 0.0
+            while True:
+                timeout = None if not batch else max(0, deadline - time.monotonic())
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    row = None
+                if row is _stop_recording:
+                    if batch:
+                        self._flush(db_conn, batch)
+                    return
+                if row is not None:
+                    if not batch:
+                        deadline = time.monotonic() + self.max_delay
+                    batch.append(row)
+                if batch and (row is None or len(batch) >= self.batch_size):
+                    self._flush(db_conn, batch)
+                    batch = []
+        finally:
+            db_conn.close()
+
+    # Runs the writer until stop is called, and everything queued before then is
+    # written.
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        task_status.started()
+        await trio.to_thread.run_sync(self._write_loop)
+
+    def stop(self):
+        self.queue.put(_stop_recording)
+
+
+@asynccontextmanager
+async def open_batch_recorder(*args, **kwargs):
+    recorder = BatchRecorder(*args, **kwargs)
+    async with trio.open_nursery() as nursery:
+        await nursery.start(recorder.run)
+        try:
+            yield recorder
+        finally:
+            recorder.stop()
+    logging.info("operation recorder finished: %s", recorder.stats)
+
+
+@dataclass
+class BatchRecordedSocket(RecordedSocket):
+    recorder: BatchRecorder
+
+    async def record(self, type: str, addr: Addr, bytes: bytes, error: Optional[str]):
+        await self.recorder.record(type, addr_for_db(addr), bytes, error)
 
 
 def addr_for_db(addr: Tuple[str, int]) -> str:
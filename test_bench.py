@@ -0,0 +1,46 @@
+from bench import *
+
+
+def test_checked_in_fixtures_match_generator(tmp_path):
+    write_fixtures(str(tmp_path))
+    for name in make_fixture_messages():
+        with open(os.path.join(FIXTURES_DIR, name + ".bencode"), "rb") as file:
+            assert file.read() == (tmp_path / (name + ".bencode")).read_bytes()
+
+
+def test_benchmark_cases_run():
+    fixtures = load_fixtures(large=False)
+    find_node = next(f for f in fixtures if f.name == "find_node_reply")
+    assert len(sql.bencode_get(find_node.bytes, *find_node.chunk_path)) == 416
+    names = set()
+    for name, size, func in benchmark_cases(fixtures):
+        func()
+        names.add(name.split("/")[0])
+    assert names == {
+        "encode",
+        "parse_one_from_bytes",
+        "bencode_get",
+        "message_writer",
+        "chunk_bytes",
+        "chunk_table",
+    }
+
+
+def test_receive_replies():
+    socket = trio.run(receive_replies, 200)
+    assert socket.replies >= 200
+    assert socket.bytes // socket.replies == len(
+        b"d1:rd2:id20:" + bytes(20) + b"5:nodes208:" + bytes(208) + b"e1:t8:" + bytes(8) + b"1:y1:re"
+    )
+
+
+def test_find_regressions():
+    baseline = {"results": {"a": {"ops_per_second": 100}, "b": {"ops_per_second": 100}}}
+    current = {
+        "results": {
+            "a": {"ops_per_second": 91},
+            "b": {"ops_per_second": 89},
+            "c": {"ops_per_second": 1},
+        }
+    }
+    assert find_regressions(current, baseline, threshold=0.1) == [("b", 100, 89)]
@@ -37,3 +37,135 @@ def test_parsed_dict():
         d[b"nope"]
     assert "hello" in d
     assert "nope" not in d
+
+
+def test_parse_bytes_many():
+    assert parse_bytes(b"i1e3:abcle") == [1, b"abc", []]
+    assert parse_bytes(memoryview(b"d1:ai-2ee")) == [{b"a": -2}]
+
+
+def test_parse_truncated():
+    for bad in [b"d1:a", b"l", b"i12", b"5:abc", b""]:
+        with pytest.raises(ValueError):
+            parse_one_from_bytes(bad)
+
+
+# Counts the bytes copied out of the input by slicing it.
+class CountingBytes(bytes):
+    copied = 0
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(key, slice):
+            CountingBytes.copied += len(value)
+        return value
+
+
+def test_parse_large_is_linear():
+    item = b"d6:lengthi42e4:pathl5:hello5:worlde6:pieces20:" + b"x" * 20 + b"e"
+    encoded = CountingBytes(b"l" + item * 20000 + b"e")
+    CountingBytes.copied = 0
+    assert len(parse_one_from_bytes(encoded)) == 20000
+    # Reslicing the remaining input per value would copy quadratically much.
+    assert CountingBytes.copied < len(encoded)
+
+
+def test_encode_canonical():
+    assert encode_to_bytes({"y": "q", b"a": [1, -2, b""], "t": b"aa"}) == (
+        b"d1:ali1ei-2e0:e1:t2:aa1:y1:qe"
+    )
+    assert encode_to_bytes(parse_one_from_bytes(b"d1:bi0e1:alee")) == b"d1:ale1:bi0ee"
+    with pytest.raises(TypeError):
+        encode_to_bytes(1.5)
+
+
+def test_encode_into_buffer():
+    buf = bytearray(b"prefix")
+    assert encode_into([b"x", 3], buf) is buf
+    assert buf == b"prefixl1:xi3ee"
+    encoder = Encoder()
+    assert encoder.encode(example_ping_query()) == encoded_example_ping_query
+    assert encoder.encode({}) == b"de"
+
+
+def test_parse_lazy():
+    encoded = b"d4:infod5:filesld6:lengthi3e4:pathl1:aeed6:lengthi4e4:pathl1:b1:ceee4:name3:foo6:pieces20:aaaaaaaaaaaaaaaaaaaaee"
+    assert parse_lazy(encoded) == parse_one_from_bytes(encoded)
+    lazy = parse_lazy(encoded)
+    info = lazy["info"]
+    assert info is lazy[b"info"]
+    assert "pieces" in info and "nope" not in info
+    assert list(info) == [b"files", b"name", b"pieces"]
+    assert info["name"] == b"foo"
+    files = info["files"]
+    assert len(files) == 2
+    assert files[-1]["path"] == [b"b", b"c"]
+    assert [f["length"] for f in files[:1]] == [3]
+    assert info.get("nope") is None
+    with pytest.raises(KeyError):
+        info["nope"]
+    with pytest.raises(IndexError):
+        files[2]
+    # Only the values that were read have been decoded.
+    assert b"pieces" not in info._values
+    assert parse_lazy(b"i5e") == 5
+
+
+def test_parse_lazy_truncated():
+    with pytest.raises(ValueError):
+        parse_lazy(b"d1:ai1e1:b")["b"]
+    with pytest.raises(ValueError):
+        len(parse_lazy(b"li1e"))
+
+
+def test_negative_string_length():
+    with pytest.raises(ValueError):
+        len(parse_lazy(b"d1:t-3:ae"))
+    with pytest.raises(ValueError):
+        skip(b"l1:a-3:e", 0)
+    with pytest.raises(ValueError):
+        parse_one_from_bytes(b"l-1:e")
+
+
+class EventRecorder:
+    def __init__(self):
+        self.events = []
+
+    def start_dict(self):
+        self.events.append("d")
+
+    def start_list(self):
+        self.events.append("l")
+
+    def end(self):
+        self.events.append("e")
+
+    def int(self, value):
+        self.events.append(value)
+
+    def str(self, value):
+        self.events.append(bytes(value))
+
+
+def test_push_parser_chunks():
+    encoded = b"d4:infod6:lengthi-42e4:pathl0:5:helloee1:ti7ee3:abci0e"
+    expected = EventRecorder()
+    StreamDecoder(BytesStreamReader(encoded)).visit(expected)
+    for size in range(1, len(encoded) + 1):
+        recorder = EventRecorder()
+        visit_chunks(
+            (encoded[i : i + size] for i in range(0, len(encoded), size)), recorder
+        )
+        assert recorder.events == expected.events
+
+
+def test_push_parser_incomplete():
+    for bad in [b"d", b"i12", b"5:abc", b"l1:ae"[:-1]]:
+        parser = PushParser(EventRecorder())
+        parser.feed(bad)
+        with pytest.raises(ValueError):
+            parser.close()
+    with pytest.raises(ValueError):
+        PushParser(EventRecorder()).feed(b"e")
+    with pytest.raises(ValueError):
+        PushParser(EventRecorder()).feed(b"i" + b"1" * 100)
@@ -0,0 +1,72 @@
+from bencode_fields import *
+import bencode
+import sqlite3
+
+
+def messages_db():
+    db_conn = sqlite3.connect(":memory:")
+    db_conn.execute(
+        'create table messages(parent_id, "index", depth, type, value, top_id)'
+    )
+    return db_conn
+
+
+def test_record_packet_from_chunks():
+    encoded = b"d1:rd2:id3:abc5:nodesl1:xi2eee1:t2:aae"
+    expected = messages_db()
+    record_packet(encoded, expected, new_message_id(expected))
+    db_conn = messages_db()
+    bencode.visit_chunks(
+        [encoded[:5], encoded[5:6], encoded[6:]],
+        MessageWriter(db_conn.cursor(), new_message_id(db_conn)),
+    )
+    select = 'select rowid, parent_id, "index", depth, type, value, top_id from messages'
+    rows = list(db_conn.execute(select))
+    assert rows == list(expected.execute(select))
+    assert rows[:3] == [
+        (1, None, None, None, None, None, 1),
+        (2, 1, 0, 0, "d", None, 1),
+        (3, 2, 0, 1, "s", b"r", 1),
+    ]
+
+
+def test_record_packets_matches_message_writer():
+    packets = [
+        b"d1:ad2:id3:abce1:q4:ping1:t2:aa1:y1:qe",
+        b"d1:rd2:id3:abc5:nodesl1:xi2eee1:t2:aa1:y1:re",
+    ]
+    expected = messages_db()
+    for packet in packets:
+        record_packet(packet, expected, new_message_id(expected))
+    db_conn = messages_db()
+    assert record_packets(db_conn, packets) == [1, 15]
+    select = 'select rowid, parent_id, "index", depth, type, value, top_id from messages'
+    assert list(db_conn.execute(select)) == list(expected.execute(select))
+    assert record_packets(db_conn, packets[:1]) == [32]
+
+
+def test_upgrade_messages_table():
+    db_conn = sqlite3.connect(":memory:")
+    db_conn.execute('create table messages(parent_id, "index", depth, type, value)')
+    db_conn.executemany(
+        'insert into messages(rowid, parent_id, "index", depth, type, value) values (?, ?, ?, ?, ?, ?)',
+        [
+            (1, None, None, None, None, None),
+            (2, 1, 0, 0, "l", None),
+            (3, 2, 0, 1, "l", None),
+            (4, 3, 0, 2, "i", 1),
+            (5, 3, 1, 2, "e", None),
+            (6, 2, 1, 1, "e", None),
+            (7, None, None, None, None, None),
+            (8, 7, 0, 0, "i", 2),
+        ],
+    )
+    upgrade_messages_table(db_conn)
+    assert [
+        top_id for top_id, in db_conn.execute("select top_id from messages order by rowid")
+    ] == [1, 1, 1, 1, 1, 1, 7, 7]
+    assert record_packets(db_conn, [b"i3e"]) == [9]
+    assert list(db_conn.execute("select top_id from messages where rowid > 8")) == [
+        (9,),
+        (9,),
+    ]
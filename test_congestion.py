@@ -0,0 +1,35 @@
+from congestion import *
+
+
+def test_rtt_timeouts():
+    scheduler = QueryScheduler(min_timeout=0.1, max_timeout=5)
+    assert scheduler.timeout_for(("a", 1)) == 5
+    for _ in range(20):
+        scheduler.on_response(("a", 1), 0.2)
+    assert 0.1 <= scheduler.timeout_for(("a", 1)) < 0.3
+    scheduler.on_response(("b", 1), 2)
+    assert scheduler.timeout_for(("b", 1)) == 5
+    # Unknown nodes get the session's estimate.
+    assert scheduler.timeout_for(("c", 1)) == min(
+        5, max(0.1, scheduler.session.timeout())
+    )
+
+
+def test_window_adapts():
+    scheduler = QueryScheduler(initial_window=3, max_window=8)
+    for _ in range(100):
+        scheduler.on_response(("a", 1), 0.1)
+    assert scheduler.alpha == 8
+    # Occasional timeouts are expected and leave the window alone.
+    scheduler.on_timeout(("b", 1))
+    assert scheduler.alpha == 8
+    for _ in range(50):
+        scheduler.on_timeout(("b", 1))
+    assert scheduler.alpha == 1
+
+
+def test_nodes_bounded():
+    scheduler = QueryScheduler(max_nodes=2)
+    for port in range(3):
+        scheduler.on_response(("a", port), 0.1)
+    assert list(scheduler.nodes) == [("a", 1), ("a", 2)]
@@ -0,0 +1,47 @@
+import sqlite3
+
+from infohash_set import *
+
+
+def ih(n):
+    return n.to_bytes(20, "big")
+
+
+def test_add_and_contains_across_merges():
+    infohashes = InfohashSet(min_merge=4)
+    for n in range(0, 100, 3):
+        infohashes.add(ih(n << 100))
+    infohashes.add(ih(3 << 100))
+    assert len(infohashes) == 34
+    # Lookups are right whether or not a background merge is in progress.
+    assert all((ih(n << 100) in infohashes) == (n % 3 == 0) for n in range(100))
+    infohashes.merge()
+    assert len(infohashes.delta) == len(infohashes.merging) == 0
+    assert len(infohashes.packed) == 34
+    assert list(infohashes.packed) == sorted(infohashes.packed)
+
+
+def test_load_from_db():
+    db_conn = sqlite3.connect(":memory:")
+    db_conn.execute(
+        "create table sample_infohashes_response_infohash(response_id, infohash)"
+    )
+    db_conn.executemany(
+        "insert into sample_infohashes_response_infohash values (?, ?)",
+        [(1, ih(5 << 100)), (1, ih(2 << 100)), (2, ih(5 << 100)), (2, b"\xff" * 20)],
+    )
+    infohashes = InfohashSet.load(db_conn)
+    assert list(infohashes.packed) == [2 << 4, 5 << 4, 2**64 - 1]
+    assert b"\xff" * 20 in infohashes
+    assert ih(3 << 100) not in infohashes
+
+
+def test_between():
+    infohashes = InfohashSet(min_merge=2)
+    for first in [1, 5, 9, 200]:
+        infohashes.add(bytes([first]) + bytes(19))
+    infohashes.add(bytes([6]) + bytes(19))
+    subset = infohashes.between(5 << 56, 10 << 56)
+    assert sorted(key >> 56 for key in [*subset.packed, *subset.delta]) == [5, 6, 9]
+    assert bytes([9]) + bytes(19) in subset
+    assert bytes([1]) + bytes(19) not in subset
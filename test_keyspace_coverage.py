@@ -0,0 +1,56 @@
+import sqlite3
+
+from keyspace_coverage import *
+
+
+def test_region_uses_id_prefix():
+    planner = CoveragePlanner(prefix_bits=4)
+    assert planner.region(b"\xf0" + bytes(19)) == 15
+    assert planner.region(b"\x1f" + bytes(19)) == 1
+
+
+def test_pick_target_prefers_unsampled_regions():
+    planner = CoveragePlanner(prefix_bits=2)
+    for first in (0x00, 0x40, 0xC0):
+        planner.record(bytes([first]) + bytes(19), now=100)
+    target = planner.pick_target(now=200)
+    assert len(target) == 20
+    assert planner.region(target) == 2
+
+
+def test_pick_target_spreads_before_replies():
+    planner = CoveragePlanner(prefix_bits=2)
+    regions = {planner.region(planner.pick_target(now=1)) for _ in range(4)}
+    assert regions == {0, 1, 2, 3}
+
+
+def test_pick_target_prefers_stale_regions():
+    planner = CoveragePlanner(prefix_bits=1)
+    planner.record(b"\x00" + bytes(19), now=300)
+    planner.record(b"\x80" + bytes(19), now=100)
+    assert planner.region(planner.pick_target(now=400)) == 1
+
+
+def test_coverage_fractions():
+    planner = CoveragePlanner(prefix_bits=2)
+    planner.record(b"\x00" + bytes(19), now=100)
+    planner.record(b"\x40" + bytes(19), now=300)
+    assert planner.coverage([200]) == (0.5, [0.25])
+
+
+def test_save_load():
+    db_conn = sqlite3.connect(":memory:")
+    planner = CoveragePlanner(prefix_bits=4)
+    planner.record(b"\x30" + bytes(19), now=100)
+    planner.save(db_conn)
+    loaded = CoveragePlanner.load(db_conn, prefix_bits=4)
+    assert loaded.samples[3] == 1
+    assert loaded.last_sampled[3] == 100
+    assert CoveragePlanner.load(db_conn, prefix_bits=8).samples[3 << 4] == 0
+    assert db_conn.execute("select count(*) from keyspace_coverage_history").fetchone() == (1,)
+
+
+def test_restrict_to_slice():
+    planner = CoveragePlanner(prefix_bits=4)
+    planner.restrict(1, 4)
+    assert {planner.region(planner.pick_target(now=1)) for _ in range(8)} == {4, 5, 6, 7}
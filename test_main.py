@@ -0,0 +1,335 @@
+from main import *
+import struct
+import trio.testing
+import pytest
+
+
+def node(id: int, port=1) -> NodeInfo:
+    return NodeInfo(PeerId(id.to_bytes(20, "big")), ("1.2.3.4", port))
+
+
+def test_candidates_order():
+    candidates = Candidates(bytes(20))
+    assert candidates.add(NodeInfo(None, ("1.2.3.4", 9)))
+    assert candidates.add(node(5))
+    assert candidates.add(node(3))
+    assert not candidates.add(node(3))
+    assert not candidates.add(node(7), bound=6)
+    assert candidates.add(node(6), bound=6)
+    assert [candidates.pop() for _ in range(len(candidates))] == [
+        (3, node(3)),
+        (5, node(5)),
+        (6, node(6)),
+        (None, NodeInfo(None, ("1.2.3.4", 9))),
+    ]
+
+
+def test_closest_nodes():
+    closest = ClosestNodes(k=3)
+    for id in [9, 4, 7]:
+        closest.add(node(id), id)
+    assert closest.bound == 9
+    closest.add(node(1), 1)
+    closest.add(node(8), 8)
+    assert closest.bound == 7
+    assert list(closest) == [node(7), node(4), node(1)]
+
+
+def test_process_reply_nodes_drops_divergent():
+    traversal = Traversal(None, bytes(20), bytes(20))
+    traversal.alpha = 0
+    for id in range(2, 10):
+        traversal.responded.add(node(id, id), id)
+    traversal.queried.add(("10.0.0.1", 1))
+    nodes = b"".join(
+        struct.pack("!20s4sH", id.to_bytes(20, "big"), bytes([10, 0, 0, port]), 1)
+        for id, port in [(1, 1), (1, 2), (9, 3), (10, 4)]
+    )
+    traversal.process_reply_nodes(nodes)
+    assert [traversal.backlog.pop() for _ in range(len(traversal.backlog))] == [
+        (1, NodeInfo(PeerId((1).to_bytes(20, "big")), ("10.0.0.2", 1))),
+        (9, NodeInfo(PeerId((9).to_bytes(20, "big")), ("10.0.0.3", 1))),
+    ]
+
+
+class MessageRecorder:
+    def __init__(self):
+        self.messages = []
+
+    def on_message(self, msg, src):
+        self.messages.append((msg["y"], src))
+
+
+def test_dispatcher_routes_by_transaction_id():
+    dispatcher = Dispatcher(None)
+    first, second = MessageRecorder(), MessageRecorder()
+    first_tid = dispatcher.new_transaction_id()
+    dispatcher.transactions[first_tid] = first
+    dispatcher.transactions[b"bb"] = second
+    dispatcher.dispatch(bencode.encode_to_bytes({"t": first_tid, "y": "r"}), "a")
+    dispatcher.dispatch(b"d1:t2:bb1:y1:ee", "b")
+    dispatcher.dispatch(b"d1:t2:cc1:y1:re", "c")
+    dispatcher.dispatch(b"garbage", "d")
+    dispatcher.dispatch(b"d1:y1:re", "e")
+    assert first.messages == [(b"r", "a")]
+    assert second.messages == [(b"e", "b")]
+
+
+def test_dispatcher_drops_truncated_reply(caplog):
+    dispatcher = Dispatcher(None)
+    recorder = MessageRecorder()
+    dispatcher.transactions[b"XXXXXXXX"] = recorder
+    dispatcher.dispatch(
+        b"d1:rd2:id20:" + b"a" * 20 + b"5:nodes3:abce1:t8:XXXXXXXX1:y1:r", "a"
+    )
+    assert recorder.messages == []
+    assert "undecodable" in caplog.text
+
+
+def test_routing_table_buckets():
+    table = RoutingTable(bytes(20), k=2)
+    # Distances 4 to 7 all share bucket 3.
+    assert table.add(node(4, 4), last_seen=0)
+    assert table.add(node(5, 5), last_seen=1)
+    assert not table.add(node(6, 6), last_seen=2)
+    assert not table.add(NodeInfo(PeerId(bytes(20)), ("1.2.3.4", 9)))
+    assert table.add(node(1, 1), last_seen=3)
+    assert table.closest((5).to_bytes(20, "big"), 2) == [node(5, 5), node(4, 4)]
+    # A stale node is replaced.
+    assert table.add(node(6, 6), last_seen=RoutingTable.stale_after + 1)
+    assert list(table.buckets[3]) == [("1.2.3.4", 5), ("1.2.3.4", 6)]
+    # Failing nodes are skipped, and eventually dropped.
+    for _ in range(RoutingTable.max_failures):
+        table.on_timeout(("1.2.3.4", 1))
+    assert node(1, 1) not in table.closest(bytes(20), 10)
+    table.on_timeout(("1.2.3.4", 1))
+    assert len(table) == 2
+    # An address that changes ID moves bucket.
+    assert table.add(node(1, 5))
+    assert list(table.buckets[3]) == [("1.2.3.4", 6)]
+    assert len(table) == 2
+
+
+def test_routing_table_persistence():
+    db_conn = sql.connect(":memory:")
+    table = RoutingTable.load(db_conn, bytes(20))
+    assert len(table) == 0
+    table.add(node(4, 4), last_seen=10)
+    table.add(node(9, 9), last_seen=5)
+    table.on_timeout(("1.2.3.4", 9))
+    table.save(db_conn)
+    loaded = RoutingTable.load(db_conn, bytes(20))
+    assert [(e.node_info, e.last_seen, e.failures) for e in loaded.entries()] == [
+        (node(4, 4), 10, 0),
+        (node(9, 9), 5, 1),
+    ]
+
+
+def test_routing_table_saved_root():
+    db_conn = sql.connect(":memory:")
+    first = RoutingTable.saved_root(db_conn)
+    assert len(first) == 20
+    assert RoutingTable.saved_root(db_conn) != first
+    root = bytes(19) + b"\x07"
+    RoutingTable(root).save(db_conn)
+    assert RoutingTable.saved_root(db_conn) == root
+
+
+def test_candidates_defer():
+    candidates = Candidates(bytes(20))
+    candidates.add(node(3))
+    candidates.add(node(5))
+    distance, node_info = candidates.pop()
+    candidates.defer(distance, node_info)
+    candidates.add(NodeInfo(None, ("1.2.3.4", 9)))
+    assert [candidates.pop() for _ in range(len(candidates))] == [
+        (5, node(5)),
+        (None, NodeInfo(None, ("1.2.3.4", 9))),
+        (3, node(3)),
+    ]
+
+
+def test_crawl_records_reach_writer(caplog):
+    caplog.set_level(logging.INFO)
+    results = queue.Queue()
+    sink = CrawlSink(results, batch_size=2)
+    table = CrawlRoutingTable(bytes(20))
+    table.sink = sink
+    table.add(node(4, 4), last_seen=10)
+    infohashes = InfohashSet()
+    response = {"t": b"aa", "r": {"id": b"\x80" + bytes(19), "samples": bytes(40)}}
+    assert send_sample_infohashes_response(sink, response, infohashes) == (2, 1)
+    sink.flush()
+    db_conn = sql.connect(":memory:")
+    db_conn.execute(
+        "create table sample_infohashes_response(time, query_t, num, interval)"
+    )
+    db_conn.execute(
+        "create table sample_infohashes_response_infohash(response_id, infohash)"
+    )
+    coverage = CoveragePlanner(prefix_bits=1)
+    writer = CrawlWriter(results, RoutingTable(bytes(20)), coverage, InfohashSet())
+    commits = sql.commits.value
+    writer.run(db_conn, [])
+    assert writer.records == 2
+    assert sql.commits.value == commits + 1
+    assert [e.node_info for e in writer.routing_table.entries()] == [node(4, 4)]
+    assert coverage.samples == [0, 1]
+    assert db_conn.execute(
+        "select count(*) from sample_infohashes_response_infohash"
+    ).fetchone() == (2,)
+    (stamped,) = db_conn.execute("select time from sample_infohashes_response").fetchone()
+    assert stamped == sql.db_datetime(coverage.last_sampled[1])
+    # Both samples are the same infohash, new to the worker and the writer.
+    assert caplog.text.count("got new infohash") == 1
+
+
+class AnsweringSocket:
+    # Replies to queries sent to the answering address, and drops the rest.
+    def __init__(self, answering: Addr):
+        self.answering = answering
+        self.sent = []
+        self.replies, self.received = trio.open_memory_channel(10)
+
+    async def sendto(self, bytes, addr):
+        self.sent.append(addr)
+        if addr == self.answering:
+            t = bencode.parse_one_from_bytes(bytes)[b"t"]
+            reply = {"t": t, "y": "r", "r": {"id": (1).to_bytes(20, "big")}}
+            self.replies.send_nowait((bencode.encode_to_bytes(reply), addr))
+
+    async def recvfrom(self, amount):
+        return await self.received.receive()
+
+
+def test_traversal_completes_replies_and_timeouts():
+    socket = AnsweringSocket(("1.2.3.4", 1))
+    scheduler = QueryScheduler(initial_timeout=0.05, min_timeout=0.05)
+    traversal = Bootstrap(socket, bytes(20), bytes(20), scheduler=scheduler)
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(traversal.dispatcher.run)
+            traversal.add_candidates(("1.2.3.4", 1), ("1.2.3.4", 2))
+            with trio.fail_after(1):
+                await traversal.wait_exhausted()
+            nursery.cancel_scope.cancel()
+
+    trio.run(main)
+    assert sorted(socket.sent) == [("1.2.3.4", 1), ("1.2.3.4", 2)]
+    assert list(traversal.responded) == [node(1, 1)]
+    assert not traversal.active and not traversal.dispatcher.transactions
+    assert scheduler.timeouts == 1
+
+
+def test_replay_operations():
+    source = sql.connect(":memory:")
+    source.execute(
+        "create table operation(remote_addr, type, error, payload, datetime, "
+        "t blob, y text, q text, node_id blob, error_code integer)"
+    )
+    nodes = struct.pack("!20s4sH", (3).to_bytes(20, "big"), bytes([10, 0, 0, 3]), 1)
+    query = {"id": bytes(20), "target": bytes(20)}
+    reply = {"id": (1).to_bytes(20, "big"), "samples": bytes(40), "nodes": nodes}
+    operations = [
+        ("send", {"t": b"aa", "y": "q", "q": "sample_infohashes", "a": query}, 0),
+        ("send", {"t": b"bb", "y": "q", "q": "find_node", "a": query}, 0),
+        ("send", {"t": b"cc", "y": "q", "q": "ping", "a": {"id": bytes(20)}}, 0),
+        ("recv", {"t": b"aa", "y": "r", "r": reply}, 1),
+        ("recv", {"t": b"cc", "y": "r", "r": {"id": (2).to_bytes(20, "big")}}, 1),
+        ("recv", {"t": b"dd", "y": "r", "r": {}}, 60),
+    ]
+    for type, msg, seconds in operations:
+        source.execute(
+            "insert into operation(remote_addr, type, payload, datetime) "
+            "values (?, ?, ?, datetime(?, 'unixepoch'))",
+            ("1.2.3.4:5", type, bencode.encode_to_bytes(msg), seconds),
+        )
+    replayer = Replayer(sql.connect(":memory:"))
+    results = trio.run(replay_operations, source, replayer)
+    assert (results["packets"], results["sent"], results["received"]) == (6, 3, 3)
+    assert (results["replies"], results["timeouts"]) == (1, 1)
+    assert (results["samples"], results["new_infohashes"]) == (2, 1)
+    assert results["recorded_seconds"] == 60
+    assert [e.node_info for e in replayer.routing_table.entries()] == [node(1, 5)]
+    assert not replayer.dispatcher.transactions
+    assert replayer.db_conn.execute("select count(*) from operation").fetchone() == (6,)
+
+
+class TimedSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def sendto(self, bytes, addr):
+        self.sent.append((addr, trio.current_time()))
+
+    async def recvfrom(self, amount):
+        await trio.sleep_forever()
+
+
+def test_dispatcher_sends_around_throttled_subnet():
+    sink = TimedSocket()
+    dispatcher = Dispatcher(PacedSocket(sink, Pacer(subnet_packets_per_second=1)))
+    handler = MessageRecorder()
+    handler.on_sent = lambda tid: None
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(dispatcher.run)
+            for addr in [("1.2.3.4", 1), ("1.2.3.5", 1), ("1.2.4.4", 1)]:
+                tid = dispatcher.new_transaction_id()
+                dispatcher.transactions[tid] = handler
+                dispatcher.send(handler, tid, b"x", addr)
+            await trio.sleep(2)
+            nursery.cancel_scope.cancel()
+
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    sent = dict(sink.sent)
+    assert sent[("1.2.4.4", 1)] == 0
+    # Whichever of the /24's packets was dequeued second waited its turn.
+    assert sorted([sent[("1.2.3.4", 1)], sent[("1.2.3.5", 1)]]) == [0, 1]
+
+
+def test_closed_traversal_sends_nothing_more():
+    sink = TimedSocket()
+    traversal = Bootstrap(sink, bytes(20), bytes(20))
+
+    async def main():
+        traversal.add_candidates(("1.2.3.4", 1), ("1.2.3.4", 2))
+        traversal.close()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(traversal.dispatcher.run)
+            await trio.sleep(1)
+            nursery.cancel_scope.cancel()
+
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    assert sink.sent == []
+
+
+def test_unsupported_nodes_still_route():
+    node_health = NodeHealthCache()
+    node_health.on_reply(("1.2.3.4", 1), {b"e": [204, b"Method Unknown"]}, sampled=True)
+    recorded = []
+    traversal = SampleInfohashes(
+        lambda response: recorded.append(response) or (0, 0),
+        None,
+        bytes(20),
+        bytes(20),
+        node_health=node_health,
+    )
+    traversal.add_candidates(("1.2.3.4", 1))
+    ((tid, pending),) = traversal.active.items()
+    assert bencode.parse_one_from_bytes(pending.bytes)[b"q"] == b"find_node"
+    nodes = struct.pack("!20s4sH", (1).to_bytes(20, "big"), bytes([10, 0, 0, 1]), 1)
+    reply = {"t": tid, "y": "r", "r": {"id": (2).to_bytes(20, "big"), "nodes": nodes}}
+    traversal.dispatcher.dispatch(bencode.encode_to_bytes(reply), ("1.2.3.4", 1))
+    assert recorded == []
+    assert ("10.0.0.1", 1) in traversal.queried
+    assert node_health.get(("1.2.3.4", 1)).supports_sample_infohashes is False
+
+
+def test_send_rates_must_be_positive():
+    assert positive_float("2.5") == 2.5
+    for bad in ["0", "-1", "nan"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            positive_float(bad)
@@ -0,0 +1,95 @@
+import socket
+import sqlite3
+import struct
+import trio
+
+from metrics import *
+
+
+def test_render():
+    registry = Registry()
+    registry.counter("sent_total", "packets sent").inc(3)
+    registry.gauge("backlog", "candidates", func=lambda: 7)
+    histogram = registry.histogram("rtt_seconds", "round trips", [0.1, 1])
+    for value in [0.05, 0.1, 0.5, 2]:
+        histogram.observe(value)
+    assert registry.render() == "\n".join(
+        [
+            "# HELP sent_total packets sent",
+            "# TYPE sent_total counter",
+            "sent_total 3",
+            "# HELP backlog candidates",
+            "# TYPE backlog gauge",
+            "backlog 7",
+            "# HELP rtt_seconds round trips",
+            "# TYPE rtt_seconds histogram",
+            'rtt_seconds_bucket{le="0.1"} 2',
+            'rtt_seconds_bucket{le="1"} 3',
+            'rtt_seconds_bucket{le="+Inf"} 4',
+            "rtt_seconds_sum 2.65",
+            "rtt_seconds_count 4",
+            "",
+        ]
+    )
+
+
+def test_registry_reuses_metrics():
+    registry = Registry()
+    assert registry.counter("a", "") is registry.counter("a", "")
+    try:
+        registry.gauge("a", "")
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_save():
+    registry = Registry()
+    registry.counter("a", "").inc()
+    db_conn = sqlite3.connect(":memory:")
+    registry.save(db_conn)
+    registry.save(db_conn)
+    assert db_conn.execute("select name, value from stats").fetchall() == [
+        ("a", 1),
+        ("a", 1),
+    ]
+
+
+def test_serve():
+    registry = Registry()
+    registry.counter("a", "things").inc()
+
+    async def get(port, path):
+        stream = await trio.open_tcp_stream("127.0.0.1", port)
+        async with stream:
+            await stream.send_all(f"GET {path} HTTP/1.0\r\n\r\n".encode())
+            response = b""
+            while True:
+                data = await stream.receive_some(0x1000)
+                if not data:
+                    return response
+                response += data
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            listeners = await nursery.start(serve, 0, registry)
+            port = listeners[0].socket.getsockname()[1]
+            # A reset connection doesn't stop the server.
+            reset = await trio.open_tcp_stream("127.0.0.1", port)
+            reset.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+            await reset.send_all(b"GET /metrics")
+            await trio.sleep(0.05)
+            reset.socket.close()
+            await trio.sleep(0.05)
+            found = await get(port, "/metrics")
+            missing = await get(port, "/nope")
+            nursery.cancel_scope.cancel()
+        return found, missing
+
+    found, missing = trio.run(main)
+    assert found.startswith(b"HTTP/1.0 200 OK\r\n")
+    assert found.endswith(b"\r\n\r\n# HELP a things\n# TYPE a counter\na 1\n")
+    assert missing.startswith(b"HTTP/1.0 404")
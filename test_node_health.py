@@ -0,0 +1,53 @@
+from node_health import *
+import sql
+
+a = ("1.2.3.4", 1)
+b = ("1.2.3.4", 2)
+
+
+def test_timeouts_defer_then_skip():
+    cache = NodeHealthCache(skip_after_timeouts=2, retry_after=10)
+    assert cache.check(a, now=0) == Verdict.QUERY
+    cache.on_timeout(a, now=1)
+    assert cache.check(a, now=2) == Verdict.DEFER
+    cache.on_timeout(a, now=3)
+    assert cache.check(a, now=4) == Verdict.SKIP
+    assert cache.check(a, now=14) == Verdict.QUERY
+    cache.on_reply(a, {b"r": {b"id": b"x"}}, now=15)
+    assert cache.get(a, now=15).consecutive_timeouts == 0
+    assert (cache.lookups, cache.hits, cache.skips, cache.deferrals) == (4, 3, 1, 1)
+    assert cache.hit_rate == 0.75
+
+
+def test_sample_infohashes_support():
+    cache = NodeHealthCache()
+    cache.on_reply(a, {b"e": [204, b"Method Unknown"]}, sampled=True, now=0)
+    cache.on_reply(b, {b"r": {b"id": b"x", b"samples": b""}}, sampled=True, now=0)
+    assert cache.get(a, now=1).errors == 1
+    assert cache.check(a, needs_sample_infohashes=True, now=1) == Verdict.ROUTE_ONLY
+    assert cache.check(a, needs_sample_infohashes=False, now=1) == Verdict.QUERY
+    assert cache.get(b, now=1).supports_sample_infohashes
+    # A malformed reply doesn't count as support.
+    cache.on_reply(b, {b"r": b"nope"}, sampled=True, now=2)
+    assert cache.get(b, now=2).supports_sample_infohashes is False
+
+
+def test_bounded_and_expiring():
+    cache = NodeHealthCache(max_entries=2, ttl=100)
+    for port in range(3):
+        cache.on_timeout(("1.2.3.4", port), now=port)
+    assert list(cache.entries) == [a, b]
+    assert cache.get(a, now=50) is not None
+    assert cache.get(a, now=200) is None
+
+
+def test_persistence():
+    db_conn = sql.connect(":memory:")
+    cache = NodeHealthCache.load(db_conn)
+    now = time.time()
+    cache.on_timeout(a, now=now - 2)
+    cache.on_reply(b, {b"e": [201, b"Generic Error"]}, now=now - 1)
+    cache.save(db_conn)
+    loaded = NodeHealthCache.load(db_conn)
+    assert loaded.entries == cache.entries
+    assert NodeHealthCache.load(db_conn, ttl=0).entries == {}
@@ -0,0 +1,54 @@
+import trio
+import trio.testing
+
+from pacing import *
+
+a = ("1.2.3.4", 1)
+b = ("1.2.3.5", 1)
+c = ("1.2.4.4", 1)
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take(1, now=0) == 0
+    assert bucket.take(1, now=0) == 0
+    assert bucket.take(1, now=0) == 0.1
+    assert bucket.take(1, now=0) == 0.2
+    # Refilled for 0.3s, which pays off the debt and adds one token.
+    assert bucket.take(1, now=0.3) == 0
+
+
+def test_pacer_limits_packets_and_bytes():
+    pacer = Pacer(packets_per_second=100, bytes_per_second=1500, burst_seconds=0)
+    assert pacer.delay(1000, a, now=0) == 0
+    assert pacer.delay(1000, a, now=0) == 500 / 1500
+    assert (pacer.sends, pacer.throttled) == (2, 1)
+    assert pacer.throttled_seconds == 500 / 1500
+
+
+def test_pacer_limits_per_subnet():
+    pacer = Pacer(subnet_packets_per_second=1)
+    assert pacer.delay(100, a, now=0) == 0
+    assert pacer.delay(100, b, now=0) == 1
+    assert pacer.delay(100, c, now=0) == 0
+    assert pacer.delay(100, ("router.example", 1), now=0) == 0
+    assert len(pacer.subnets) == 3
+
+
+def test_paced_socket_waits():
+    class Sink:
+        def __init__(self):
+            self.sent = []
+
+        async def sendto(self, bytes, addr):
+            self.sent.append(trio.current_time())
+
+    sink = Sink()
+    socket = PacedSocket(sink, Pacer(packets_per_second=10, burst_seconds=0))
+
+    async def main():
+        for _ in range(3):
+            await socket.sendto(b"x", a)
+
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    assert [round(t - sink.sent[0], 3) for t in sink.sent] == [0, 0.1, 0.2]
@@ -0,0 +1,64 @@
+import time
+import trio
+
+from profiling import *
+
+
+class Work:
+    def step(self, n):
+        return n + 1
+
+
+def test_hot_paths_sample_and_restore():
+    original = Work.step
+    hot_paths = HotPaths(every=4)
+    hot_paths.wrap(Work, "step")
+    work = Work()
+    assert [work.step(n) for n in range(10)] == list(range(1, 11))
+    stats = hot_paths.paths["Work.step"]
+    assert (stats.calls, stats.sampled) == (10, 2)
+    assert stats.estimated_seconds > 0
+    hot_paths.restore()
+    assert Work.step is original
+
+
+def test_instrument_counts_tasks():
+    instrument = TaskInstrument()
+
+    async def child():
+        await trio.sleep(0)
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            for _ in range(3):
+                nursery.start_soon(child, name="child")
+
+    trio.run(main, instruments=[instrument])
+    assert instrument.tasks["child"].spawns == 3
+    assert instrument.tasks["child"].steps == 6
+    assert instrument.latencies
+
+
+def test_profiler_summary_and_stacks(tmp_path):
+    path = tmp_path / "stacks"
+    profiler = Profiler([(Work, "step")], str(path))
+
+    async def busy():
+        work = Work()
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            work.step(1)
+        await trio.sleep(0)
+
+    async def main():
+        profiler.start()
+        try:
+            await busy()
+        finally:
+            profiler.stop()
+
+    trio.run(main)
+    summary = profiler.summary()
+    assert "Work.step" in summary
+    stacks = path.read_text().splitlines()
+    assert any("test_profiling.py:busy" in line for line in stacks)
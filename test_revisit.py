@@ -0,0 +1,79 @@
+from revisit import *
+import bencode
+import trio
+
+a = ("1.2.3.4", 1)
+b = ("1.2.3.4", 2)
+
+
+def reply(num, interval):
+    return {"r": {"num": num, "interval": interval}}
+
+
+def test_schedule_respects_interval_and_yield():
+    scheduler = RevisitScheduler(revisit_base=100, max_revisit=10_000)
+    # Productive node with more to give: revisited after its interval.
+    scheduler.observe(a, reply(1000, 60), samples=20, new=20, now=0)
+    # Unproductive node: backed off well past its interval.
+    scheduler.observe(b, reply(1000, 60), samples=20, new=0, now=0)
+    assert scheduler.nodes[a].next_sample == 60
+    assert scheduler.nodes[b].next_sample == 200
+    assert scheduler.pop_due(now=59) is None
+    assert scheduler.pop_due(now=60).addr == a
+    assert scheduler.pop_due(now=60) is None
+    assert scheduler.next_due() == 200
+
+
+def test_exhausted_node_waits_for_interval():
+    scheduler = RevisitScheduler(revisit_base=1)
+    scheduler.observe(a, reply(5, 3600), samples=5, new=5, now=0)
+    assert scheduler.nodes[a].next_sample == 3600
+    scheduler.observe(a, reply(5, 10**9), samples=5, new=5, now=0)
+    assert scheduler.nodes[a].next_sample == MAX_INTERVAL
+
+
+def test_malformed_reply_fields_ignored():
+    scheduler = RevisitScheduler(revisit_base=100)
+    scheduler.observe(a, reply(b"lots", b"soon"), samples=20, new=20, now=0)
+    assert scheduler.nodes[a].last_num is None
+    # Scheduled on yield alone.
+    assert scheduler.nodes[a].next_sample == 100 / (21 / 2)
+    scheduler.observe(b, {"r": b"nope"}, samples=0, new=0, now=0)
+    assert scheduler.nodes[b].last_num is None
+
+
+def test_failures_drop_node():
+    scheduler = RevisitScheduler(retry_after=10, max_failures=2)
+    scheduler.observe(a, reply(None, None), samples=0, new=0, now=0)
+    scheduler.on_failure(a, now=5)
+    assert scheduler.pop_due(now=14) is None
+    assert scheduler.pop_due(now=15).addr == a
+    scheduler.on_failure(a, now=15)
+    assert a not in scheduler.nodes
+    assert scheduler.next_due() is None
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.requests = []
+
+    async def request(self, addr, q, a, timeout):
+        self.requests.append((addr, q))
+        return bencode.parse_lazy(
+            bencode.encode_to_bytes({"r": {"num": 10, "interval": 600}})
+        )
+
+
+def test_run_revisits_due_nodes():
+    scheduler = RevisitScheduler()
+    scheduler.observe(a, reply(10, 0), samples=0, new=0, now=0)
+    dispatcher = FakeDispatcher()
+
+    async def main():
+        with trio.move_on_after(0.1):
+            await scheduler.run(dispatcher, bytes(20), lambda reply: (3, 2))
+
+    trio.run(main)
+    assert dispatcher.requests == [(a, "sample_infohashes")]
+    assert (scheduler.queries, scheduler.new_infohashes) == (1, 2)
+    assert scheduler.nodes[a].queries == 2
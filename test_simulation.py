@@ -0,0 +1,64 @@
+import argparse
+import trio
+import trio.testing
+
+import main
+from simulation import *
+
+
+def closest_id(network, target: bytes) -> int:
+    target = int.from_bytes(target, "big")
+    return min(network.ids, key=lambda id: id ^ target)
+
+
+def test_find_node_converges_on_closest():
+    network = SimNetwork(nodes=500, loss=0, sample_support=1)
+    socket = SimSocket(network)
+    target = bytes(20)
+    traversal = main.Bootstrap(socket, target, bytes([1] * 20))
+
+    async def run():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(network.run)
+            nursery.start_soon(traversal.dispatcher.run)
+            traversal.add_candidates(*network.bootstrap_nodes())
+            await traversal.wait_exhausted()
+            nursery.cancel_scope.cancel()
+
+    trio.run(run, clock=trio.testing.MockClock(autojump_threshold=0))
+    closest = list(traversal.responded)[-1]
+    assert int.from_bytes(closest.id.bytes, "big") == closest_id(network, target)
+    assert network.queries == len(traversal.queried)
+
+
+def test_unsupported_and_dead_nodes():
+    network = SimNetwork(nodes=10, loss=0, sample_support=0)
+    node = next(iter(network.nodes.values()))
+    reply = network._reply(
+        node, {b"t": b"aa", b"q": b"sample_infohashes", b"a": {b"target": bytes(20)}}
+    )
+    assert reply["e"][0] == METHOD_UNKNOWN
+    node.alive = False
+    network.send(SimSocket(network), b"", node.addr)
+    assert network.dropped == 1
+
+
+def test_simulate_command():
+    args = argparse.Namespace(
+        nodes=300,
+        seed=1,
+        latency=0.05,
+        loss=0.01,
+        churn=0.01,
+        infohashes=1000,
+        infohashes_per_node=20,
+        query="sample_infohashes",
+        traversals=3,
+        parallel=2,
+        max_window=16,
+    )
+    results = main.run_simulation(args)
+    assert results["traversals"] == 3
+    assert results["queries_per_traversal"] > 8
+    assert results["new_infohashes"] > 0
+    assert results["convergence_p50_seconds"] > 0
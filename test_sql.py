@@ -7,3 +7,73 @@ def test_chunk_bytes():
     a.execute("insert into herp values (x'deadbeef'), (x'c0ffee')")
     b = list(a.execute("select herp.rowid, chunk from herp, chunk(derp, 2)"))
     assert b == [(1, b"\xde\xad"), (1, b"\xbe\xef"), (2, b"\xc0\xff"), (2, b"\xee")]
+
+
+def test_read_blob_chunks():
+    a = connect(":memory:")
+    a.execute("create table herp(derp)")
+    a.execute("insert into herp values (?)", [b"d1:ai1ee"])
+    assert list(read_blob_chunks(a, "herp", "derp", 1, 3)) == [b"d1:", b"ai1", b"ee"]
+
+
+def test_batch_recorder(tmp_path):
+    database = str(tmp_path / "recorder.db")
+    db = connect(database)
+    db.execute("create table operation(remote_addr, type, error, payload, datetime)")
+    upgrade_operation_table(db)
+
+    async def record():
+        async with open_batch_recorder(database, batch_size=3) as recorder:
+            for i in range(10):
+                await recorder.record("send", f"1.2.3.4:{i}", b"de", None)
+        return recorder.stats
+
+    stats = trio.run(record)
+    assert stats.queued == stats.written == 10
+    assert stats.flushes >= 4
+    assert stats.dropped == 0
+    assert db.execute("select count(*), min(type) from operation").fetchone() == (
+        10,
+        "send",
+    )
+
+
+def test_batch_recorder_drops_when_full():
+    recorder = BatchRecorder(":memory:", max_queue=1, drop_when_full=True)
+
+    async def record():
+        for _ in range(3):
+            await recorder.record("recv", "1.2.3.4:5", b"de", None)
+
+    trio.run(record)
+    assert recorder.queue_depth == 1
+    assert (recorder.stats.queued, recorder.stats.dropped) == (1, 2)
+
+
+def test_operation_columns():
+    db = connect(":memory:")
+    db.execute("create table operation(remote_addr, type, error, payload, datetime)")
+    db.execute("create index operation_type_remote_addr on operation(type, remote_addr)")
+    db.execute(
+        "insert into operation values ('1.2.3.4:5', 'recv', null, ?, datetime('now'))",
+        [b"d1:rd2:id2:xye1:t2:aa1:y1:re"],
+    )
+    upgrade_operation_table(db)
+    record_operation(db, "send", "1.2.3.4:5", b"d1:ad2:id2:mee1:q4:ping1:t2:bb1:y1:qe", None)
+    record_operation(db, "recv", "1.2.3.4:5", b"d1:eli201e5:Errore1:t2:bb1:y1:ee", None)
+    record_operation(db, "recv", "1.2.3.4:6", b"d1:ad2:id2:zze1:q4:ping1:t2:cc1:y1:qe", None)
+    record_operation(db, "recv", "1.2.3.4:7", b"garbage", None)
+    record_operation(db, "recv", "1.2.3.4:8", b"d1:t-3:ae", None)
+    select = "select t, y, q, node_id, error_code from operation order by rowid"
+    assert list(db.execute(select))[1:] == [
+        (b"bb", "q", "ping", None, None),
+        (b"bb", "e", None, None, 201),
+        (b"cc", "q", "ping", b"zz", None),
+        (None, None, None, None, None),
+        (None, None, None, None, None),
+    ]
+    assert backfill_operation_columns(db, batch_size=2) == 6
+    assert list(db.execute(select))[0] == (b"aa", "r", None, b"xy", None)
+    indexes = {row[1] for row in db.execute("pragma index_list(operation)")}
+    assert "operation_t" in indexes
+    assert "operation_type_remote_addr" not in indexes
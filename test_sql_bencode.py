@@ -1,4 +1,5 @@
 from sql import *
+import pytest
 
 
 def test_get_r_nodes():
@@ -20,3 +21,48 @@ def test_misc():
     assert bencode_get(b"li1ei2ei3ee", 1) == 2
     assert bencode_get(b"de", 1) == None
     assert bencode_get(b"le", 1) == None
+
+
+def test_get_negative_length():
+    with pytest.raises(ValueError):
+        bencode_get(b"d1:a-3:e1:ti1ee", "t")
+
+
+def test_get_paths():
+    payload = b"d1:ad2:id3:abc6:targetli1ei2eee1:q4:ping1:t2:aa1:y1:qe"
+    assert bencode_get_paths(
+        payload, [("t",), ("a", "id"), ("a", "target", 1), ("a",), ("nope",), ("q", 0)]
+    ) == [b"aa", b"abc", 2, None, None, None]
+    assert bencode_get_paths(None, [("t",)]) == [None]
+    assert bencode_get(payload, "a", "target", 0) == 1
+    assert bencode_get(payload, "a", "nope") is None
+    assert bencode_get(payload, "t", "nope") is None
+
+
+def test_get_paths_mixed_keys_and_indexes():
+    payloads = [
+        b"d1:ai14e1:b1:y2:rbi28ee",
+        b"d2:ab2:bye",
+        b"d1:ad1:ai1e1:bli2ei3eee1:ai4e1:bi5ee",
+        b"d1:ad1:0i1e1:1i2ee1:b1:ce",
+    ]
+    keys: list = ["a", "b", "ab", "by", "0", 0, 1, 2, 3]
+    paths = [(key,) for key in keys] + [(a, b) for a in keys for b in keys]
+    for payload in payloads:
+        assert bencode_get_paths(payload, paths) == [
+            bencode_get(payload, *path) for path in paths
+        ]
+
+
+def test_get_many_table_function():
+    db = connect(":memory:")
+    db.execute("create table operation(payload)")
+    db.execute(
+        "insert into operation values (?), (?)",
+        [b"d1:rd2:id2:xye1:t2:aa1:y1:re", b"d1:t2:bb1:y1:qe"],
+    )
+    assert list(
+        db.execute(
+            "select operation.rowid, path, value from operation, bencode_get_many(payload, 't,r.id')"
+        )
+    ) == [(1, "t", b"aa"), (1, "r.id", b"xy"), (2, "t", b"bb"), (2, "r.id", None)]
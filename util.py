@@ -1,6 +1,28 @@
+import contextlib
+import logging
+
+
 def chunk_bytes(bytes, size, strict=False):
     if strict and len(bytes) % size:
         raise ValueError(f"len(input) ({len(bytes)}) is not multiple of {size}")
-    while bytes:
-        yield bytes[:size]
-        bytes = bytes[size:]
+    for start in range(0, len(bytes), size):
+        yield bytes[start : start + size]
+
+
+# Nearest-rank percentiles of values, or Nones if there are no values.
+def percentiles(values, ps):
+    values = sorted(values)
+    if not values:
+        return [None] * len(ps)
+    return [values[min(len(values) - 1, len(values) * p // 100)] for p in ps]
+
+
+# Silences logging below errors for benchmarks, where per-reply logging would
+# swamp what's being measured.
+@contextlib.contextmanager
+def quiet_logging():
+    logging.disable(logging.ERROR)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)